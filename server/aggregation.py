@@ -0,0 +1,436 @@
+import threading
+
+import numpy as np
+
+PARAM_KINDS = ("weights", "bias")
+
+
+# Exact sums split every term into binary digits on a fixed grid, EXACT_DIGIT_BITS bits per digit,
+# and add each digit into its own float64 array. A digit sum is a whole number of grid steps below
+# 2^53 for up to 2^20 terms, so no addition ever rounds; carrying into the next digit restores the
+# headroom. Being exact, the sum does not depend on the order terms are added or merged in.
+EXACT_DIGIT_BITS = 33
+EXACT_MIN_EXPONENT = -149  # float32 values, and their integer multiples, are multiples of 2^-149
+EXACT_NUM_DIGITS = 10  # up to the float32 maximum times MAX_EXACT_SCALE
+EXACT_CARRY_INTERVAL = 1 << 19
+MAX_EXACT_SCALE = 1 << 29  # a float32 times a smaller integer is exact in float64
+# Sample counts weight exact sums, so they have to stay below MAX_EXACT_SCALE
+MAX_SAMPLE_COUNT = MAX_EXACT_SCALE - 1
+
+
+def non_finite_tensors(weights):
+    # (layer, kind) of every tensor holding a NaN or an infinity. One of those in a running sum stays
+    # there for good: subtracting an infinity again leaves NaN.
+    return [(layer, kind) for layer, params in weights.items() for kind, values in params.items()
+            if not np.isfinite(values).all()]
+
+
+def fedavg(weight_dicts):
+    # Streams over the clients, so peak memory is one float64 sum per layer rather than
+    # clients x layer size. Adding the clients in order onto float64 zeros is exactly what
+    # np.mean(np.stack(...), axis=0, dtype=np.float64) does, bit for bit (signed zeros included).
+    sums = {}
+    n = 0
+    for weights in weight_dicts:
+        for key, params in weights.items():
+            if n == 0:
+                sums[key] = {kind: np.zeros(np.shape(params[kind]), dtype=np.float64) for kind in PARAM_KINDS}
+            for kind in PARAM_KINDS:
+                sums[key][kind] += params[kind]
+        n += 1
+    if n == 0:
+        raise ValueError("No client weights to average")
+
+    # Calculate the average weights and biases
+    return {key: {kind: layer_sums[kind] / n for kind in PARAM_KINDS} for key, layer_sums in sums.items()}
+
+
+def digit_step(index):
+    return 2.0 ** (EXACT_MIN_EXPONENT + EXACT_DIGIT_BITS * index)
+
+
+class ExactSum:
+    # Exact running sum of float32 arrays scaled by integers. Digits below the top one are kept in
+    # [0, 2^EXACT_DIGIT_BITS) steps after a carry, so the same total always has the same digits and
+    # value() rounds it the same way no matter how it was put together.
+    def __init__(self):
+        self.digits = {}
+        self.pending = 0
+
+    def add(self, values, scale=1):
+        values = np.asarray(values)
+        if abs(scale) >= MAX_EXACT_SCALE:
+            raise ValueError(f"Scale {scale} is too large to sum exactly")
+        if values.dtype == np.float32:
+            pieces = [values]
+        else:
+            # Wider inputs are split into float32 pieces, each of which multiplies exactly
+            head = values.astype(np.float32)
+            rest = values - head
+            middle = rest.astype(np.float32)
+            pieces = [head, middle, (rest - middle).astype(np.float32)]
+        for piece in pieces:
+            self._add_terms(np.multiply(piece, scale, dtype=np.float64))
+
+    def _add_terms(self, remainder):
+        peak = float(np.max(np.abs(remainder))) if remainder.size else 0.0
+        if not np.isfinite(peak):
+            self._accumulate(0, remainder)
+            return
+        top = 0
+        if peak > 0:
+            top = min(EXACT_NUM_DIGITS - 1, max(0, (np.frexp(peak)[1] - 1 - EXACT_MIN_EXPONENT) // EXACT_DIGIT_BITS))
+        for index in range(top, 0, -1):
+            step = digit_step(index)
+            # Truncation keeps the remainder no larger than the value it came from, so it is exact
+            part = np.trunc(remainder / step) * step
+            remainder = remainder - part
+            if index in self.digits or part.any():
+                self._accumulate(index, part)
+        self._accumulate(0, remainder)
+        self.pending += 1
+        if self.pending >= EXACT_CARRY_INTERVAL:
+            self.carry()
+
+    def _accumulate(self, index, part):
+        if index in self.digits:
+            self.digits[index] += part
+        else:
+            self.digits[index] = np.array(part, dtype=np.float64)
+
+    def carry(self):
+        for index in range(EXACT_NUM_DIGITS - 1):
+            if index not in self.digits:
+                continue
+            step = digit_step(index + 1)
+            carried = np.floor(self.digits[index] / step) * step
+            if carried.any():
+                self.digits[index] -= carried
+                self._accumulate(index + 1, carried)
+        self.pending = 1 if self.digits else 0
+
+    def merge(self, other):
+        for index, digit in other.digits.items():
+            self._accumulate(index, digit)
+        self.pending += other.pending
+        if self.pending >= EXACT_CARRY_INTERVAL:
+            self.carry()
+
+    def copy(self):
+        clone = ExactSum()
+        clone.digits = {index: digit.copy() for index, digit in self.digits.items()}
+        clone.pending = self.pending
+        return clone
+
+    def value(self):
+        self.carry()
+        # From the top digit down, the running total is exact until it outgrows float64 and the
+        # lower digits then only round it
+        total = None
+        for index in sorted(self.digits, reverse=True):
+            total = self.digits[index].copy() if total is None else total + self.digits[index]
+        return total
+
+
+class PartialAggregate:
+    # Mergeable FedAvg state: per layer and kind, the exact sample-weighted sum of client parameters,
+    # plus the total sample count and the contributing clients. Partials built over disjoint sets of
+    # clients merge into exactly the partial of all of them, so edge servers can each sum their own
+    # clients and a root can average the merge bit for bit as if it had received every upload itself.
+    def __init__(self):
+        self.sums = {}
+        self.total_samples = 0
+        self.clients = []
+
+    def add(self, weights, num_samples):
+        # A negative num_samples takes back an earlier contribution of the same weights
+        for layer, params in weights.items():
+            layer_sums = self.sums.setdefault(layer, {})
+            for kind in PARAM_KINDS:
+                layer_sums.setdefault(kind, ExactSum()).add(params[kind], num_samples)
+        self.total_samples += num_samples
+
+    def merge(self, other):
+        for layer, layer_sums in other.sums.items():
+            for kind, exact in layer_sums.items():
+                self.sums.setdefault(layer, {}).setdefault(kind, ExactSum()).merge(exact)
+        self.total_samples += other.total_samples
+        self.clients = self.clients + other.clients
+
+    def copy(self):
+        clone = PartialAggregate()
+        clone.sums = {layer: {kind: exact.copy() for kind, exact in layer_sums.items()}
+                      for layer, layer_sums in self.sums.items()}
+        clone.total_samples = self.total_samples
+        clone.clients = list(self.clients)
+        return clone
+
+    def average(self):
+        if self.total_samples <= 0:
+            raise ValueError("No client contributions to average")
+        return {
+            layer: {kind: layer_sums[kind].value() / self.total_samples for kind in PARAM_KINDS}
+            for layer, layer_sums in self.sums.items()
+        }
+
+
+def stack_params(weight_dicts, layer, kind):
+    return np.stack([np.asarray(w[layer][kind], dtype=np.float32).ravel() for w in weight_dicts])
+
+
+def weighted_fedavg(weight_dicts, num_samples=None):
+    # Summed exactly, so it agrees bit for bit with the running accumulator and with merged partials
+    if num_samples is None:
+        return fedavg(weight_dicts)
+    partial = PartialAggregate()
+    for weights, n in zip(weight_dicts, num_samples):
+        partial.add(weights, n)
+    return partial.average()
+
+
+def coordinate_median(weight_dicts, num_samples=None):
+    # Per-coordinate median by partial selection of the middle order statistic(s), no full sort
+    n = len(weight_dicts)
+    middle = [(n - 1) // 2, n // 2]
+    avg = {}
+    for layer in weight_dicts[0]:
+        avg[layer] = {}
+        for kind in PARAM_KINDS:
+            selected = np.partition(stack_params(weight_dicts, layer, kind), middle, axis=0)
+            avg[layer][kind] = np.mean(selected[middle], axis=0, dtype=np.float64)
+    return avg
+
+
+def trimmed_mean(weight_dicts, num_samples=None, trim_ratio=0.1):
+    # Drops the floor(trim_ratio * n) largest and smallest values of every coordinate. A single
+    # two-sided partition places exactly the kept values between the two cut points.
+    n = len(weight_dicts)
+    k = int(np.floor(trim_ratio * n))
+    if not 0 <= trim_ratio < 0.5 or n - 2 * k < 1:
+        raise ValueError(f"trim_ratio {trim_ratio} leaves no values for {n} clients")
+    avg = {}
+    for layer in weight_dicts[0]:
+        avg[layer] = {}
+        for kind in PARAM_KINDS:
+            stacked = stack_params(weight_dicts, layer, kind)
+            if k:
+                stacked = np.partition(stacked, [k, n - k - 1], axis=0)[k:n - k]
+            avg[layer][kind] = np.mean(stacked, axis=0, dtype=np.float64)
+    return avg
+
+
+def krum_scores(weight_dicts, num_byzantine):
+    # Krum score of each client: the sum of squared distances to its n - f - 2 nearest neighbours.
+    # All pairwise distances come from one Gram matrix product over the flattened, centred updates.
+    n = len(weight_dicts)
+    flat = np.concatenate([stack_params(weight_dicts, layer, kind)
+                           for layer in weight_dicts[0] for kind in PARAM_KINDS], axis=1)
+    flat -= flat.mean(axis=0, dtype=np.float64).astype(np.float32)
+    gram = (flat @ flat.T).astype(np.float64)
+    norms = np.diag(gram)
+    distances = np.maximum(norms[:, None] + norms[None, :] - 2 * gram, 0)
+    np.fill_diagonal(distances, np.inf)
+    neighbours = n - num_byzantine - 2
+    return np.partition(distances, neighbours - 1, axis=1)[:, :neighbours].sum(axis=1)
+
+
+def krum(weight_dicts, num_samples=None, num_byzantine=None, num_selected=1):
+    # num_selected=1 is Krum, larger values give Multi-Krum: the mean of the best-scored clients
+    n = len(weight_dicts)
+    if num_byzantine is None:
+        num_byzantine = max(0, (n - 3) // 2)
+    if n - num_byzantine - 2 < 1:
+        raise ValueError(f"Krum needs more than 2f + 2 clients, got n={n} and f={num_byzantine}")
+    scores = krum_scores(weight_dicts, num_byzantine)
+    selected = np.argsort(scores, kind='stable')[:max(1, min(num_selected, n))]
+    return fedavg(weight_dicts[i] for i in selected)
+
+
+def multi_krum(weight_dicts, num_samples=None, num_byzantine=None, num_selected=None):
+    n = len(weight_dicts)
+    if num_byzantine is None:
+        num_byzantine = max(0, (n - 3) // 2)
+    if num_selected is None:
+        num_selected = n - num_byzantine
+    return krum(weight_dicts, num_samples, num_byzantine, num_selected)
+
+
+# Aggregation rules selectable per round. Each takes the list of client weight dicts, their sample
+# counts (only FedAvg uses them) and rule-specific keyword parameters.
+AGGREGATORS = {
+    "fedavg": weighted_fedavg,
+    "median": coordinate_median,
+    "trimmed_mean": trimmed_mean,
+    "krum": krum,
+    "multi_krum": multi_krum,
+}
+
+
+def aggregate(rule, weight_dicts, num_samples=None, **params):
+    if rule not in AGGREGATORS:
+        raise ValueError(f"Unknown aggregation rule '{rule}', expected one of {sorted(AGGREGATORS)}")
+    if not weight_dicts:
+        raise ValueError("No client weights to aggregate")
+    return AGGREGATORS[rule](list(weight_dicts), num_samples, **params)
+
+
+class FedAvgAccumulator:
+    # Running per-layer sums of sample-weighted client parameters, updated as uploads arrive so
+    # that averaging is a single division regardless of how many clients contributed. The sums are
+    # exact, so subtracting a superseded contribution leaves no trace of it.
+    # Contributions may be registered by reference (e.g. a path); reload(ref) must then return
+    # the same weights again so a superseded contribution can be subtracted without keeping it resident.
+    def __init__(self, reload=None):
+        self.reload = reload
+        self.lock = threading.Lock()
+        self.partial = PartialAggregate()
+        self.contributions = {}
+
+    def _fold(self, weights, num_samples):
+        self.partial.add(weights, num_samples)
+
+    @property
+    def total_samples(self):
+        return self.partial.total_samples
+
+    def _retained_weights(self, client_id):
+        retained, by_reference, num_samples = self.contributions[client_id]
+        return (self.reload(retained) if by_reference else retained), num_samples
+
+    def add(self, client_id, weights, num_samples=1, ref=None):
+        # Checked before the previous contribution is subtracted, so a rejected add changes nothing
+        if not 0 < num_samples <= MAX_SAMPLE_COUNT:
+            raise ValueError(f"num_samples must be between 1 and {MAX_SAMPLE_COUNT}, got {num_samples}")
+        with self.lock:
+            if client_id in self.contributions:
+                previous, previous_samples = self._retained_weights(client_id)
+                self._fold(previous, -previous_samples)
+            self._fold(weights, num_samples)
+            if ref is not None:
+                self.contributions[client_id] = (ref, True, num_samples)
+            else:
+                self.contributions[client_id] = (weights, False, num_samples)
+
+    def remove(self, client_id):
+        with self.lock:
+            if client_id not in self.contributions:
+                return False
+            previous, previous_samples = self._retained_weights(client_id)
+            self._fold(previous, -previous_samples)
+            del self.contributions[client_id]
+            if not self.contributions:
+                self.partial = PartialAggregate()
+            return True
+
+    def reset(self):
+        with self.lock:
+            self.partial = PartialAggregate()
+            self.contributions = {}
+
+    def snapshot(self):
+        # A copy of the current sums, e.g. to push to a root aggregator, that later uploads do not change
+        with self.lock:
+            partial = self.partial.copy()
+            partial.clients = sorted(self.contributions)
+        return partial
+
+    def client_weights(self):
+        # Every current contribution as (client_id, weights, num_samples), for rules that need them all
+        with self.lock:
+            contributions = list(self.contributions.items())
+        return [
+            (client_id, self.reload(retained) if by_reference else retained, num_samples)
+            for client_id, (retained, by_reference, num_samples) in contributions
+        ]
+
+    @property
+    def num_clients(self):
+        return len(self.contributions)
+
+    def average(self):
+        with self.lock:
+            if not self.contributions:
+                raise ValueError("No client contributions to average")
+            return self.partial.average()
+
+
+class SparseRowAccumulator:
+    # Sample-weighted sums of sparse row deltas (e.g. embedding rows), with the total weight and
+    # the number of contributors kept per row. Rows live in slots allocated on first touch, so memory
+    # follows the number of distinct rows clients touched, not the size of the table. A client's
+    # newer update replaces its previous one until drain() hands the round's averages over and
+    # starts the next round empty; restore() puts them back if that round fails.
+    def __init__(self, row_size, initial_capacity=1024):
+        self.row_size = row_size
+        self.lock = threading.Lock()
+        self._reset(initial_capacity)
+
+    def _reset(self, capacity):
+        self.slots = {}
+        self.rows = np.empty(capacity, dtype=np.int64)
+        self.sums = np.zeros((capacity, self.row_size), dtype=np.float64)
+        self.weights = np.zeros(capacity, dtype=np.float64)
+        self.contributors = np.zeros(capacity, dtype=np.int64)
+        self.contributions = {}
+
+    def _slots_for(self, rows):
+        missing = [row for row in rows.tolist() if row not in self.slots]
+        needed = len(self.slots) + len(missing)
+        if needed > len(self.rows):
+            capacity = max(needed, 2 * len(self.rows))
+            self.rows = np.resize(self.rows, capacity)
+            for name in ("sums", "weights", "contributors"):
+                grown = np.zeros((capacity,) + getattr(self, name).shape[1:], dtype=getattr(self, name).dtype)
+                grown[:len(self.slots)] = getattr(self, name)[:len(self.slots)]
+                setattr(self, name, grown)
+        for row in missing:
+            self.rows[len(self.slots)] = row
+            self.slots[row] = len(self.slots)
+        return np.fromiter((self.slots[row] for row in rows.tolist()), dtype=np.int64, count=len(rows))
+
+    def _fold(self, rows, deltas, num_samples, sign):
+        slots = self._slots_for(rows)
+        self.sums[slots] += sign * np.multiply(deltas, num_samples, dtype=np.float64)
+        self.weights[slots] += sign * num_samples
+        self.contributors[slots] += sign
+
+    def add(self, client_id, rows, deltas, num_samples=1):
+        rows = np.asarray(rows, dtype=np.int64)
+        deltas = np.asarray(deltas)
+        if num_samples <= 0:
+            raise ValueError(f"num_samples must be positive, got {num_samples}")
+        if deltas.shape != (len(rows), self.row_size):
+            raise ValueError(f"Expected ({len(rows)}, {self.row_size}) row deltas, got {deltas.shape}")
+        if len(np.unique(rows)) != len(rows):
+            raise ValueError("Row indices must be unique")
+        with self.lock:
+            if client_id in self.contributions:
+                self._fold(*self.contributions[client_id], -1)
+            self._fold(rows, deltas, num_samples, 1)
+            self.contributions[client_id] = (rows, deltas, num_samples)
+
+    @property
+    def num_clients(self):
+        return len(self.contributions)
+
+    def drain(self):
+        # (rows, mean deltas, contributors per row) of every row still touched and the drained client
+        # contributions, for restore(); the next round starts fresh
+        with self.lock:
+            used = len(self.slots)
+            touched = self.contributors[:used] > 0
+            rows = self.rows[:used][touched]
+            means = self.sums[:used][touched] / self.weights[:used][touched, None]
+            contributors = self.contributors[:used][touched]
+            contributions = self.contributions
+            self._reset(max(1024, used))
+        order = np.argsort(rows)
+        return rows[order], means[order], contributors[order], contributions
+
+    def restore(self, contributions):
+        # Puts drained contributions back, except those of clients that sent a newer update since
+        with self.lock:
+            for client_id, (rows, deltas, num_samples) in contributions.items():
+                if client_id not in self.contributions:
+                    self._fold(rows, deltas, num_samples, 1)
+                    self.contributions[client_id] = (rows, deltas, num_samples)
@@ -1,447 +1,1121 @@
-from flask import Flask, request, send_file, make_response, Response
-import os
-import zipfile
-from datetime import datetime
-import coremltools as ct
-import numpy as np
-import struct
-import tensorflow as tf
-import tensorflow_datasets as tfds
-from sklearn.metrics import accuracy_score, f1_score, precision_score, recall_score
-import random
-import gzip
-import json
-from io import BytesIO
-import glob
-import shutil
-import csv
-
-# Constants
-VOCAB_SIZE = 10000
-MAX_LEN = 100
-EMBED_DIM = 128
-BATCH_SIZE = 32
-EPOCHS = 10
-
-# Load IMDb
-(train_data, val_data, test_data), info = tfds.load(
-    'imdb_reviews',
-    split=['train[:80%]', 'train[80%:]', 'test'],
-    as_supervised=True,
-    with_info=True
-)
-
-# Prepare raw texts
-train_texts = [x.numpy().decode("utf-8") for x, _ in train_data]
-train_labels = [int(y.numpy()) for _, y in train_data]
-val_texts = [x.numpy().decode("utf-8") for x, _ in val_data]
-val_labels = [int(y.numpy()) for _, y in val_data]
-test_texts = [x.numpy().decode("utf-8") for x, _ in test_data]
-test_labels = [int(y.numpy()) for _, y in test_data]
-
-# Get random subset of test data
-subset_size = 2500
-indices = random.sample(range(len(test_texts)), subset_size)
-test_texts = [test_texts[i] for i in indices]
-test_labels = [test_labels[i] for i in indices]
-
-# Tokenizer
-tokenizer = tf.keras.preprocessing.text.Tokenizer(num_words=VOCAB_SIZE)
-tokenizer.fit_on_texts(train_texts)
-train_sequences = tokenizer.texts_to_sequences(train_texts)
-train_padded = tf.keras.preprocessing.sequence.pad_sequences(train_sequences, maxlen=MAX_LEN)
-val_sequences = tokenizer.texts_to_sequences(val_texts)
-val_padded = tf.keras.preprocessing.sequence.pad_sequences(val_sequences, maxlen=MAX_LEN)
-test_sequences = tokenizer.texts_to_sequences(test_texts)
-test_padded = tf.keras.preprocessing.sequence.pad_sequences(test_sequences, maxlen=MAX_LEN)
-
-# Convert to NumPy arrays
-train_inputs = np.array(train_padded)
-train_labels = np.array(train_labels)
-val_inputs = np.array(val_padded)
-val_labels = np.array(val_labels)
-test_inputs = np.array(test_padded)
-test_labels = np.array(test_labels)
-
-def create_pretrained_model():
-    # Updatable-friendly model
-    model = tf.keras.Sequential([
-        tf.keras.layers.Embedding(VOCAB_SIZE, EMBED_DIM, input_length=MAX_LEN, name="embedding"),
-        tf.keras.layers.Flatten(name="flatten"),
-        tf.keras.layers.Dense(64, activation='relu', name="dense1"),
-        tf.keras.layers.Dense(2, activation='softmax', name="output")
-    ])
-
-    model.compile(loss='sparse_categorical_crossentropy', optimizer='adam', metrics=['accuracy'])
-    model.summary()
-
-    # Pretraining
-    model.fit(train_inputs, train_labels, batch_size=BATCH_SIZE, epochs=EPOCHS, validation_data=(val_inputs, val_labels))
-
-    # Save the model
-    model.save("imdb_model.keras")
-    print("✅ Pretrained model saved as imdb_model.keras")
-
-    # Save tokenizer
-    with open("tokenizer.json", "w") as f:
-        json.dump({"word_index": tokenizer.word_index}, f)
-
-    print("✅ Tokenizer saved.")
-
-
-def convert_to_coreml():
-    # Load the model
-    model = tf.keras.models.load_model("imdb_model.keras")
-
-    model.build(input_shape=(None, MAX_LEN))
-    _ = model.get_weights()
-
-    # # Set input type
-    input_type = ct.TensorType(shape=(1, MAX_LEN), dtype=np.int32)
-
-    # Convert to CoreML Neural Network
-    mlmodel = ct.convert(
-        model,
-        convert_to="neuralnetwork",
-        inputs=[input_type],
-        compute_units=ct.ComputeUnit.ALL
-    )
-
-    # Enable updatable model
-    old_spec = mlmodel.get_spec()
-    old_spec.description.metadata.shortDescription = "Updatable IMDB sentiment classifier"
-    old_spec.description.metadata.author = "Your Name"
-    old_spec.isUpdatable = True
-
-    old_nn = old_spec.neuralNetwork
-    # Delete the last layer (softmaxND) as it is incompatible with updatable models
-    del old_nn.layers[-1] 
-    second_to_last_index = len(old_nn.layers) - 1
-
-    old_spec.neuralNetwork.layers[second_to_last_index].output[0] = "output_r"
-
-    ct.utils.save_spec(old_spec, "imdb_model.mlmodel")
-    spec = ct.utils.load_spec("imdb_model.mlmodel")
-
-    # Add the last layer again as a softmax layer (not softmaxND) 
-    softmax_layer = spec.neuralNetwork.layers.add()
-    softmax_layer.name = "softmax"
-    softmax_layer.softmax.MergeFromString(b"")
-    softmax_layer.input.append("output_r")
-    softmax_layer.output.append("Identity")
-
-    ct.utils.save_spec(spec, "imdb_model.mlmodel")
-
-    builder = ct.models.neural_network.NeuralNetworkBuilder(spec=spec)
-    # Mark updatable layers
-    builder.make_updatable([
-        "sequential/output/BiasAdd",
-        "sequential/dense1/BiasAdd"
-    ])
-
-    # Set up the model for training
-    builder.set_categorical_cross_entropy_loss(name="lossLayer", input='Identity')
-    builder.set_adam_optimizer(ct.models.neural_network.AdamParams(lr=0.01, batch=32))
-    builder.set_epochs(10)
-
-    model_spec = builder.spec
-    model_spec.description.metadata.shortDescription = "Updatable IMDB sentiment classifier"
-    model_spec.description.metadata.author = "Your Name"
-    model_spec.isUpdatable = True
-
-    mlmodel = ct.models.MLModel(model_spec)
-
-    mlmodel.save("imdb_updatable_model.mlpackage")
-
-def get_centralized_keras_model_score():
-    model = tf.keras.models.load_model("imdb_model.keras")
-
-    # Fine tuning
-    model.compile(loss='sparse_categorical_crossentropy', optimizer='adam', metrics=['accuracy'])
-    model.fit(val_inputs, val_labels, batch_size=BATCH_SIZE, epochs=EPOCHS)
-
-    # Predict
-    pred_probs = model.predict(test_inputs)
-    pred_labels = np.argmax(pred_probs, axis=1)
-
-    # Accuracy and other metrics
-    acc = accuracy_score(test_labels, pred_labels)
-    precision = precision_score(test_labels, pred_labels, average='weighted')
-    recall = recall_score(test_labels, pred_labels, average='weighted')
-    f1 = f1_score(test_labels, pred_labels, average='weighted')
-
-    print(f"Fine-tuned Accuracy: {acc:.4f}")
-    print(f"Fine-tuned Precision: {precision:.4f}")
-    print(f"Fine-tuned Recall: {recall:.4f}")
-    print(f"Fine-tuned F1 Score: {f1:.4f}")
-
-    # CSV Logging
-    log_file = "centralized_model_metrics.csv"
-    write_header = not os.path.exists(log_file)
-
-    with open(log_file, mode="a", newline="") as file:
-        writer = csv.writer(file)
-        if write_header:
-            writer.writerow(["model_type", "accuracy", "precision", "recall", "f1_score"])
-        writer.writerow(["centralized", acc, precision, recall, f1])
-
-    return acc, precision, recall, f1
-
-create_pretrained_model()
-convert_to_coreml()
-
-def read_compiled_weights(mlmodelc_path):
-    layer_bytes = []
-    layer_data = {}
-    weights = {}
-    filename = os.path.join(mlmodelc_path, 'model.espresso.weights')
-    with open(filename, 'rb') as f:
-        num_layers = struct.unpack('<i', f.read(4))[0]
-
-        f.read(4)
-
-        # Read the number of layers and their sizes
-        while len(layer_bytes) < num_layers:
-            layer_num, _, num_bytes, _ = struct.unpack('<iiii', f.read(16))
-            layer_bytes.append((layer_num, num_bytes))
-
-        # Read the layer data
-        for layer_num, num_bytes in layer_bytes:
-            data = struct.unpack('f' * (num_bytes // 4), f.read(num_bytes))
-            layer_data[layer_num] = data
-        
-        weights['sequential/dense1/BiasAdd'] = {
-            "weights": np.array(layer_data[5]),
-            "bias": np.array(layer_data[3])
-        }
-        weights['sequential/output/BiasAdd'] = {
-            "weights": np.array(layer_data[9]),
-            "bias": np.array(layer_data[7])
-        }
-        return weights
-
-def fedavg(weight_dicts):
-    avg = {}
-    n = len(weight_dicts)
-    all_keys = weight_dicts[0].keys()
-
-    # Iterate through each layer's weights and biases
-    for key in all_keys:
-        w_stack = np.stack([w[key]["weights"] for w in weight_dicts])
-        b_stack = np.stack([w[key]["bias"] for w in weight_dicts])
-
-        # Calculate the average weights and biases
-        avg[key] = {
-            "weights": np.mean(w_stack, axis=0),
-            "bias": np.mean(b_stack, axis=0)
-        }
-    return avg
-
-def set_weights_in_model(base_model_path, avg_weights, output_model_path):
-    # Load the base model from .mlpackage
-    model = ct.models.MLModel(base_model_path)
-    spec = model.get_spec()
-
-    # Update weights in the model specification
-    for layer in spec.neuralNetwork.layers:
-        if layer.name in avg_weights:
-            print(np.array(layer.innerProduct.weights.floatValue)[0])
-            layer.innerProduct.weights.floatValue[:] = avg_weights[layer.name]["weights"].flatten().tolist()
-            layer.innerProduct.bias.floatValue[:] = avg_weights[layer.name]["bias"].flatten().tolist()
-
-    # Save the updated model
-    ct.models.MLModel(spec).save(output_model_path)
-    print(f"✅ Aggregated model saved to: {output_model_path}")
-
-app = Flask(__name__)
-
-UPLOAD_FOLDER = './uploads'
-MODEL_FOLDER = './models'
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-os.makedirs(MODEL_FOLDER, exist_ok=True)
-
-@app.route('/upload', methods=['POST'])
-def upload_model():
-    if 'model' not in request.files:
-        return 'No model file part', 400
-
-    file = request.files['model']
-    if file.filename == '':
-        return 'No selected file', 400
-
-    client_id = request.remote_addr.replace('.', '_') 
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    # if same client id, different timestamp, delete old model
-    for old_file in glob.glob(os.path.join(UPLOAD_FOLDER, f"{client_id}_*.zip")):
-        try:
-            os.remove(old_file)
-            print(f"❌ Deleted old model: {old_file}")
-        except Exception as e:
-            print(f"⚠️ Failed to delete {old_file}: {e}")
-    zip_filename = f"{client_id}_{timestamp}.zip"
-    zip_path = os.path.join(UPLOAD_FOLDER, zip_filename)
-
-    file.save(zip_path)
-    print(f"✅ Received model and saved to {zip_path}")
-
-    for old_folder in glob.glob(os.path.join(MODEL_FOLDER, f"{client_id}_*")):
-        try:
-            shutil.rmtree(old_folder)
-            print(f"❌ Deleted old extracted model: {old_folder}")
-        except Exception as e:
-            print(f"⚠️ Failed to delete {old_folder}: {e}")
-
-    extract_dir = os.path.join(MODEL_FOLDER, f"{client_id}_{timestamp}")
-    os.makedirs(extract_dir, exist_ok=True)
-
-    try:
-        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            zip_ref.extractall(extract_dir)
-        print(f"✅ Unzipped to {extract_dir}")
-        return 'Model uploaded and unzipped successfully', 200
-    except Exception as e:
-        print(f"❌ Failed to unzip: {e}")
-        return f"Unzipping failed: {str(e)}", 500
-
-@app.route('/aggregate', methods=['POST'])
-def aggregate_models():
-    base_model_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server', 'imdb_updatable_model.mlpackage', 'Data', 'com.apple.CoreML', 'model.mlmodel')
-    output_model_path = './aggregated_model.mlmodel'
-
-    # Find all extracted model folders
-    model_dirs = [os.path.join(MODEL_FOLDER, d) for d in os.listdir(MODEL_FOLDER)
-                  if os.path.isdir(os.path.join(MODEL_FOLDER, d))]
-
-    model_paths = []
-    for d in model_dirs:
-        for fname in os.listdir(d):
-            if fname.endswith('.mlmodelc'):
-                model_paths.append(os.path.join(d, fname))
-
-    if len(model_paths) < 1:
-        return 'Need at least 1 model to aggregate', 400
-
-    # Extract weights from each model
-    all_weights = [read_compiled_weights(model_path) for model_path in model_paths]
-    avg_weights = fedavg(all_weights)
-
-    # Set weights in the base model and save the aggregated model
-    set_weights_in_model(base_model_path, avg_weights, output_model_path)
-
-    model_version = datetime.now().strftime('%Y%m%d_%H%M%S')  # Use timestamp as the version
-    model_version_file = './model_version.txt'
-    
-    with open(model_version_file, 'w') as f:
-        f.write(model_version)
-    
-    print(f"✅ Aggregated model version: {model_version}")
-
-    return f"✅ Aggregated {len(model_paths)} models into {output_model_path}", 200
-
-@app.route('/download', methods=['GET'])
-def download_aggregated_model():
-    output_model_path = './aggregated_model.mlmodel'
-    if not os.path.exists(output_model_path):
-        return 'Aggregated model not found', 404
-    
-    model_version_file = './model_version.txt'
-    if os.path.exists(model_version_file):
-        with open(model_version_file, 'r') as f:
-            model_version = f.read().strip()
-    else:
-        model_version = 'v1.0.0'
-
-    print(f"✅ Model Version: {model_version}")
-    
-    response = make_response(send_file(output_model_path, as_attachment=True))
-    response.headers['Model-Version'] = model_version
-    return response
-
-@app.route('/metrics', methods=['POST'])
-def receive_metrics():
-    data = request.get_json()
-    
-    accuracy = data.get('accuracy', None)
-    loss = data.get('loss', None)
-    model_version = data.get('model_version', None)
-    
-    if not accuracy or not loss or not model_version:
-        return 'Missing required data (accuracy, loss, or model_version)', 400
-    
-    print(f"Received metrics - Model Version: {model_version}, Accuracy: {accuracy}, Loss: {loss}")
-    
-    metrics_log = './metrics_log.txt'
-    with open(metrics_log, 'a') as f:
-        f.write(f"{datetime.now()} - Model Version: {model_version}, Accuracy: {accuracy}, Loss: {loss}\n")
-    
-    return 'Metrics received successfully', 200
-
-@app.route('/get_train_data', methods=['GET'])
-def get_train_data():
-    subset_size = 50
-    # Get a random subset of training data
-    indices = random.sample(range(len(val_texts)), subset_size)
-    samples = [{"text": val_texts[i], "label": int(val_labels[i])} for i in indices]
-    return {"data": samples}, 200
-
-@app.route('/get_test_data', methods=['GET'])
-def get_test_data():
-    samples = [{"text": text, "label": int(label)} for text, label in zip(test_texts, test_labels)]
-    return {"data": samples}, 200
-
-@app.route('/get_test_data_gzip', methods=['GET'])
-def get_test_data_gzip():
-    samples = [{"text": text, "label": int(label)} for text, label in zip(test_texts, test_labels)]
-    buffer = BytesIO()
-    with gzip.GzipFile(fileobj=buffer, mode="w") as f:
-        f.write(json.dumps({"data": samples}).encode('utf-8'))
-    buffer.seek(0)
-    return Response(buffer, mimetype='application/gzip', headers={'Content-Encoding': 'gzip'})
-
-@app.route('/report_metrics', methods=['POST'])
-def report_metrics():
-    data = request.get_json()
-
-    required_fields = [
-        'client_id', 'round', 'accuracy', 'precision', 'recall', 'f1_score', 
-        'log_loss', 'confusion_matrix', 'evaluation_time_ms', 'prediction_confidence', 
-        'per_class_precision', 'per_class_recall'
-    ]
-    
-    if not all(field in data for field in required_fields):
-        return 'Missing one or more required fields', 400
-
-    log_file = 'federated_metrics_log.csv'
-    file_exists = os.path.isfile(log_file)
-
-    try:
-        with open(log_file, mode='a', newline='') as file:
-            writer = csv.DictWriter(file, fieldnames=required_fields)
-
-            if not file_exists:
-                writer.writeheader()
-
-            writer.writerow({
-                'client_id': data['client_id'],
-                'round': data['round'],
-                'accuracy': data['accuracy'],
-                'precision': data['precision'],
-                'recall': data['recall'],
-                'f1_score': data['f1_score'],
-                'log_loss': data['log_loss'],
-                'confusion_matrix': data['confusion_matrix'],
-                'evaluation_time_ms': data['evaluation_time_ms'],
-                'prediction_confidence': data['prediction_confidence'],
-                'per_class_precision': data['per_class_precision'],
-                'per_class_recall': data['per_class_recall'],
-            })
-
-        print(f"✅ Logged metrics for client '{data['client_id']}' at round {data['round']}")
-        return 'Metrics logged successfully', 200
-
-    except Exception as e:
-        print(f"❌ Failed to log metrics: {e}")
-        return f"Logging failed: {e}", 500
-    
-if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000)
+from flask import Flask, Request, request, make_response, g
+import os
+import zipfile
+from datetime import datetime
+import coremltools as ct
+import numpy as np
+import tensorflow as tf
+from sklearn.metrics import accuracy_score, f1_score, precision_score, recall_score
+import random
+import json
+import glob
+import shutil
+import csv
+import threading
+import tempfile
+import uuid
+import time
+import socket
+import urllib.error
+import urllib.request
+from functools import lru_cache
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from espresso import EspressoWeights
+from model_writer import ModelTemplate, embedding_shape, find_embedding_layer, layer_fields
+from model_store import ModelStore
+from metrics_store import MetricsSink
+from client_registry import ClientRegistry, valid_client_id
+from instrumentation import RoundProfiler, Stats
+from evaluator import NumpyEvaluator
+from aggregation import (AGGREGATORS, MAX_SAMPLE_COUNT, FedAvgAccumulator, SparseRowAccumulator, aggregate,
+                         non_finite_tensors)
+from payloads import EncodedPayload, serve_payload
+from rounds import RoundCoordinator
+from ingest import UploadIngestor
+from resumable import ResumableUploads, missing_ranges
+from wire import (decode_embedding_update, decode_layer_patch, decode_partial, decode_update, encode_layer_patch,
+                  encode_partial, encode_shard, token_dtype)
+# Data, tokenizer and pretrained model, from the artifact cache
+from dataset import (BATCH_SIZE, EPOCHS, KERAS_MODEL_PATH, MAX_LEN, UPDATABLE_LAYERS, UPDATABLE_MODEL_PATH, VOCAB_SIZE,
+                     artifact_cache, cache_hit, test_inputs, test_labels, text_stores, val_inputs, val_labels)
+
+# Configuration; the FL_* environment variables override the defaults
+UPLOAD_FOLDER = './uploads'
+MODEL_FOLDER = './models'
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Each client's latest upload, journaled so it survives a restart
+CLIENT_JOURNAL_PATH = os.environ.get('FL_CLIENT_JOURNAL', './clients.jsonl')
+
+# Every aggregated model is kept under its content hash; the most recent ones are served from memory
+MODEL_STORE_DIR = os.environ.get('FL_MODEL_STORE_DIR', './model_store')
+MODEL_CACHE_SIZE = int(os.environ.get('FL_MODEL_CACHE_SIZE', 4))
+# The single mutable model file of earlier server versions, adopted as the first stored version
+LEGACY_MODEL_PATH = './aggregated_model.mlmodel'
+
+# Metric reports are buffered and written to SQLite in batches, flattened into typed columns
+METRICS_DB_PATH = os.environ.get('FL_METRICS_DB', './metrics.db')
+
+# Every aggregated version is evaluated on the test subset in the background unless FL_EVALUATE=0
+EVALUATE_VERSIONS = os.environ.get('FL_EVALUATE', '1') != '0'
+
+# Hierarchical deployment. Edge servers (FL_ROLE=edge) ingest the uploads of their own clients and end
+# each of their rounds by pushing exact FedAvg partial sums to the root at FL_ROOT_URL. The root
+# (FL_ROLE=root) merges the latest partial of every edge with any uploads it received itself, publishes
+# the global model, and edges mirror it for /download. Clients must each upload to a single edge.
+SERVER_ROLE = os.environ.get('FL_ROLE', 'standalone')
+if SERVER_ROLE not in ('standalone', 'edge', 'root'):
+    raise ValueError(f"FL_ROLE must be standalone, edge or root, got '{SERVER_ROLE}'")
+ROOT_URL = os.environ.get('FL_ROOT_URL', '').rstrip('/')
+if SERVER_ROLE == 'edge' and not ROOT_URL:
+    raise ValueError("FL_ROLE=edge needs FL_ROOT_URL")
+SERVER_PORT = int(os.environ.get('FL_PORT', 5000))
+EDGE_ID = os.environ.get('FL_EDGE_ID', f"{socket.gethostname()}:{SERVER_PORT}")
+PARTIAL_MIMETYPE = 'application/x-fslm-partial'
+ROOT_TIMEOUT_SECONDS = 120
+
+# /aggregate?rule=... overrides the default rule for the round that request starts, and is refused
+# when it starts none; the coordinator hands the (rule, params) override to that round only
+DEFAULT_AGGREGATION_RULE = os.environ.get('FL_AGGREGATION_RULE', 'fedavg')
+RULE_PARAMS = {"trim_ratio": float, "num_byzantine": int, "num_selected": int}
+
+# Aggregate once a quorum of uploads arrives or the round deadline passes, never concurrently
+ROUND_QUORUM = int(os.environ.get('FL_ROUND_QUORUM', 1))
+ROUND_DEADLINE = float(os.environ.get('FL_ROUND_DEADLINE', 0))
+AGGREGATE_WAIT_SECONDS = 60
+
+# Every aggregated model shares the frozen layers of the pretrained base, so the base is identified by
+# the artifact fingerprint and only the updatable layers need to travel between versions
+BASE_VERSION = artifact_cache.fingerprint
+PATCH_PATH = './aggregated_patch.bin'
+PATCH_MIMETYPE = 'application/x-fslm-patch'
+
+# Updatable-layer weights are kept for the pretrained base and this many recent aggregated versions,
+# which clients may compute compressed deltas against
+MAX_DELTA_BASES = 4
+
+# Pre-tokenized shards of the same pools /get_train_data and /get_test_data draw from, so clients
+# can skip downloading review text and tokenizing it on device
+SHARD_SIZE = 50
+SHARD_DTYPE = token_dtype(VOCAB_SIZE)
+
+def get_centralized_keras_model_score():
+    model = tf.keras.models.load_model(KERAS_MODEL_PATH)
+
+    # Fine tuning
+    model.compile(loss='sparse_categorical_crossentropy', optimizer='adam', metrics=['accuracy'])
+    model.fit(val_inputs, val_labels, batch_size=BATCH_SIZE, epochs=EPOCHS)
+
+    # Predict
+    pred_probs = model.predict(test_inputs)
+    pred_labels = np.argmax(pred_probs, axis=1)
+
+    # Accuracy and other metrics
+    acc = accuracy_score(test_labels, pred_labels)
+    precision = precision_score(test_labels, pred_labels, average='weighted')
+    recall = recall_score(test_labels, pred_labels, average='weighted')
+    f1 = f1_score(test_labels, pred_labels, average='weighted')
+
+    print(f"Fine-tuned Accuracy: {acc:.4f}")
+    print(f"Fine-tuned Precision: {precision:.4f}")
+    print(f"Fine-tuned Recall: {recall:.4f}")
+    print(f"Fine-tuned F1 Score: {f1:.4f}")
+
+    # CSV Logging
+    log_file = "centralized_model_metrics.csv"
+    write_header = not os.path.exists(log_file)
+
+    with open(log_file, mode="a", newline="") as file:
+        writer = csv.writer(file)
+        if write_header:
+            writer.writerow(["model_type", "accuracy", "precision", "recall", "f1_score"])
+        writer.writerow(["centralized", acc, precision, recall, f1])
+
+    return acc, precision, recall, f1
+
+
+# Keep the copies bundled into the iOS app next to the server in sync with the cache
+for name in ["tokenizer.json", "imdb_updatable_model.mlpackage"]:
+    if not cache_hit or not os.path.exists(name):
+        artifact_cache.publish(name, name)
+
+def read_compiled_weights(mlmodelc_path):
+    # Zero-copy float32 views into the memory-mapped weights file, keyed by layer name
+    compiled = EspressoWeights(mlmodelc_path)
+    return {name: compiled.layer(name) for name in UPDATABLE_LAYERS}
+
+@lru_cache(maxsize=None)
+def get_model_template(base_model_path):
+    # Parsed and serialized once; each round only overwrites the updatable layers' float bytes, plus
+    # the embedding once federated rows have changed it
+    return ModelTemplate(base_model_path, UPDATABLE_LAYERS + [EMBEDDING_LAYER])
+
+@lru_cache(maxsize=None)
+def get_evaluator(base_model_path):
+    return NumpyEvaluator(base_model_path, UPDATABLE_LAYERS)
+
+def find_compiled_model(model_dir):
+    for fname in os.listdir(model_dir):
+        if fname.endswith('.mlmodelc'):
+            return os.path.join(model_dir, fname)
+    return None
+
+def write_update_weights(path, weights):
+    # The weights a compressed update reconstructs, kept on disk like an uploaded model so they can be
+    # subtracted again and survive a restart
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, **{f"{layer}:{kind}": values for layer, params in weights.items() for kind, values in params.items()})
+    os.replace(path + '.tmp', path)
+
+def read_client_weights(model_path):
+    # A client's contribution on disk: an uploaded .mlmodelc, or the .npz written for a compressed update
+    if not model_path.endswith('.npz'):
+        return read_compiled_weights(model_path)
+    weights = {}
+    with np.load(model_path) as saved:
+        for key in saved.files:
+            layer, kind = key.rsplit(':', 1)
+            weights.setdefault(layer, {})[kind] = saved[key]
+    return weights
+
+def remove_client_artifacts(entry):
+    # Files of an upload that a newer one from the same client has replaced
+    if entry.get("upload") and os.path.exists(entry["upload"]):
+        try:
+            os.remove(entry["upload"])
+            print(f"❌ Deleted old model: {entry['upload']}")
+        except Exception as e:
+            print(f"⚠️ Failed to delete {entry['upload']}: {e}")
+    if entry.get("model_dir") and os.path.isdir(entry["model_dir"]):
+        try:
+            shutil.rmtree(entry["model_dir"])
+            print(f"❌ Deleted old extracted model: {entry['model_dir']}")
+        except Exception as e:
+            print(f"⚠️ Failed to delete {entry['model_dir']}: {e}")
+
+def read_spec_embedding(spec):
+    # The embedding table as (embedding size, vocab size), the layout CoreML stores it in
+    layer = find_embedding_layer(spec)
+    values = np.array(dict(layer_fields(layer))["weights"].floatValue, dtype=np.float32)
+    return layer.name, values.reshape(embedding_shape(layer))
+
+def read_spec_layers(spec):
+    return {
+        layer.name: {
+            "weights": np.array(layer.innerProduct.weights.floatValue, dtype=np.float32),
+            "bias": np.array(layer.innerProduct.bias.floatValue, dtype=np.float32)
+        }
+        for layer in spec.neuralNetwork.layers if layer.name in UPDATABLE_LAYERS
+    }
+
+def read_spec_weights(model_path):
+    return read_spec_layers(ct.utils.load_spec(model_path))
+
+def embedding_row_layers(embedding):
+    # The vocabulary ids whose embedding differs from the base, with their current values, in the
+    # row_layers form of a layer patch; empty while the embedding is still the base one
+    rows = np.flatnonzero(np.any(embedding != base_embedding, axis=0))
+    if not len(rows):
+        return {}
+    return {EMBEDDING_LAYER: (rows, np.ascontiguousarray(embedding[:, rows].T))}
+
+def read_version(model_path):
+    # Updatable layers and changed embedding rows of a stored model, as its patch carries them
+    spec = ct.utils.load_spec(model_path)
+    return read_spec_layers(spec), embedding_row_layers(read_spec_embedding(spec)[1])
+
+# Server state, restored from disk at startup
+os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+os.makedirs(MODEL_FOLDER, exist_ok=True)
+
+# Multipart file parts are streamed straight into UPLOAD_FOLDER instead of an anonymous spool, so
+# accepting an upload is a rename rather than another copy
+class StreamingRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.NamedTemporaryFile(dir=UPLOAD_FOLDER, suffix='.part', delete=False)
+
+app = Flask(__name__)
+app.request_class = StreamingRequest
+
+# Per-endpoint latency, status and byte counters plus per-phase timings, served at /stats
+stats = Stats()
+stats.describe('request_seconds', 'Time from request start until the handler returned its response')
+stats.describe('requests_total', 'Requests by endpoint and status code')
+stats.describe('request_bytes_in_total', 'Request body bytes by endpoint')
+stats.describe('response_bytes_out_total', 'Response body bytes by endpoint, where the length is known')
+stats.describe('ingest_phase_seconds', 'Time spent in each step of ingesting one upload')
+stats.describe('aggregation_phase_seconds', 'Time spent in each step of one aggregation')
+stats.describe('aggregation_seconds', 'Time of one whole aggregation')
+stats.describe('duplicate_uploads_total', 'Resumable uploads skipped because the client already sent the same bytes')
+
+# FL_PROFILE=N writes a cProfile dump of every N-th aggregation to FL_PROFILE_DIR
+round_profiler = RoundProfiler(int(os.environ.get('FL_PROFILE', 0)), os.environ.get('FL_PROFILE_DIR', './profiles'))
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_stats(response):
+    # Streamed bodies are sent after this runs, so their transfer time is not included
+    endpoint = request.endpoint or 'unmatched'
+    stats.observe('request_seconds', time.perf_counter() - g.request_start, endpoint=endpoint)
+    stats.inc('requests_total', endpoint=endpoint, status=response.status_code)
+    stats.inc('request_bytes_in_total', request.content_length or 0, endpoint=endpoint)
+    stats.inc('response_bytes_out_total', response.content_length or 0, endpoint=endpoint)
+    return response
+
+# Leftovers of requests that died mid-transfer
+for stale_part in glob.glob(os.path.join(UPLOAD_FOLDER, '*.part')):
+    os.remove(stale_part)
+
+model_store = ModelStore(MODEL_STORE_DIR, cache_size=MODEL_CACHE_SIZE)
+# Adopt the legacy model file as the first stored version
+if model_store.latest is None and os.path.exists(LEGACY_MODEL_PATH):
+    legacy_version = None
+    if os.path.exists('./model_version.txt'):
+        with open('./model_version.txt') as f:
+            legacy_version = f.read().strip()
+    with open(LEGACY_MODEL_PATH, 'rb') as f:
+        model_store.publish(model_store.put(f.read(), round=None, clients=[], parent=None,
+                                            legacy_version=legacy_version))
+
+metrics_sink = MetricsSink(METRICS_DB_PATH)
+
+# Running FedAvg sums, folded in at upload time. Contributions are kept by path and re-read only when
+# a client's newer upload supersedes them.
+accumulator = FedAvgAccumulator(reload=read_client_weights)
+
+# Each client's latest upload, replayed from the journal
+registry = ClientRegistry(CLIENT_JOURNAL_PATH)
+
+if not registry.existed:
+    # Models extracted before the registry existed are named <client>_<date>_<time>; adopt the newest per client
+    for d in sorted(os.listdir(MODEL_FOLDER)):
+        model_dir = os.path.join(MODEL_FOLDER, d)
+        model_path = find_compiled_model(model_dir) if os.path.isdir(model_dir) else None
+        if model_path is None:
+            continue
+        previous = registry.record(d.rsplit('_', 2)[0], upload=None, model_dir=model_dir, model_path=model_path,
+                                   num_samples=1, round=None)
+        if previous is not None:
+            remove_client_artifacts(previous)
+
+# Rebuild the running sums from the models registered before a restart
+for client_id, entry in registry.items():
+    try:
+        if entry.get("model_path") is None:
+            # Compressed updates journaled before they were written to disk
+            raise ValueError("no model on disk")
+        accumulator.add(client_id, read_client_weights(entry["model_path"]), entry["num_samples"], ref=entry["model_path"])
+    except Exception as e:
+        print(f"⚠️ Dropping the registered model of {client_id}: {e}")
+        registry.remove(client_id)
+        remove_client_artifacts(entry)
+print(f"✅ Restored {accumulator.num_clients} client models into the aggregate")
+
+# Callbacks are looked up on every call, since the handlers they run are defined further down
+ingestor = UploadIngestor(lambda *args: process_upload(*args), lambda payload: discard_upload(payload),
+                          max_workers=int(os.environ.get('FL_INGEST_WORKERS', 4)))
+
+# Resumable alternative to /upload for flaky connections: the client declares the size and sha256 of
+# the zip, sends it as chunks at explicit offsets in any order, and can ask which ranges arrived after
+# a dropped connection. Only data that hashes to the declared sha256 reaches the ingest pool.
+resumable_uploads = ResumableUploads(os.path.join(UPLOAD_FOLDER, 'resumable'),
+                                     max_size=int(os.environ.get('FL_MAX_UPLOAD_BYTES', 1 << 30)),
+                                     ttl_seconds=float(os.environ.get('FL_UPLOAD_SESSION_TTL', 24 * 3600)))
+# Ingest id of each client's latest resumable upload, to recognise a resend while it is still queued
+resumable_ingests = {}
+
+# Round numbers carry on from the stored versions, which server evaluations and the registry refer to
+last_stored_round = max((record.get('round') or 0 for record in model_store.versions()), default=0)
+coordinator = RoundCoordinator(lambda round_number, options: run_aggregation(round_number, options),
+                               quorum=ROUND_QUORUM, deadline=ROUND_DEADLINE, start_round=last_stored_round)
+
+# Guards the swap of the published model version and its patch
+publish_lock = threading.Lock()
+
+# Runs the evaluations of aggregated versions, one at a time off the aggregation thread
+evaluation_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='evaluate')
+
+# Latest partial sums pushed by each edge, merged into every fedavg round of the root
+edge_partials = {}
+edge_partials_lock = threading.Lock()
+
+# Federated embedding rows. Clients send deltas of only the rows they touched to /upload_embedding;
+# each round averages them per row and patches those columns of the global embedding.
+EMBEDDING_LAYER, base_embedding = read_spec_embedding(
+    ct.utils.load_spec(os.path.join(UPDATABLE_MODEL_PATH, 'Data', 'com.apple.CoreML', 'model.mlmodel')))
+global_embedding = base_embedding
+if model_store.latest is not None:
+    global_embedding = read_spec_embedding(ct.utils.load_spec(model_store.path(model_store.latest)))[1]
+embedding_accumulator = SparseRowAccumulator(base_embedding.shape[0])
+
+def load_latest_patch():
+    version = model_store.latest
+    if version is None:
+        return None
+    patch = None
+    if os.path.exists(PATCH_PATH):
+        with open(PATCH_PATH, 'rb') as f:
+            patch = f.read()
+        try:
+            model_version, base_version = decode_layer_patch(patch)[:2]
+        except ValueError:
+            # Written in an older patch format
+            model_version, base_version = None, None
+        if (model_version, base_version) != (version, BASE_VERSION):
+            patch = None
+    if patch is None:
+        # Rebuild the patch of the published version from the stored model
+        weights, row_layers = read_version(model_store.path(version))
+        patch = encode_layer_patch(version, BASE_VERSION, weights, row_layers)
+        with open(PATCH_PATH + '.tmp', 'wb') as f:
+            f.write(patch)
+        os.replace(PATCH_PATH + '.tmp', PATCH_PATH)
+    return version, EncodedPayload(patch, PATCH_MIMETYPE, encodings=('gzip',))
+
+latest_patch = load_latest_patch()
+
+# Updatable-layer weights of the model versions clients may compute compressed deltas against:
+# the pretrained base (whose version is BASE_VERSION) and the most recent aggregated versions
+version_weights = OrderedDict()
+version_weights[BASE_VERSION] = read_spec_weights(os.path.join(UPDATABLE_MODEL_PATH, 'Data', 'com.apple.CoreML', 'model.mlmodel'))
+if latest_patch is not None:
+    version_weights[latest_patch[0]] = decode_layer_patch(latest_patch[1].bodies['identity'])[2]
+
+# The test subset is fixed at startup, so its response body is serialized and compressed once
+test_samples = text_stores["test"].samples(range(len(text_stores["test"])))
+test_data_payload = EncodedPayload(json.dumps({"data": test_samples}).encode('utf-8'), 'application/json')
+del test_samples
+
+# The token arrays /shards serves, by split
+shard_splits = {
+    "train": (val_inputs, val_labels),
+    "test": (test_inputs, test_labels),
+}
+
+# Current sizes of the state above, sampled whenever /stats is rendered
+stats.gauge('round', lambda: coordinator.round)
+stats.gauge('clients_in_aggregate', lambda: accumulator.num_clients)
+stats.gauge('registered_clients', lambda: len(registry))
+stats.gauge('edge_partials', lambda: len(edge_partials))
+stats.gauge('embedding_rows_pending', lambda: len(embedding_accumulator.slots))
+stats.gauge('resumable_uploads_open', lambda: len(resumable_uploads))
+stats.gauge('tracked_uploads', lambda: {(("status", status),): count for status, count in ingestor.counts().items()})
+
+def request_client_id():
+    # Apps identify themselves with a Client-Id header. The remote address is only a fallback for older
+    # apps, since every client behind one NAT shares it. None means the header is not a usable id.
+    client_id = request.headers.get('Client-Id')
+    if client_id is None:
+        return request.remote_addr.replace('.', '_').replace(':', '_')
+    return client_id if valid_client_id(client_id) else None
+
+def process_upload(upload_id, client_id, payload):
+    # Runs on the ingest pool: validate, extract and parse one uploaded zip, then fold it in
+    zip_path, num_samples, sha256 = payload
+    if not zipfile.is_zipfile(zip_path):
+        raise ValueError('Uploaded file is not a zip archive')
+
+    extract_dir = os.path.join(MODEL_FOLDER, f"{client_id}_{upload_id}")
+    os.makedirs(extract_dir, exist_ok=True)
+
+    try:
+        with stats.timer('ingest_phase_seconds', phase='extract'), zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            zip_ref.extractall(extract_dir)
+        print(f"✅ Unzipped to {extract_dir}")
+
+        model_path = find_compiled_model(extract_dir)
+        if model_path is None:
+            raise ValueError('No .mlmodelc found in uploaded archive')
+
+        # Replaces this client's previous contribution, which is still on disk to be subtracted
+        with stats.timer('ingest_phase_seconds', phase='read_weights'):
+            weights = read_compiled_weights(model_path)
+        non_finite = non_finite_tensors(weights)
+        if non_finite:
+            raise ValueError(f"Model has NaN or infinite values in {non_finite}")
+        with stats.timer('ingest_phase_seconds', phase='fold'):
+            accumulator.add(client_id, weights, num_samples, ref=model_path)
+    except Exception:
+        shutil.rmtree(extract_dir, ignore_errors=True)
+        raise
+    print(f"✅ Folded {client_id} ({num_samples} samples) into the aggregate of {accumulator.num_clients} clients")
+
+    # The superseded upload was only kept on disk until the accumulator had subtracted it
+    previous = registry.record(client_id, upload=zip_path, model_dir=extract_dir, model_path=model_path,
+                               num_samples=num_samples, round=coordinator.round + 1, sha256=sha256)
+    if previous is not None:
+        remove_client_artifacts(previous)
+    coordinator.on_upload()
+
+    return 'Model uploaded and unzipped successfully'
+
+def discard_upload(payload):
+    zip_path, _, _ = payload
+    if os.path.exists(zip_path):
+        os.remove(zip_path)
+
+@app.teardown_request
+def remove_unclaimed_parts(_):
+    # Multipart files a handler did not move into place, e.g. after a 400
+    for file in request.files.values():
+        name = getattr(file.stream, 'name', None)
+        if isinstance(name, str) and name.endswith('.part') and os.path.exists(name):
+            file.stream.close()
+            os.remove(name)
+
+@app.route('/upload', methods=['POST'])
+def upload_model():
+    # Number of local training samples behind this update, used to weight it in FedAvg
+    try:
+        num_samples = int(request.headers.get('Sample-Count') or request.args.get('num_samples') or request.form.get('num_samples') or 1)
+    except ValueError:
+        return 'Sample count must be an integer', 400
+    if not 0 < num_samples <= MAX_SAMPLE_COUNT:
+        return f'Sample count must be between 1 and {MAX_SAMPLE_COUNT}', 400
+
+    client_id = request_client_id()
+    if client_id is None:
+        return 'Client-Id must be 1-64 letters, digits, dots, dashes or underscores', 400
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    zip_filename = f"{client_id}_{timestamp}_{uuid.uuid4().hex[:8]}.zip"
+    zip_path = os.path.join(UPLOAD_FOLDER, zip_filename)
+
+    if request.mimetype in ('application/zip', 'application/octet-stream'):
+        # Raw zip body, streamed to disk in chunks
+        with open(zip_path, 'wb') as f:
+            shutil.copyfileobj(request.stream, f, UPLOAD_CHUNK_SIZE)
+    else:
+        if 'model' not in request.files:
+            return 'No model file part', 400
+
+        file = request.files['model']
+        if file.filename == '':
+            return 'No selected file', 400
+
+        # The part was already streamed into UPLOAD_FOLDER by StreamingRequest
+        file.stream.close()
+        os.replace(file.stream.name, zip_path)
+
+    print(f"✅ Received model and saved to {zip_path}")
+
+    upload_id = ingestor.submit(client_id, (zip_path, num_samples, None), num_samples=num_samples)
+    return {"upload_id": upload_id, "status": "queued", "status_url": f"/upload_status/{upload_id}"}, 202
+
+def find_duplicate_upload(client_id, sha256, num_samples):
+    # Status of an upload from this client with the same bytes and sample count that is already
+    # folded in or still queued, which makes sending it again pointless
+    entry = registry.get(client_id)
+    if entry is not None and entry.get("sha256") == sha256 and entry.get("num_samples") == num_samples:
+        return {"status": "duplicate", "message": "This model is already this client's contribution"}
+    status = ingestor.status(resumable_ingests.get(client_id, ''))
+    if status is not None and status.get("sha256") == sha256 and status.get("num_samples") == num_samples \
+            and status["status"] in ("queued", "processing"):
+        upload_id = status["upload_id"]
+        return {"status": "duplicate", "upload_id": upload_id, "status_url": f"/upload_status/{upload_id}"}
+    return None
+
+def resumable_upload_state(session):
+    return {"upload_id": session.upload_id, "size": session.size, "sha256": session.sha256,
+            "num_samples": session.num_samples, "received": session.received,
+            "missing": missing_ranges(session.received, session.size), "status": session.status,
+            "chunk_url": f"/uploads/{session.upload_id}"}
+
+def lookup_resumable_upload(upload_id):
+    # Sessions are only visible to the client that started them
+    session = resumable_uploads.get(upload_id)
+    if session is None or session.client_id != request_client_id():
+        return None
+    return session
+
+@app.route('/uploads', methods=['POST'])
+def start_resumable_upload():
+    client_id = request_client_id()
+    if client_id is None:
+        return 'Client-Id must be 1-64 letters, digits, dots, dashes or underscores', 400
+    try:
+        size = int(request.headers['Upload-Length'])
+        num_samples = int(request.headers.get('Sample-Count') or 1)
+    except (KeyError, ValueError):
+        return 'Upload-Length and Sample-Count must be integers', 400
+    if not 0 < num_samples <= MAX_SAMPLE_COUNT:
+        return f'Sample count must be between 1 and {MAX_SAMPLE_COUNT}', 400
+    sha256 = request.headers.get('Upload-Sha256', '').lower()
+
+    duplicate = find_duplicate_upload(client_id, sha256, num_samples)
+    if duplicate is not None:
+        stats.inc('duplicate_uploads_total')
+        return duplicate, 200
+    try:
+        session, created = resumable_uploads.initiate(client_id, size, sha256, num_samples)
+    except ValueError as e:
+        return str(e), 400
+    if created:
+        print(f"✅ Started resumable upload {session.upload_id} of {size} bytes from {client_id}")
+    return resumable_upload_state(session), 201 if created else 200
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def resumable_upload_status(upload_id):
+    session = lookup_resumable_upload(upload_id)
+    if session is None:
+        return f"Unknown upload '{upload_id}'", 404
+    return resumable_upload_state(session), 200
+
+@app.route('/uploads/<upload_id>', methods=['PUT', 'PATCH'])
+def upload_chunk(upload_id):
+    session = lookup_resumable_upload(upload_id)
+    if session is None:
+        return f"Unknown upload '{upload_id}'", 404
+    if request.content_length is None:
+        return 'Chunks need a Content-Length', 411
+    try:
+        offset = int(request.headers['Upload-Offset'])
+    except (KeyError, ValueError):
+        return 'Upload-Offset must be an integer', 400
+    try:
+        with stats.timer('ingest_phase_seconds', phase='write_chunk'):
+            resumable_uploads.write(session, offset, request.stream, request.content_length, UPLOAD_CHUNK_SIZE)
+    except ValueError as e:
+        return {"error": str(e), **resumable_upload_state(session)}, 400
+
+    # The chunk that completes the upload hands it to the ingest pool, after the hash checks out
+    zip_path = os.path.join(UPLOAD_FOLDER, f"{session.client_id}_{session.upload_id}.zip")
+    try:
+        with stats.timer('ingest_phase_seconds', phase='verify_hash'):
+            completed = resumable_uploads.complete(session, zip_path)
+    except ValueError as e:
+        print(f"❌ Resumable upload {upload_id} from {session.client_id} failed verification: {e}")
+        return {"error": f"{e}, resend the whole upload", **resumable_upload_state(session)}, 422
+    if not completed:
+        return resumable_upload_state(session), 200
+    print(f"✅ Received model and saved to {zip_path}")
+
+    # Another request may have delivered the same model while this one was in flight
+    duplicate = find_duplicate_upload(session.client_id, session.sha256, session.num_samples)
+    if duplicate is not None:
+        stats.inc('duplicate_uploads_total')
+        os.remove(zip_path)
+        return duplicate, 200
+    ingest_id = ingestor.submit(session.client_id, (zip_path, session.num_samples, session.sha256),
+                                num_samples=session.num_samples, sha256=session.sha256)
+    resumable_ingests[session.client_id] = ingest_id
+    return {"upload_id": ingest_id, "status": "queued", "status_url": f"/upload_status/{ingest_id}"}, 202
+
+@app.route('/upload_status/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    status = ingestor.status(upload_id)
+    if status is None:
+        return f"Unknown upload '{upload_id}'", 404
+    return status, 200
+
+@app.route('/upload_update', methods=['POST'])
+def upload_update():
+    # Compressed alternative to /upload: fp16, int8 or top-k deltas of the updatable layers against
+    # a known model version, decoded straight into the aggregate. Only the reconstructed weights are
+    # written to disk, as an .npz in UPLOAD_FOLDER.
+    try:
+        with stats.timer('ingest_phase_seconds', phase='decode_update'):
+            base_version, num_samples, deltas = decode_update(request.get_data(cache=False))
+    except Exception as e:
+        return f"Malformed update: {e}", 400
+    if not 0 < num_samples <= MAX_SAMPLE_COUNT:
+        return f'Sample count must be between 1 and {MAX_SAMPLE_COUNT}', 400
+
+    base_weights = lookup_version_weights(base_version)
+    if base_weights is None:
+        return f"Unknown base model version '{base_version}', download the latest model first", 409
+
+    weights = {}
+    for layer in UPDATABLE_LAYERS:
+        if layer not in deltas:
+            return f"Update is missing layer '{layer}'", 400
+        weights[layer] = {}
+        for kind in ("weights", "bias"):
+            delta = deltas[layer].get(kind)
+            base = base_weights[layer][kind]
+            if delta is None or delta.size != base.size:
+                return f"Update for '{layer}' {kind} does not match the model shape", 400
+            weights[layer][kind] = base + delta
+    non_finite = non_finite_tensors(weights)
+    if non_finite:
+        return f"Update has NaN or infinite values in {non_finite}", 400
+
+    client_id = request_client_id()
+    if client_id is None:
+        return 'Client-Id must be 1-64 letters, digits, dots, dashes or underscores', 400
+
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    weights_path = os.path.join(UPLOAD_FOLDER, f"{client_id}_{timestamp}_{uuid.uuid4().hex[:8]}.npz")
+    with stats.timer('ingest_phase_seconds', phase='write_update'):
+        write_update_weights(weights_path, weights)
+
+    def fold_update():
+        with stats.timer('ingest_phase_seconds', phase='fold'):
+            accumulator.add(client_id, weights, num_samples, ref=weights_path)
+        # This client's previous upload or update, if any, has just been superseded
+        previous = registry.record(client_id, upload=weights_path, model_dir=None, model_path=weights_path,
+                                   num_samples=num_samples, round=coordinator.round + 1, base_version=base_version)
+        if previous is not None:
+            remove_client_artifacts(previous)
+
+    # Serialized with the client's full uploads on the ingest pool, so their supersede steps never interleave
+    try:
+        ingestor.run_inline(client_id, fold_update)
+    except Exception:
+        os.remove(weights_path)
+        raise
+    print(f"✅ Folded compressed update from {client_id} ({num_samples} samples, {request.content_length} bytes) against {base_version}")
+    coordinator.on_upload()
+
+    return 'Update received successfully', 200
+
+def run_aggregation(round_number, rule_override=None):
+    with round_profiler.profile(round_number), stats.timer('aggregation_seconds'):
+        return aggregate_round(round_number, rule_override)
+
+def aggregate_round(round_number, rule_override=None):
+    base_model_path = os.path.join(UPDATABLE_MODEL_PATH, 'Data', 'com.apple.CoreML', 'model.mlmodel')
+
+    rule, rule_params = rule_override or (DEFAULT_AGGREGATION_RULE, {})
+
+    if SERVER_ROLE == 'edge':
+        return push_partial(rule)
+
+    with stats.timer('aggregation_phase_seconds', phase=rule):
+        if rule == "fedavg":
+            # The running sums already hold every client's weighted contribution, and the partial sums
+            # pushed by edges merge into them exactly
+            partial = accumulator.snapshot()
+            with edge_partials_lock:
+                for edge_partial in edge_partials.values():
+                    partial.merge(edge_partial)
+            client_ids = sorted(partial.clients)
+            avg_weights = partial.average()
+        else:
+            # Robust rules look at every client's update side by side, which edges do not forward
+            with edge_partials_lock:
+                if edge_partials:
+                    raise ValueError(f"{rule} needs every client update, edges only push fedavg sums")
+            contributions = accumulator.client_weights()
+            client_ids = sorted(client_id for client_id, _, _ in contributions)
+            avg_weights = aggregate(rule, [w for _, w, _ in contributions], [n for _, _, n in contributions], **rule_params)
+
+    # Embedding rows touched since the last round move by their per-row average delta. They are
+    # drained here and put back if the round fails before it is published.
+    global global_embedding
+    rows, row_deltas, _, drained_rows = embedding_accumulator.drain()
+    try:
+        with stats.timer('aggregation_phase_seconds', phase='embedding'):
+            embedding = global_embedding
+            if len(rows):
+                embedding = global_embedding.copy()
+                embedding[:, rows] += row_deltas.T.astype(np.float32)
+                print(f"✅ Patched {len(rows)} embedding rows")
+            row_layers = embedding_row_layers(embedding)
+
+        # Rendering and evaluation need the whole embedding; the patch only carries its changed rows
+        model_weights = dict(avg_weights)
+        if row_layers:
+            model_weights[EMBEDDING_LAYER] = {"weights": embedding.ravel()}
+
+        # The version is the hash of the model bytes, so it is stored before anything is published
+        with stats.timer('aggregation_phase_seconds', phase='render'):
+            model_bytes = get_model_template(base_model_path).render(model_weights)
+        parent_version = model_store.latest or BASE_VERSION
+        with stats.timer('aggregation_phase_seconds', phase='store'):
+            model_version = model_store.put(model_bytes, round=round_number, rule=rule, clients=client_ids,
+                                            parent=parent_version, base_version=BASE_VERSION)
+        print(f"✅ Aggregated model saved to: {model_store.path(model_version)}")
+        publish_version(model_version, avg_weights, row_layers)
+    except Exception:
+        embedding_accumulator.restore(drained_rows)
+        raise
+    global_embedding = embedding
+
+    print(f"✅ Round {round_number} aggregated model version: {model_version} ({rule}, parent {parent_version})")
+
+    if EVALUATE_VERSIONS:
+        evaluation_pool.submit(evaluate_version, base_model_path, model_version, round_number, model_weights)
+
+    return f"✅ Aggregated {len(client_ids)} models into version {model_version} with {rule}"
+
+def publish_version(model_version, weights, row_layers=None):
+    # Patch with just the updatable layers and the embedding rows that differ from the base, for
+    # clients that already hold a model from the same base
+    global latest_patch
+    with stats.timer('aggregation_phase_seconds', phase='patch'):
+        patch = encode_layer_patch(model_version, BASE_VERSION, weights, row_layers)
+        with open(PATCH_PATH + '.tmp', 'wb') as f:
+            f.write(patch)
+
+    # Publish the model and its patch together so /download never sees a torn pair
+    with stats.timer('aggregation_phase_seconds', phase='publish'), publish_lock:
+        os.replace(PATCH_PATH + '.tmp', PATCH_PATH)
+        model_store.publish(model_version)
+        latest_patch = (model_version, EncodedPayload(patch, PATCH_MIMETYPE, encodings=('gzip',)))
+        remember_version_weights(model_version, weights)
+
+def push_partial(rule):
+    # An edge's round ends by handing the exact sums of its clients to the root, which publishes
+    if rule != "fedavg":
+        raise ValueError(f"Edges only aggregate with fedavg, {rule} needs every client update at the root")
+    partial = accumulator.snapshot()
+    with stats.timer('aggregation_phase_seconds', phase='push'):
+        body = encode_partial(partial)
+        push = urllib.request.Request(f"{ROOT_URL}/partials", data=body, method='POST', headers={
+            'Content-Type': PARTIAL_MIMETYPE, 'Edge-Id': EDGE_ID, 'Base-Version': BASE_VERSION})
+        with urllib.request.urlopen(push, timeout=ROOT_TIMEOUT_SECONDS) as response:
+            response.read()
+    return f"✅ Pushed the sums of {len(partial.clients)} clients ({len(body)} bytes) to {ROOT_URL}"
+
+def evaluate_version(base_model_path, model_version, round_number, weights):
+    # Scores a new version on the test subset without TensorFlow, off the aggregation thread
+    try:
+        with stats.timer('aggregation_phase_seconds', phase='evaluate'):
+            report = get_evaluator(base_model_path).evaluate(weights, test_inputs, test_labels, round_number=round_number)
+        report["model_version"] = model_version
+        metrics_sink.record('server_evaluations', report)
+        print(f"✅ Round {round_number} server evaluation: accuracy {report['accuracy']:.4f}, F1 {report['f1_score']:.4f} "
+              f"({report['evaluation_time_ms']:.0f} ms)")
+    except Exception as e:
+        print(f"❌ Evaluation of {model_version} failed: {e}")
+
+@app.route('/upload_embedding', methods=['POST'])
+def upload_embedding():
+    # Sparse embedding update: (row, delta) pairs for only the vocabulary ids a client touched. Rows are
+    # averaged over the clients that touched them and applied with the next aggregated version.
+    if SERVER_ROLE == 'edge':
+        return 'Embedding updates are aggregated by the root, send them there', 404
+    try:
+        with stats.timer('ingest_phase_seconds', phase='decode_embedding'):
+            base_version, num_samples, rows, deltas = decode_embedding_update(request.get_data(cache=False))
+    except Exception as e:
+        return f"Malformed embedding update: {e}", 400
+    if not 0 < num_samples <= MAX_SAMPLE_COUNT:
+        return f'Sample count must be between 1 and {MAX_SAMPLE_COUNT}', 400
+    if not np.isfinite(deltas).all():
+        return 'Embedding update has NaN or infinite values', 400
+    if base_version != BASE_VERSION and not model_store.has(base_version):
+        return f"Unknown base model version '{base_version}', download the latest model first", 409
+    embed_dim, vocab_size = base_embedding.shape
+    if deltas.shape[1] != embed_dim:
+        return f"Embedding rows have {embed_dim} values, got {deltas.shape[1]}", 400
+    if len(rows) and int(rows.max()) >= vocab_size:
+        return f"Row {int(rows.max())} is outside the {vocab_size}-word vocabulary", 400
+
+    client_id = request_client_id()
+    if client_id is None:
+        return 'Client-Id must be 1-64 letters, digits, dots, dashes or underscores', 400
+    try:
+        embedding_accumulator.add(client_id, rows, deltas, num_samples)
+    except ValueError as e:
+        return f"Invalid embedding update: {e}", 400
+    print(f"✅ Received {len(rows)} embedding rows from {client_id} ({request.content_length} bytes)")
+    return 'Embedding update received successfully', 200
+
+def seconds_arg(name, default):
+    # A finite number of seconds from the query string, or None when it is not one
+    try:
+        seconds = float(request.args.get(name, default))
+    except ValueError:
+        return None
+    return seconds if np.isfinite(seconds) else None
+
+@app.route('/aggregate', methods=['POST'])
+def aggregate_models():
+    rule, rule_override = request.args.get('rule'), None
+    if rule is not None:
+        if rule not in AGGREGATORS:
+            return f"Unknown aggregation rule '{rule}', expected one of {sorted(AGGREGATORS)}", 400
+        try:
+            rule_params = {name: cast(request.args[name]) for name, cast in RULE_PARAMS.items() if name in request.args}
+        except ValueError as e:
+            return f"Invalid aggregation parameter: {e}", 400
+        rule_override = (rule, rule_params)
+    wait = seconds_arg('wait', AGGREGATE_WAIT_SECONDS)
+    if wait is None:
+        return 'wait must be a number of seconds', 400
+
+    # Uploads are acknowledged before they are ingested, and clients such as the iOS app call /aggregate
+    # right after their upload, so the caller's own queued uploads are folded in before the round starts
+    deadline = time.time() + wait
+    client_id = request_client_id()
+    if client_id is not None and not ingestor.wait_for_client(client_id, wait):
+        return {"error": "This client's uploads are still being ingested", **coordinator.status()}, 202
+    if accumulator.num_clients + len(edge_partials) < 1:
+        return 'Need at least 1 model to aggregate', 400
+
+    # Joins the in-flight aggregation if there is one; force=1 aggregates pending uploads below quorum
+    target_round = coordinator.request_aggregation(force=request.args.get('force') == '1', options=rule_override)
+    if target_round is None:
+        status = coordinator.status()
+        reason = "a round is in flight" if status["in_flight"] is not None else "no round can start now"
+        return {"error": f"rule={rule} only applies to a round this request starts, and {reason}", **status}, 409
+    if not coordinator.wait_for_round(target_round, max(0, deadline - time.time())):
+        status = coordinator.status()
+        if status["in_flight"] is None and status["last_error"]:
+            return f"Aggregation failed: {status['last_error']}", 500
+        return status, 202
+
+    status = coordinator.status()
+    if status["last_result"] is None:
+        # No round has completed since the server started
+        return status, 202
+    return f"{status['last_result']} (round {status['round']})", 200
+
+@app.route('/round_status', methods=['GET'])
+def round_status():
+    # Long-poll with ?after=<round>&wait=<seconds> to be woken as soon as a later round is published
+    after = request.args.get('after')
+    if after is None:
+        return coordinator.status(), 200
+    try:
+        after = int(after)
+    except ValueError:
+        return 'after must be a round number', 400
+    wait = seconds_arg('wait', 30)
+    if wait is None:
+        return 'wait must be a number of seconds', 400
+    return coordinator.wait_for_change(after, min(wait, AGGREGATE_WAIT_SECONDS)), 200
+
+def remember_version_weights(model_version, weights):
+    version_weights[model_version] = {
+        layer: {kind: np.asarray(values, dtype=np.float32) for kind, values in params.items()}
+        for layer, params in weights.items()
+    }
+    # Always keep the pretrained base, drop the oldest aggregated versions beyond the limit
+    while len(version_weights) > MAX_DELTA_BASES + 1:
+        oldest = next(v for v in version_weights if v != BASE_VERSION)
+        del version_weights[oldest]
+
+def lookup_version_weights(version):
+    # Delta bases outside the recent window are read back from the model store on demand
+    weights = version_weights.get(version)
+    if weights is None and model_store.has(version):
+        weights = read_spec_weights(model_store.path(version))
+    return weights
+
+@app.route('/download', methods=['GET'])
+def download_aggregated_model():
+    # ?version=<hash> serves any stored version, e.g. to roll back or to diff against
+    model_version = request.args.get('version')
+    if model_version is None:
+        model_version = model_store.latest
+        if model_version is None:
+            return 'Aggregated model not found', 404
+
+        # Delta mode: a client on the same base only needs the updatable layers of the latest version
+        wants_delta = request.args.get('mode') == 'delta' or PATCH_MIMETYPE in request.headers.get('Accept', '')
+        current_patch = latest_patch
+        if wants_delta and current_patch is not None and request.headers.get('Base-Version') == BASE_VERSION:
+            patch_version, patch_payload = current_patch
+            if request.headers.get('Model-Version') == patch_version:
+                response = make_response('', 304)
+            else:
+                response = serve_payload(patch_payload, request)
+            response.headers['Model-Version'] = patch_version
+            response.headers['Base-Version'] = BASE_VERSION
+            print(f"✅ Model Version: {patch_version} (delta)")
+            return response
+
+    # Stored versions never change, so the payload can be served even if a newer one is published meanwhile
+    payload = model_store.payload(model_version)
+    if payload is None:
+        return f"Unknown model version '{model_version}'", 404
+
+    print(f"✅ Model Version: {model_version}")
+
+    response = serve_payload(payload, request)
+    response.headers['Content-Disposition'] = 'attachment; filename=aggregated_model.mlmodel'
+    response.headers['Model-Version'] = model_version
+    response.headers['Base-Version'] = BASE_VERSION
+    return response
+
+@app.route('/partials', methods=['POST'])
+def receive_partial():
+    # Root only: an edge's exact sums over its clients, replacing the edge's previous push
+    if SERVER_ROLE != 'root':
+        return 'Partial sums are only accepted by a root aggregator (FL_ROLE=root)', 404
+    edge_id = request.headers.get('Edge-Id')
+    if not edge_id:
+        return 'Missing Edge-Id header', 400
+    if request.headers.get('Base-Version') != BASE_VERSION:
+        return f"Edge runs on another base model, expected {BASE_VERSION}", 409
+    try:
+        with stats.timer('ingest_phase_seconds', phase='decode_partial'):
+            partial = decode_partial(request.get_data(cache=False))
+    except Exception as e:
+        return f"Malformed partial aggregate: {e}", 400
+
+    with edge_partials_lock:
+        edge_partials[edge_id] = partial
+    print(f"✅ Received the sums of {len(partial.clients)} clients ({partial.total_samples} samples) from edge {edge_id}")
+    coordinator.on_upload()
+    return {"round": coordinator.round}, 200
+
+def mirror_latest_version():
+    # Copies the root's published version into this edge's store and publishes it here as well
+    headers = {'Accept': PATCH_MIMETYPE, 'Base-Version': BASE_VERSION}
+    if model_store.latest is not None:
+        headers['Model-Version'] = model_store.latest
+    try:
+        fetch = urllib.request.Request(f"{ROOT_URL}/download?mode=delta", headers=headers)
+        with urllib.request.urlopen(fetch, timeout=ROOT_TIMEOUT_SECONDS) as response:
+            model_version = response.headers['Model-Version']
+            base_version = response.headers['Base-Version']
+            is_patch = response.headers.get_content_type() == PATCH_MIMETYPE
+            body = response.read()
+    except urllib.error.HTTPError as e:
+        # 304: already current, 404: the root has not published anything yet
+        if e.code in (304, 404):
+            return
+        raise
+    if base_version != BASE_VERSION:
+        raise ValueError(f"Root serves base {base_version}, this edge runs {BASE_VERSION}")
+    if model_version == model_store.latest:
+        return
+
+    model_bytes = None if is_patch else body
+    if model_bytes is None and not model_store.has(model_version):
+        with urllib.request.urlopen(f"{ROOT_URL}/download?version={model_version}", timeout=ROOT_TIMEOUT_SECONDS) as response:
+            model_bytes = response.read()
+    if model_bytes is not None and model_store.put(model_bytes, mirrored_from=ROOT_URL) != model_version:
+        raise ValueError(f"Model downloaded from the root does not hash to {model_version}")
+
+    if is_patch:
+        _, _, weights, row_layers = decode_layer_patch(body)
+    else:
+        weights, row_layers = read_version(model_store.path(model_version))
+    publish_version(model_version, weights, row_layers)
+    print(f"✅ Mirrored model version {model_version} from the root")
+
+def mirror_root_models():
+    # Long-polls the root's round status and mirrors each version it publishes
+    seen_round = -1
+    while True:
+        try:
+            with urllib.request.urlopen(f"{ROOT_URL}/round_status?after={seen_round}&wait=30",
+                                        timeout=ROOT_TIMEOUT_SECONDS) as response:
+                root_round = json.load(response)["round"]
+            if root_round > seen_round:
+                mirror_latest_version()
+                seen_round = root_round
+        except Exception as e:
+            print(f"⚠️ Could not sync with the root at {ROOT_URL}: {e}")
+            time.sleep(5)
+
+@app.route('/metrics', methods=['POST'])
+def receive_metrics():
+    data = request.get_json()
+    
+    accuracy = data.get('accuracy', None)
+    loss = data.get('loss', None)
+    model_version = data.get('model_version', None)
+    
+    if not accuracy or not loss or not model_version:
+        return 'Missing required data (accuracy, loss, or model_version)', 400
+    
+    print(f"Received metrics - Model Version: {model_version}, Accuracy: {accuracy}, Loss: {loss}")
+
+    try:
+        metrics_sink.record('model_metrics', data)
+    except (TypeError, ValueError) as e:
+        return f"Invalid metrics: {e}", 400
+    
+    return 'Metrics received successfully', 200
+
+@app.route('/stats', methods=['GET'])
+def get_stats():
+    response = make_response(stats.render())
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
+
+@app.route('/evaluations', methods=['GET'])
+def list_evaluations():
+    # Server-side scores of every aggregated version, oldest first
+    metrics_sink.flush()
+    columns = ["round", "model_version", "accuracy", "precision", "recall", "f1_score", "log_loss", "evaluation_time_ms"]
+    selected = ", ".join(f'"{c}"' for c in columns)
+    rows = metrics_sink.query(f"SELECT {selected} FROM server_evaluations ORDER BY id")
+    return {"evaluations": [dict(zip(columns, row)) for row in rows]}, 200
+
+@app.route('/get_train_data', methods=['GET'])
+def get_train_data():
+    subset_size = 50
+    # Get a random subset of training data
+    indices = random.sample(range(len(text_stores["val"])), subset_size)
+    samples = text_stores["val"].samples(indices)
+    return {"data": samples}, 200
+
+@app.route('/get_test_data', methods=['GET'])
+def get_test_data():
+    return serve_payload(test_data_payload, request)
+
+@app.route('/get_test_data_gzip', methods=['GET'])
+def get_test_data_gzip():
+    return serve_payload(test_data_payload, request, encoding='gzip', mimetype='application/gzip')
+
+@lru_cache(maxsize=None)
+def get_shard_payload(split, shard_id):
+    inputs, labels = shard_splits[split]
+    start = shard_id * SHARD_SIZE
+    end = start + SHARD_SIZE
+    return EncodedPayload(encode_shard(inputs[start:end], labels[start:end], SHARD_DTYPE), 'application/octet-stream')
+
+@app.route('/shards/<split>', methods=['GET'])
+def get_shard_index(split):
+    if split not in shard_splits:
+        return f"Unknown split '{split}'", 404
+    num_samples = len(shard_splits[split][1])
+    return {
+        "split": split,
+        "num_samples": num_samples,
+        "shard_size": SHARD_SIZE,
+        "num_shards": (num_samples + SHARD_SIZE - 1) // SHARD_SIZE,
+        "max_len": MAX_LEN,
+        "dtype": SHARD_DTYPE.str,
+    }, 200
+
+@app.route('/shards/<split>/<int:shard_id>', methods=['GET'])
+def get_shard(split, shard_id):
+    if split not in shard_splits:
+        return f"Unknown split '{split}'", 404
+    if shard_id * SHARD_SIZE >= len(shard_splits[split][1]):
+        return f"Shard {shard_id} out of range for split '{split}'", 404
+    return serve_payload(get_shard_payload(split, shard_id), request)
+
+@app.route('/report_metrics', methods=['POST'])
+def report_metrics():
+    data = request.get_json()
+
+    required_fields = [
+        'client_id', 'round', 'accuracy', 'precision', 'recall', 'f1_score', 
+        'log_loss', 'confusion_matrix', 'evaluation_time_ms', 'prediction_confidence', 
+        'per_class_precision', 'per_class_recall'
+    ]
+    
+    if not all(field in data for field in required_fields):
+        return 'Missing one or more required fields', 400
+
+    try:
+        metrics_sink.record('client_reports', data)
+    except (KeyError, TypeError, ValueError) as e:
+        return f"Invalid metrics field: {e}", 400
+
+    print(f"✅ Logged metrics for client '{data['client_id']}' at round {data['round']}")
+    return 'Metrics logged successfully', 200
+    
+def start_background_work():
+    # Called once the whole module is initialised, right before serving, so importing it never starts
+    # a round. Models restored from disk count towards the first round, all in one go so they start at
+    # most one; edges start following the root.
+    coordinator.on_upload(accumulator.num_clients)
+    if SERVER_ROLE == 'edge':
+        threading.Thread(target=mirror_root_models, name='mirror', daemon=True).start()
+
+if __name__ == '__main__':
+    start_background_work()
+    app.run(host='0.0.0.0', port=SERVER_PORT)
@@ -0,0 +1,89 @@
+import hashlib
+import importlib.metadata
+import json
+import os
+import shutil
+
+import numpy as np
+
+ARTIFACT_ROOT = os.environ.get('FL_ARTIFACT_DIR', './artifacts')
+MANIFEST_NAME = 'manifest.json'
+
+# Libraries whose version changes the tokenizer, the trained weights or the converted model
+FINGERPRINT_LIBRARIES = ['tensorflow', 'tensorflow-datasets', 'coremltools', 'numpy']
+
+
+def library_versions():
+    versions = {}
+    for name in FINGERPRINT_LIBRARIES:
+        try:
+            versions[name] = importlib.metadata.version(name)
+        except importlib.metadata.PackageNotFoundError:
+            versions[name] = None
+    return versions
+
+
+def compute_fingerprint(params, splits):
+    payload = json.dumps({
+        'params': params,
+        'splits': splits,
+        'libraries': library_versions(),
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+
+class ArtifactCache:
+    def __init__(self, fingerprint, root=ARTIFACT_ROOT):
+        self.fingerprint = fingerprint
+        self.dir = os.path.join(root, fingerprint)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def is_complete(self):
+        manifest_path = self.path(MANIFEST_NAME)
+        if not os.path.exists(manifest_path):
+            return False
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        if manifest.get('fingerprint') != self.fingerprint:
+            return False
+        return all(os.path.exists(self.path(name)) for name in manifest.get('files', []))
+
+    def start_build(self):
+        # A directory without a manifest is a build that died half way, start over
+        if os.path.isdir(self.dir):
+            shutil.rmtree(self.dir)
+        os.makedirs(self.dir, exist_ok=True)
+
+    def mark_complete(self, files):
+        manifest_path = self.path(MANIFEST_NAME)
+        tmp_path = manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'fingerprint': self.fingerprint, 'files': files}, f)
+        os.replace(tmp_path, manifest_path)
+
+    def save_arrays(self, name, **arrays):
+        np.savez(self.path(name), **arrays)
+
+    def load_arrays(self, name):
+        with np.load(self.path(name)) as data:
+            return {key: data[key] for key in data.files}
+
+    def save_json(self, name, obj):
+        with open(self.path(name), 'w') as f:
+            json.dump(obj, f)
+
+    def load_json(self, name):
+        with open(self.path(name), 'r') as f:
+            return json.load(f)
+
+    def publish(self, name, destination):
+        # Copy an artifact next to the server so it can be bundled into the iOS app
+        source = self.path(name)
+        if os.path.isdir(source):
+            if os.path.isdir(destination):
+                shutil.rmtree(destination)
+            shutil.copytree(source, destination)
+        else:
+            shutil.copyfile(source, destination)
@@ -1,263 +1,241 @@
-import pandas as pd
+import argparse
+import os
+import pickle
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
-import ast
-plt.ion()
-
-# Load Federated Learning metrics
-federated_df = pd.read_csv("federated_metrics_log.csv")  # Use the actual filename
-
-# Load Centralized model metrics
-centralized_df = pd.read_csv("centralized_model_metrics.csv")
-
-# Get the latest centralized metrics (last row if you logged multiple)
-centralized_metrics = centralized_df.iloc[-1]
-
-# Create a centralized metrics DataFrame to match federated format
-centralized_over_rounds = pd.DataFrame({
-    "round": federated_df["round"],
-    "accuracy": [centralized_metrics["accuracy"]] * len(federated_df),
-    "precision": [centralized_metrics["precision"]] * len(federated_df),
-    "recall": [centralized_metrics["recall"]] * len(federated_df),
-    "f1_score": [centralized_metrics["f1_score"]] * len(federated_df),
-    "model_type": ["centralized"] * len(federated_df)
-})
-
-# Add model_type column to federated metrics
-federated_df["model_type"] = "federated"
-
-# Combine both into one DataFrame
-combined_df = pd.concat([federated_df[["round", "accuracy", "precision", "recall", "f1_score", "model_type"]],
-                         centralized_over_rounds], ignore_index=True)
-
-# Plotting
-metrics = ["accuracy", "precision", "recall", "f1_score"]
-for metric in metrics:
-    plt.figure(figsize=(8, 5))
-    for model_type in combined_df["model_type"].unique():
-        data = combined_df[combined_df["model_type"] == model_type]
-        plt.plot(data["round"], data[metric], label=model_type.capitalize(), marker='o' if model_type == "federated" else 'd')
-    plt.title(f"{metric.capitalize()} Over Rounds")
-    plt.xlabel("Round")
-    plt.ylabel(metric.capitalize())
-    plt.grid(True)
-    plt.legend()
-    plt.tight_layout()
-    plt.ylim(0, 1)
-    plt.savefig(f"{metric}_comparison.png")
-    plt.show()
-
-log_losses = federated_df["log_loss"].tolist()
-# Plot log loss
-plt.figure(figsize=(8, 5))
-plt.plot(federated_df["round"], log_losses, label="Federated Log Loss", marker='o')
-plt.title("Log Loss Over Rounds")
-plt.xlabel("Round")
-plt.ylabel("Log Loss")
-plt.grid(True)
-plt.ylim(0, max(log_losses) * 1.1)
-plt.legend()
-plt.tight_layout()
-plt.savefig("log_loss_comparison.png")
-plt.show()
-
-# show table of confusion matrix values over rounds
-confusion_matrix = federated_df["confusion_matrix"].tolist()
-confusion_matrix = [ast.literal_eval(x) for x in confusion_matrix]
-# confusion_matrix has tp, tn, fp, fn
-tp = [x["tp"] for x in confusion_matrix]
-tn = [x["tn"] for x in confusion_matrix]
-fp = [x["fp"] for x in confusion_matrix]
-fn = [x["fn"] for x in confusion_matrix]
-# Plot confusion matrix values
-plt.figure(figsize=(8, 5))
-plt.plot(federated_df["round"], tp, label="True Positives", marker='o')
-plt.plot(federated_df["round"], tn, label="True Negatives", marker='o')
-plt.plot(federated_df["round"], fp, label="False Positives", marker='o')
-plt.plot(federated_df["round"], fn, label="False Negatives", marker='o')
-plt.title("Confusion Matrix Values Over Rounds (Federated)")
-plt.xlabel("Round")
-plt.ylabel("Count")
-plt.grid(True)
-plt.ylim(0, max(max(tp), max(tn), max(fp), max(fn)) * 1.1)
-plt.legend()
-plt.tight_layout()
-plt.savefig("confusion_matrix_comparison.png")
-plt.show()
-
-evaluation_time_ms = federated_df["evaluation_time_ms"].tolist()
-# Plot evaluation time
-plt.figure(figsize=(8, 5))
-plt.plot(federated_df["round"], evaluation_time_ms, label="Federated Evaluation Time (ms)", marker='o')
-plt.title("Evaluation Time Over Rounds")
-plt.xlabel("Round")
-plt.ylabel("Evaluation Time (ms)")
-plt.grid(True)
-plt.ylim(0, max(evaluation_time_ms) * 1.1)
-plt.legend()
-plt.tight_layout()
-plt.savefig("evaluation_time_comparison.png")
-plt.show()
-
-prediction_confidence = federated_df["prediction_confidence"].tolist()
-prediction_confidence = [ast.literal_eval(x) for x in prediction_confidence]
-# prediction confidence has average, min, and max values
-avg_confidence = [x["average"] for x in prediction_confidence]
-min_confidence = [x["min"] for x in prediction_confidence]
-max_confidence = [x["max"] for x in prediction_confidence]
-
-# Plot prediction confidence
-plt.figure(figsize=(8, 5))
-plt.plot(federated_df["round"], avg_confidence, label="Average Prediction Confidence", marker='o')
-plt.fill_between(federated_df["round"], min_confidence, max_confidence, color='gray', alpha=0.5, label="Confidence Range")
-plt.title("Prediction Confidence Over Rounds (Federated)")
-plt.xlabel("Round")
-plt.ylabel("Prediction Confidence")
-plt.grid(True)
-plt.ylim(0, 1)
-plt.legend()
-plt.tight_layout()
-plt.savefig("prediction_confidence_comparison.png")
-plt.show()
-
-per_class_precision = federated_df["per_class_precision"].tolist()
-per_class_precision = [ast.literal_eval(x) for x in per_class_precision]
-# per_class_precision has precision for class_0 and class_1
-class_0_precision = [x["class_0"] for x in per_class_precision]
-class_1_precision = [x["class_1"] for x in per_class_precision]
-# Plot per class precision
-plt.figure(figsize=(8, 5))
-plt.plot(federated_df["round"], class_0_precision, label="Class 0 Precision", marker='o')
-plt.plot(federated_df["round"], class_1_precision, label="Class 1 Precision", marker='o')
-plt.title("Per Class Precision Over Rounds (Federated)")
-plt.xlabel("Round")
-plt.ylabel("Precision")
-plt.grid(True)
-plt.ylim(0, 1)
-plt.legend()
-plt.tight_layout()
-plt.savefig("per_class_precision_comparison.png")
-plt.show()
-
-per_class_recall = federated_df["per_class_recall"].tolist()
-per_class_recall = [ast.literal_eval(x) for x in per_class_recall]
-# per_class_recall has recall for class_0 and class_1
-class_0_recall = [x["class_0"] for x in per_class_recall]
-class_1_recall = [x["class_1"] for x in per_class_recall]
-# Plot per class recall
-plt.figure(figsize=(8, 5))
-plt.plot(federated_df["round"], class_0_recall, label="Class 0 Recall", marker='o')
-plt.plot(federated_df["round"], class_1_recall, label="Class 1 Recall", marker='o')
-plt.title("Per Class Recall Over Rounds")
-plt.xlabel("Round")
-plt.ylabel("Recall")
-plt.grid(True)
-plt.ylim(0, 1)
-plt.legend()
-plt.tight_layout()
-plt.savefig("per_class_recall_comparison.png")
-plt.show()
-
-with PdfPages("federated_vs_centralized_report.pdf") as pdf:
-    for metric in metrics:
-        plt.figure(figsize=(8, 5))
-        for model_type in combined_df["model_type"].unique():
-            data = combined_df[combined_df["model_type"] == model_type]
-            plt.plot(data["round"], data[metric], label=model_type.capitalize(),
-                     marker='o' if model_type == "federated" else 'd')
-        plt.title(f"{metric.capitalize()} Over Rounds")
-        plt.xlabel("Round")
-        plt.ylabel(metric.capitalize())
-        plt.grid(True)
-        plt.ylim(0, 1)
-        plt.legend()
-        plt.tight_layout()
-        pdf.savefig()
-        plt.close()
-    
-    # Log loss
-    plt.figure(figsize=(8, 5))
-    plt.plot(federated_df["round"], log_losses, label="Federated Log Loss", marker='o')
-    plt.title("Log Loss Over Rounds")
-    plt.xlabel("Round")
-    plt.ylabel("Log Loss")
-    plt.grid(True)
-    plt.ylim(0, max(log_losses) * 1.1)
-    plt.legend()
-    plt.tight_layout()
-    pdf.savefig()
-    plt.close()
-
-    # Confusion matrix values
-    plt.figure(figsize=(8, 5))
-    plt.plot(federated_df["round"], tp, label="True Positives", marker='o')
-    plt.plot(federated_df["round"], tn, label="True Negatives", marker='o')
-    plt.plot(federated_df["round"], fp, label="False Positives", marker='o')
-    plt.plot(federated_df["round"], fn, label="False Negatives", marker='o')
-    plt.title("Confusion Matrix Values Over Rounds (Federated)")
-    plt.xlabel("Round")
-    plt.ylabel("Count")
-    plt.grid(True)
-    plt.ylim(0, max(max(tp), max(tn), max(fp), max(fn)) * 1.1)
-    plt.legend()
-    plt.tight_layout()
-    pdf.savefig()
-    plt.close()
-
-    # Evaluation time
-    plt.figure(figsize=(8, 5))
-    plt.plot(federated_df["round"], evaluation_time_ms, label="Federated Evaluation Time (ms)", marker='o')
-    plt.title("Evaluation Time Over Rounds")
-    plt.xlabel("Round")
-    plt.ylabel("Evaluation Time (ms)")
-    plt.grid(True)
-    plt.ylim(0, max(evaluation_time_ms) * 1.1)
-    plt.legend()
-    plt.tight_layout()
-    pdf.savefig()
-    plt.close()
-    
-    # Prediction confidence
-    plt.figure(figsize=(8, 5))
-    plt.plot(federated_df["round"], avg_confidence, label="Average Prediction Confidence", marker='o')
-    plt.fill_between(federated_df["round"], min_confidence, max_confidence, color='gray', alpha=0.5,
-                     label="Confidence Range")
-    plt.title("Prediction Confidence Over Rounds (Federated)")
-    plt.xlabel("Round")
-    plt.ylabel("Prediction Confidence")
-    plt.grid(True)
-    plt.ylim(0, 1)
-    plt.legend()
-    plt.tight_layout()
-    pdf.savefig()
-    plt.close()
-
-    # Per class precision
-    plt.figure(figsize=(8, 5))
-    plt.plot(federated_df["round"], class_0_precision, label="Class 0 Precision", marker='o')
-    plt.plot(federated_df["round"], class_1_precision, label="Class 1 Precision", marker='o')
-    plt.title("Per Class Precision Over Rounds (Federated)")
-    plt.xlabel("Round")
-    plt.ylabel("Precision")
-    plt.grid(True)
-    plt.ylim(0, 1)
-    plt.legend()
-    plt.tight_layout()
-    pdf.savefig()
-    plt.close()
-
-    # Per class recall
-    plt.figure(figsize=(8, 5))
-    plt.plot(federated_df["round"], class_0_recall, label="Class 0 Recall", marker='o')
-    plt.plot(federated_df["round"], class_1_recall, label="Class 1 Recall", marker='o')
-    plt.title("Per Class Recall Over Rounds (Federated)")
-    plt.xlabel("Round")
-    plt.ylabel("Recall")
-    plt.grid(True)
-    plt.ylim(0, 1)
-    plt.legend()
-    plt.tight_layout()
-    pdf.savefig()
-    plt.close()
-
+import pandas as pd
 
+# Per-client report columns aggregated per round, as flattened by the server's metrics store
+METRIC_COLUMNS = [
+    "accuracy", "precision", "recall", "f1_score", "log_loss", "tp", "tn", "fp", "fn",
+    "evaluation_time_ms", "confidence_avg", "confidence_min", "confidence_max",
+    "precision_class_0", "precision_class_1", "recall_class_0", "recall_class_1",
+]
+
+# Dict-valued columns of the old federated_metrics_log.csv and the flat columns their keys map to
+LEGACY_NESTED_COLUMNS = {
+    "confusion_matrix": {"tp": "tp", "tn": "tn", "fp": "fp", "fn": "fn"},
+    "prediction_confidence": {"average": "confidence_avg", "min": "confidence_min", "max": "confidence_max"},
+    "per_class_precision": {"class_0": "precision_class_0", "class_1": "precision_class_1"},
+    "per_class_recall": {"class_0": "recall_class_0", "class_1": "recall_class_1"},
+}
+
+CENTRALIZED_METRICS = ["accuracy", "precision", "recall", "f1_score"]
+
+
+def expand_legacy_log(df):
+    # Pulls every 'key': value pair out of each stringified dict column in one regex pass per column
+    for column, mapping in LEGACY_NESTED_COLUMNS.items():
+        pairs = df[column].str.extractall(r"'(\w+)':\s*([^,}]+)")
+        wide = pairs.droplevel("match").set_index(0, append=True)[1].unstack()
+        wide = wide.rename(columns=mapping)[list(mapping.values())].astype(float)
+        df = df.drop(columns=column).join(wide)
+    return df
+
+
+def load_reports(source, after_id=0, rounds=None):
+    # Client reports with id > after_id (optionally only the given rounds), from the SQLite metrics
+    # store or from a legacy CSV log, where the id is the 1-based row number
+    if source.endswith(".csv"):
+        df = expand_legacy_log(pd.read_csv(source))
+        df.insert(0, "id", range(1, len(df) + 1))
+        df = df[df["id"] > after_id]
+        return df if rounds is None else df[df["round"].isin(rounds)]
+    query = "SELECT * FROM client_reports WHERE id > ?"
+    params = [after_id]
+    if rounds is not None:
+        query += f" AND round IN ({', '.join('?' * len(rounds))})"
+        params += [int(r) for r in rounds]
+    with sqlite3.connect(source) as connection:
+        return pd.read_sql_query(query, connection, params=params)
+
+
+def aggregate_rounds(reports):
+    # Mean, spread and range of every metric across the clients that reported in each round
+    grouped = reports.groupby("round")
+    stats = grouped[METRIC_COLUMNS].agg(["mean", "std", "min", "max"])
+    stats.columns = [f"{column}_{stat}" for column, stat in stats.columns]
+    stats = stats.fillna(0.0)
+    stats["clients"] = grouped.size()
+    return stats
+
+
+def source_identity(source):
+    # Unchanged by appends, but not by the file being replaced or recreated
+    st = os.stat(source)
+    return os.path.abspath(source), st.st_dev, st.st_ino
+
+
+def report_fingerprint(source, report_id):
+    # The report with the given id as JSON, to tell a source that was appended to from one whose ids
+    # restarted, e.g. a metrics DB recreated in place
+    if report_id == 0:
+        return None
+    if source.endswith(".csv"):
+        reports = load_reports(source, after_id=report_id - 1)
+    else:
+        with sqlite3.connect(source) as connection:
+            reports = pd.read_sql_query("SELECT * FROM client_reports WHERE id = ?", connection, params=[report_id])
+    return reports[reports["id"] == report_id].head(1).to_json(orient="records")
+
+
+def update_round_cache(source, cache_path):
+    # Only rounds that received new reports since the cached run are re-aggregated. The cache is
+    # dropped when the source file, its last cached report or the aggregated columns change.
+    key = {"source": source_identity(source), "columns": METRIC_COLUMNS}
+    cache = None
+    if os.path.exists(cache_path):
+        with open(cache_path, "rb") as f:
+            cache = pickle.load(f)
+        if cache.get("key") != key or report_fingerprint(source, cache["last_id"]) != cache.get("last_report"):
+            cache = None
+    if cache is None:
+        cache = {"key": key, "last_id": 0, "last_report": None, "rounds": None}
+
+    new_reports = load_reports(source, after_id=cache["last_id"])
+    if len(new_reports) == 0:
+        return cache["rounds"]
+
+    changed = sorted(new_reports["round"].unique())
+    fresh = aggregate_rounds(load_reports(source, rounds=changed))
+    if cache["rounds"] is not None:
+        fresh = pd.concat([cache["rounds"].drop(index=changed, errors="ignore"), fresh]).sort_index()
+    last_id = int(new_reports["id"].max())
+    cache.update(last_id=last_id, last_report=report_fingerprint(source, last_id), rounds=fresh)
+    with open(cache_path + ".tmp", "wb") as f:
+        pickle.dump(cache, f)
+    os.replace(cache_path + ".tmp", cache_path)
+    print(f"Re-aggregated {len(changed)} of {len(fresh)} rounds from {len(new_reports)} new reports")
+    return fresh
+
+
+def plot_band(ax, rounds, column, label, marker="o"):
+    mean = rounds[f"{column}_mean"]
+    std = rounds[f"{column}_std"]
+    ax.plot(rounds.index, mean, label=label, marker=marker, markersize=3)
+    ax.fill_between(rounds.index, mean - std, mean + std, alpha=0.2)
+
+
+def new_axes(title, ylabel):
+    fig, ax = plt.subplots(figsize=(8, 5))
+    ax.set_title(title)
+    ax.set_xlabel("Round")
+    ax.set_ylabel(ylabel)
+    ax.grid(True)
+    return fig, ax
+
+
+def metric_figure(rounds, centralized, metric):
+    fig, ax = new_axes(f"{metric.capitalize()} Over Rounds", metric.capitalize())
+    plot_band(ax, rounds, metric, "Federated (mean ± std)")
+    if centralized is not None:
+        ax.axhline(centralized[metric], color="C1", linestyle="--", label="Centralized")
+    ax.set_ylim(0, 1)
+    return fig, ax
+
+
+def log_loss_figure(rounds, centralized):
+    fig, ax = new_axes("Log Loss Over Rounds", "Log Loss")
+    plot_band(ax, rounds, "log_loss", "Federated Log Loss")
+    ax.set_ylim(0, rounds["log_loss_max"].max() * 1.1)
+    return fig, ax
+
+
+def confusion_matrix_figure(rounds, centralized):
+    fig, ax = new_axes("Confusion Matrix Values Over Rounds (Federated)", "Count")
+    for column, label in [("tp", "True Positives"), ("tn", "True Negatives"),
+                          ("fp", "False Positives"), ("fn", "False Negatives")]:
+        plot_band(ax, rounds, column, label)
+    ax.set_ylim(0, max(rounds[f"{c}_max"].max() for c in ("tp", "tn", "fp", "fn")) * 1.1)
+    return fig, ax
+
+
+def evaluation_time_figure(rounds, centralized):
+    fig, ax = new_axes("Evaluation Time Over Rounds", "Evaluation Time (ms)")
+    plot_band(ax, rounds, "evaluation_time_ms", "Federated Evaluation Time (ms)")
+    ax.set_ylim(0, rounds["evaluation_time_ms_max"].max() * 1.1)
+    return fig, ax
+
+
+def prediction_confidence_figure(rounds, centralized):
+    fig, ax = new_axes("Prediction Confidence Over Rounds (Federated)", "Prediction Confidence")
+    ax.plot(rounds.index, rounds["confidence_avg_mean"], label="Average Prediction Confidence", marker="o", markersize=3)
+    ax.fill_between(rounds.index, rounds["confidence_min_min"], rounds["confidence_max_max"],
+                    color="gray", alpha=0.5, label="Confidence Range")
+    ax.set_ylim(0, 1)
+    return fig, ax
+
+
+def per_class_figure(rounds, centralized, metric):
+    fig, ax = new_axes(f"Per Class {metric.capitalize()} Over Rounds (Federated)", metric.capitalize())
+    plot_band(ax, rounds, f"{metric}_class_0", f"Class 0 {metric.capitalize()}")
+    plot_band(ax, rounds, f"{metric}_class_1", f"Class 1 {metric.capitalize()}")
+    ax.set_ylim(0, 1)
+    return fig, ax
+
+
+# Report pages in order: (PNG file name, figure builder, extra arguments)
+FIGURES = [(f"{metric}_comparison.png", metric_figure, (metric,)) for metric in CENTRALIZED_METRICS] + [
+    ("log_loss_comparison.png", log_loss_figure, ()),
+    ("confusion_matrix_comparison.png", confusion_matrix_figure, ()),
+    ("evaluation_time_comparison.png", evaluation_time_figure, ()),
+    ("prediction_confidence_comparison.png", prediction_confidence_figure, ()),
+    ("per_class_precision_comparison.png", per_class_figure, ("precision",)),
+    ("per_class_recall_comparison.png", per_class_figure, ("recall",)),
+]
+
+
+def render_figure(index, rounds, centralized, out_dir):
+    # Draws one figure once, saves its PNG and hands the figure back pickled for the PDF page
+    name, build, extra = FIGURES[index]
+    fig, ax = build(rounds, centralized, *extra)
+    ax.legend()
+    fig.tight_layout()
+    fig.savefig(os.path.join(out_dir, name))
+    data = pickle.dumps(fig)
+    plt.close(fig)
+    return data
+
+
+def load_centralized(path):
+    if not os.path.exists(path):
+        return None
+    # The last row holds the most recent centralized run
+    return pd.read_csv(path).iloc[-1][CENTRALIZED_METRICS].astype(float).to_dict()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Federated vs centralized report from the metrics store")
+    parser.add_argument("--source", default=os.environ.get("FL_METRICS_DB", "metrics.db"),
+                        help="SQLite metrics store, or a legacy federated_metrics_log.csv")
+    parser.add_argument("--centralized", default="centralized_model_metrics.csv")
+    parser.add_argument("--cache", default=".report_rounds.pkl", help="per-round aggregates of the last run")
+    parser.add_argument("--out-dir", default=".")
+    parser.add_argument("--pdf", default="federated_vs_centralized_report.pdf")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    rounds = update_round_cache(args.source, args.cache)
+    if rounds is None or len(rounds) == 0:
+        print(f"No client reports in {args.source}")
+        return
+    centralized = load_centralized(args.centralized)
+
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        figures = pool.map(render_figure, range(len(FIGURES)), [rounds] * len(FIGURES),
+                           [centralized] * len(FIGURES), [args.out_dir] * len(FIGURES))
+        with PdfPages(os.path.join(args.out_dir, args.pdf)) as pdf:
+            for data in figures:
+                fig = pickle.loads(data)
+                pdf.savefig(fig)
+                plt.close(fig)
+    print(f"Wrote {len(FIGURES)} figures over {len(rounds)} rounds to {args.out_dir}")
+
+
+if __name__ == "__main__":
+    main()
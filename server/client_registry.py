@@ -0,0 +1,91 @@
+import json
+import os
+import re
+import threading
+import time
+
+# Client ids end up in file names, so they are restricted to a safe alphabet
+CLIENT_ID_PATTERN = re.compile(r'^[A-Za-z0-9_.-]{1,64}$')
+
+
+def valid_client_id(client_id):
+    return bool(client_id) and CLIENT_ID_PATTERN.match(client_id) is not None and client_id not in ('.', '..')
+
+
+class ClientRegistry:
+    # Each client's latest upload (zip path, extracted model dir, parsed .mlmodelc path, round and
+    # sample count) kept in memory, so superseding an upload is a dict lookup rather than a directory
+    # scan. Every change is appended to a JSON-lines journal that is replayed on restart and
+    # compacted once it holds mostly stale lines.
+    def __init__(self, journal_path, compact_ratio=4):
+        self.journal_path = journal_path
+        self.compact_ratio = compact_ratio
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.journal_lines = 0
+        self.existed = os.path.exists(journal_path)
+        if self.existed:
+            self._replay()
+        self.journal = open(journal_path, 'a')
+
+    def _replay(self):
+        with open(self.journal_path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A line torn by a crash mid-write
+                    continue
+                self.journal_lines += 1
+                client_id = record.pop("client_id")
+                if record.get("removed"):
+                    self.entries.pop(client_id, None)
+                else:
+                    self.entries[client_id] = record
+
+    def _append_locked(self, record):
+        self.journal.write(json.dumps(record) + '\n')
+        self.journal.flush()
+        self.journal_lines += 1
+        if self.journal_lines > self.compact_ratio * max(len(self.entries), 16):
+            self._compact_locked()
+
+    def _compact_locked(self):
+        tmp_path = self.journal_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for client_id, entry in self.entries.items():
+                f.write(json.dumps(dict(entry, client_id=client_id)) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.journal.close()
+        os.replace(tmp_path, self.journal_path)
+        self.journal = open(self.journal_path, 'a')
+        self.journal_lines = len(self.entries)
+
+    def record(self, client_id, **fields):
+        # Makes this the client's latest upload and returns the entry it replaces, if any
+        entry = dict(fields, updated_at=time.time())
+        with self.lock:
+            previous = self.entries.get(client_id)
+            self.entries[client_id] = entry
+            self._append_locked(dict(entry, client_id=client_id))
+        return previous
+
+    def remove(self, client_id):
+        with self.lock:
+            previous = self.entries.pop(client_id, None)
+            if previous is not None:
+                self._append_locked({"client_id": client_id, "removed": True})
+        return previous
+
+    def get(self, client_id):
+        with self.lock:
+            entry = self.entries.get(client_id)
+            return dict(entry) if entry is not None else None
+
+    def items(self):
+        with self.lock:
+            return [(client_id, dict(entry)) for client_id, entry in self.entries.items()]
+
+    def __len__(self):
+        return len(self.entries)
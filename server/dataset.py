@@ -0,0 +1,201 @@
+import os
+import random
+import shutil
+
+import coremltools as ct
+import numpy as np
+import tensorflow as tf
+import tensorflow_datasets as tfds
+
+from artifacts import ArtifactCache, compute_fingerprint
+from fast_tokenizer import FastTokenizer
+from text_store import TextStore
+
+# The IMDb splits, tokenizer, encoded inputs and pretrained CoreML model, loaded from the artifact
+# cache or built into it on a miss. Importing this touches nothing outside the cache, so the server
+# and the offline simulation can share it.
+
+# Constants
+VOCAB_SIZE = 10000
+MAX_LEN = 100
+EMBED_DIM = 128
+BATCH_SIZE = 32
+EPOCHS = 10
+UPDATABLE_LAYERS = ["sequential/dense1/BiasAdd", "sequential/output/BiasAdd"]
+SPLITS = ['train[:80%]', 'train[80%:]', 'test']
+TEST_SUBSET_SIZE = 2500
+# Bumped whenever the files in the cache change layout, so older caches miss and are rebuilt
+CACHE_FORMAT = 2
+
+# Artifacts are cached under a fingerprint of everything that shapes them
+artifact_cache = ArtifactCache(compute_fingerprint(
+    {"VOCAB_SIZE": VOCAB_SIZE, "MAX_LEN": MAX_LEN, "EMBED_DIM": EMBED_DIM, "EPOCHS": EPOCHS,
+     "BATCH_SIZE": BATCH_SIZE, "TEST_SUBSET_SIZE": TEST_SUBSET_SIZE, "CACHE_FORMAT": CACHE_FORMAT},
+    SPLITS
+))
+KERAS_MODEL_PATH = artifact_cache.path("imdb_model.keras")
+TOKENIZER_PATH = artifact_cache.path("tokenizer.json")
+COREML_SPEC_PATH = artifact_cache.path("imdb_model.mlmodel")
+UPDATABLE_MODEL_PATH = artifact_cache.path("imdb_updatable_model.mlpackage")
+ARRAYS_FILE = "preprocessed.npz"
+# Raw review texts and labels per split, memory-mapped and read by index
+TEXT_STORES = {"train": "train_texts", "val": "val_texts", "test": "test_texts"}
+# Padded token matrices, one memory-mappable .npy per split under the tokenizer's hash
+ENCODED_DIR = "encoded"
+ENCODED_SPLITS = ["train", "val", "test"]
+# Extra encode processes are opt-in: under the spawn start method they re-import the main module
+TOKENIZER_WORKERS = int(os.environ.get('FL_TOKENIZER_WORKERS', 1))
+CACHED_FILES = ["imdb_model.keras", "tokenizer.json", "imdb_updatable_model.mlpackage", ARRAYS_FILE, ENCODED_DIR] + list(TEXT_STORES.values())
+
+cache_hit = artifact_cache.is_complete()
+
+if cache_hit:
+    print(f"✅ Reusing cached artifacts from {artifact_cache.dir}")
+    arrays = artifact_cache.load_arrays(ARRAYS_FILE)
+    text_stores = {split: TextStore(artifact_cache.path(name)) for split, name in TEXT_STORES.items()}
+    train_labels = arrays["train_labels"]
+    val_labels = arrays["val_labels"]
+    test_labels = arrays["test_labels"]
+
+    tokenizer = FastTokenizer.load(TOKENIZER_PATH, num_words=VOCAB_SIZE)
+    encoded_paths = {split: tokenizer.encoding_path(artifact_cache.path(ENCODED_DIR), split, MAX_LEN) for split in ENCODED_SPLITS}
+    train_inputs, val_inputs, test_inputs = (np.load(encoded_paths[split], mmap_mode='r') for split in ENCODED_SPLITS)
+else:
+    print(f"⏳ No cached artifacts for {artifact_cache.fingerprint}, preparing from scratch")
+    artifact_cache.start_build()
+
+    # Load IMDb
+    (train_data, val_data, test_data), info = tfds.load(
+        'imdb_reviews',
+        split=SPLITS,
+        as_supervised=True,
+        with_info=True
+    )
+
+    # Write the raw review bytes straight into the text stores, nothing is decoded or kept in lists
+    def examples(data):
+        return ((x.numpy(), int(y.numpy())) for x, y in data)
+
+    text_stores = {
+        "train": TextStore.build(artifact_cache.path(TEXT_STORES["train"]), examples(train_data)),
+        "val": TextStore.build(artifact_cache.path(TEXT_STORES["val"]), examples(val_data)),
+    }
+
+    # Get random subset of test data
+    all_test = TextStore.build(artifact_cache.path("all_test_texts"), examples(test_data))
+    indices = random.sample(range(len(all_test)), TEST_SUBSET_SIZE)
+    text_stores["test"] = TextStore.build(artifact_cache.path(TEXT_STORES["test"]),
+                                          ((all_test.raw(i), int(all_test.labels[i])) for i in indices))
+    del all_test
+    shutil.rmtree(artifact_cache.path("all_test_texts"))
+
+    # Tokenizer, with the same word_index and encodings as the Keras Tokenizer
+    tokenizer = FastTokenizer(num_words=VOCAB_SIZE)
+    tokenizer.fit_on_texts(text_stores["train"].texts())
+    encoded_dir = artifact_cache.path(ENCODED_DIR)
+    train_inputs = tokenizer.encode_cached(text_stores["train"].texts(), MAX_LEN, encoded_dir, "train", TOKENIZER_WORKERS)
+    val_inputs = tokenizer.encode_cached(text_stores["val"].texts(), MAX_LEN, encoded_dir, "val", TOKENIZER_WORKERS)
+    test_inputs = tokenizer.encode_cached(text_stores["test"].texts(), MAX_LEN, encoded_dir, "test", TOKENIZER_WORKERS)
+
+    # Convert to NumPy arrays
+    train_labels = np.array(text_stores["train"].labels, dtype=np.int64)
+    val_labels = np.array(text_stores["val"].labels, dtype=np.int64)
+    test_labels = np.array(text_stores["test"].labels, dtype=np.int64)
+
+    artifact_cache.save_arrays(
+        ARRAYS_FILE,
+        train_labels=train_labels, val_labels=val_labels, test_labels=test_labels,
+        test_indices=np.array(indices)
+    )
+
+def create_pretrained_model():
+    # Updatable-friendly model
+    model = tf.keras.Sequential([
+        tf.keras.layers.Embedding(VOCAB_SIZE, EMBED_DIM, input_length=MAX_LEN, name="embedding"),
+        tf.keras.layers.Flatten(name="flatten"),
+        tf.keras.layers.Dense(64, activation='relu', name="dense1"),
+        tf.keras.layers.Dense(2, activation='softmax', name="output")
+    ])
+
+    model.compile(loss='sparse_categorical_crossentropy', optimizer='adam', metrics=['accuracy'])
+    model.summary()
+
+    # Pretraining
+    model.fit(train_inputs, train_labels, batch_size=BATCH_SIZE, epochs=EPOCHS, validation_data=(val_inputs, val_labels))
+
+    # Save the model
+    model.save(KERAS_MODEL_PATH)
+    print(f"✅ Pretrained model saved as {KERAS_MODEL_PATH}")
+
+    # Save tokenizer
+    tokenizer.save(TOKENIZER_PATH)
+
+    print("✅ Tokenizer saved.")
+
+
+def convert_to_coreml():
+    # Load the model
+    model = tf.keras.models.load_model(KERAS_MODEL_PATH)
+
+    model.build(input_shape=(None, MAX_LEN))
+    _ = model.get_weights()
+
+    # # Set input type
+    input_type = ct.TensorType(shape=(1, MAX_LEN), dtype=np.int32)
+
+    # Convert to CoreML Neural Network
+    mlmodel = ct.convert(
+        model,
+        convert_to="neuralnetwork",
+        inputs=[input_type],
+        compute_units=ct.ComputeUnit.ALL
+    )
+
+    # Enable updatable model
+    old_spec = mlmodel.get_spec()
+    old_spec.description.metadata.shortDescription = "Updatable IMDB sentiment classifier"
+    old_spec.description.metadata.author = "Your Name"
+    old_spec.isUpdatable = True
+
+    old_nn = old_spec.neuralNetwork
+    # Delete the last layer (softmaxND) as it is incompatible with updatable models
+    del old_nn.layers[-1] 
+    second_to_last_index = len(old_nn.layers) - 1
+
+    old_spec.neuralNetwork.layers[second_to_last_index].output[0] = "output_r"
+
+    ct.utils.save_spec(old_spec, COREML_SPEC_PATH)
+    spec = ct.utils.load_spec(COREML_SPEC_PATH)
+
+    # Add the last layer again as a softmax layer (not softmaxND) 
+    softmax_layer = spec.neuralNetwork.layers.add()
+    softmax_layer.name = "softmax"
+    softmax_layer.softmax.MergeFromString(b"")
+    softmax_layer.input.append("output_r")
+    softmax_layer.output.append("Identity")
+
+    ct.utils.save_spec(spec, COREML_SPEC_PATH)
+
+    builder = ct.models.neural_network.NeuralNetworkBuilder(spec=spec)
+    # Mark updatable layers
+    builder.make_updatable(UPDATABLE_LAYERS)
+
+    # Set up the model for training
+    builder.set_categorical_cross_entropy_loss(name="lossLayer", input='Identity')
+    builder.set_adam_optimizer(ct.models.neural_network.AdamParams(lr=0.01, batch=32))
+    builder.set_epochs(10)
+
+    model_spec = builder.spec
+    model_spec.description.metadata.shortDescription = "Updatable IMDB sentiment classifier"
+    model_spec.description.metadata.author = "Your Name"
+    model_spec.isUpdatable = True
+
+    mlmodel = ct.models.MLModel(model_spec)
+
+    mlmodel.save(UPDATABLE_MODEL_PATH)
+
+if not cache_hit:
+    create_pretrained_model()
+    convert_to_coreml()
+    artifact_cache.mark_complete(CACHED_FILES)
+    print(f"✅ Artifacts cached under {artifact_cache.dir}")
@@ -0,0 +1,99 @@
+import json
+import mmap
+import os
+
+import numpy as np
+
+WEIGHTS_FILE = 'model.espresso.weights'
+NET_FILE = 'model.espresso.net'
+
+# model.espresso.weights starts with a little-endian uint64 blob count, followed by one
+# (blob id, byte size) uint64 pair per blob; the float32 blobs follow back to back in that order
+HEADER_DTYPE = np.dtype('<u8')
+INDEX_DTYPE = np.dtype([('blob_id', '<u8'), ('num_bytes', '<u8')])
+BLOB_DTYPE = np.dtype('<f4')
+
+
+def read_layer_blobs(mlmodelc_path):
+    # Map each layer name in model.espresso.net to the blob ids holding its parameters
+    with open(os.path.join(mlmodelc_path, NET_FILE), 'r') as f:
+        net = json.load(f)
+
+    layer_blobs = {}
+    for layer in net.get('layers', []):
+        blobs = {}
+        if 'blob_weights' in layer:
+            blobs['weights'] = layer['blob_weights']
+        if 'blob_biases' in layer:
+            blobs['bias'] = layer['blob_biases']
+        if blobs:
+            layer_blobs[layer['name']] = blobs
+    return layer_blobs
+
+
+class EspressoWeights:
+    def __init__(self, mlmodelc_path):
+        self.path = os.path.join(mlmodelc_path, WEIGHTS_FILE)
+        with open(self.path, 'rb') as f:
+            # The mapping stays valid after the file is closed; numpy views keep it alive
+            self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._buffer) < HEADER_DTYPE.itemsize:
+            raise ValueError(f"{self.path} is too small to hold an espresso weights header")
+
+        num_blobs = int(np.frombuffer(self._buffer, dtype=HEADER_DTYPE, count=1)[0])
+        index_start = HEADER_DTYPE.itemsize
+        data_start = index_start + num_blobs * INDEX_DTYPE.itemsize
+        if data_start > len(self._buffer):
+            raise ValueError(f"{self.path} declares {num_blobs} blobs but the index is truncated")
+
+        index = np.frombuffer(self._buffer, dtype=INDEX_DTYPE, count=num_blobs, offset=index_start)
+        sizes = index['num_bytes'].astype(np.int64)
+        offsets = data_start + np.concatenate(([0], np.cumsum(sizes)[:-1])) if num_blobs else np.zeros(0, np.int64)
+        if num_blobs and offsets[-1] + sizes[-1] > len(self._buffer):
+            raise ValueError(f"{self.path} is truncated: blobs extend past the end of the file")
+
+        # blob id -> (byte offset, byte size), built once per file
+        self.index = {
+            int(blob_id): (int(offset), int(size))
+            for blob_id, offset, size in zip(index['blob_id'], offsets, sizes)
+        }
+        self.layer_blobs = read_layer_blobs(mlmodelc_path)
+
+    def blob(self, blob_id):
+        offset, num_bytes = self.index[blob_id]
+        return np.frombuffer(self._buffer, dtype=BLOB_DTYPE, count=num_bytes // BLOB_DTYPE.itemsize, offset=offset)
+
+    def layer(self, name):
+        if name not in self.layer_blobs:
+            raise KeyError(f"Layer '{name}' has no weight blobs in {NET_FILE}")
+        return {kind: self.blob(blob_id) for kind, blob_id in self.layer_blobs[name].items()}
+
+
+def encode_weights(blobs):
+    # Inverse of EspressoWeights: serializes {blob_id: float32 array} in ascending blob id order
+    blob_ids = sorted(blobs)
+    arrays = [np.ascontiguousarray(blobs[blob_id], dtype=BLOB_DTYPE).ravel() for blob_id in blob_ids]
+    index = np.array([(blob_id, array.nbytes) for blob_id, array in zip(blob_ids, arrays)], dtype=INDEX_DTYPE)
+    return b''.join([np.array([len(blob_ids)], dtype=HEADER_DTYPE).tobytes(), index.tobytes()] +
+                    [array.tobytes() for array in arrays])
+
+
+def encode_model(layers):
+    # Minimal model.espresso.net and model.espresso.weights contents for {layer: {'weights', 'bias'}},
+    # enough for read_compiled_weights; blob ids are assigned in layer order starting at 1
+    net_layers, blobs = [], {}
+    for name, params in layers.items():
+        weights_id, bias_id = len(blobs) + 1, len(blobs) + 2
+        blobs[weights_id], blobs[bias_id] = params['weights'], params['bias']
+        net_layers.append({'name': name, 'type': 'inner_product', 'blob_weights': weights_id, 'blob_biases': bias_id})
+    return json.dumps({'layers': net_layers}).encode(), encode_weights(blobs)
+
+
+def write_model(mlmodelc_path, layers):
+    os.makedirs(mlmodelc_path, exist_ok=True)
+    net, weights = encode_model(layers)
+    with open(os.path.join(mlmodelc_path, NET_FILE), 'wb') as f:
+        f.write(net)
+    with open(os.path.join(mlmodelc_path, WEIGHTS_FILE), 'wb') as f:
+        f.write(weights)
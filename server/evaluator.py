@@ -0,0 +1,60 @@
+import time
+
+import coremltools as ct
+import numpy as np
+
+from metrics_store import classification_report
+from model_writer import embedding_shape, find_embedding_layer, layer_fields
+
+
+def softmax(logits):
+    shifted = logits - logits.max(axis=1, keepdims=True)
+    exp = np.exp(shifted)
+    return exp / exp.sum(axis=1, keepdims=True)
+
+
+class NumpyEvaluator:
+    # Runs the served architecture (embedding -> flatten -> dense1 + ReLU -> output -> softmax) as
+    # plain NumPy matmuls. The embedding is read from the base spec once and replaced by the one in
+    # the evaluated weights when those carry it; the two dense layers come from whichever model
+    # version is evaluated, in the spec's innerProduct [out, in] layout.
+    def __init__(self, base_model_path, dense_layers, batch_size=500):
+        spec = ct.utils.load_spec(base_model_path)
+        self.dense_layers = dense_layers
+        self.batch_size = batch_size
+        layer = find_embedding_layer(spec)
+        self.embedding_layer = layer.name
+        self.embedding_shape = embedding_shape(layer)
+        self.embedding = self.gather_table(dict(layer_fields(layer))["weights"].floatValue)
+
+    def gather_table(self, values):
+        # Stored as (embedding size, vocab size); gathered by token id, so keep it (vocab, embedding)
+        return np.ascontiguousarray(np.asarray(values, dtype=np.float32).reshape(self.embedding_shape).T)
+
+    def predict_proba(self, weights, inputs):
+        embedding = self.embedding
+        if self.embedding_layer in weights:
+            embedding = self.gather_table(weights[self.embedding_layer]["weights"])
+        hidden_layer, output_layer = self.dense_layers
+        w1 = np.asarray(weights[hidden_layer]["weights"], dtype=np.float32)
+        b1 = np.asarray(weights[hidden_layer]["bias"], dtype=np.float32)
+        w2 = np.asarray(weights[output_layer]["weights"], dtype=np.float32)
+        b2 = np.asarray(weights[output_layer]["bias"], dtype=np.float32)
+        w1 = w1.reshape(b1.size, -1)
+        w2 = w2.reshape(b2.size, -1)
+
+        probs = np.empty((len(inputs), b2.size), dtype=np.float32)
+        for start in range(0, len(inputs), self.batch_size):
+            tokens = np.asarray(inputs[start:start + self.batch_size])
+            # Flatten keeps (position, embedding) order, as Keras' Flatten does
+            flat = embedding[tokens].reshape(len(tokens), -1)
+            hidden = np.maximum(flat @ w1.T + b1, 0)
+            probs[start:start + len(tokens)] = softmax(hidden @ w2.T + b2)
+        return probs
+
+    def evaluate(self, weights, inputs, labels, client_id="server", round_number=0):
+        # A /report_metrics style record for the positive class, timed like the on-device evaluation
+        start = time.perf_counter()
+        probs = self.predict_proba(weights, inputs)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        return classification_report(client_id, round_number, np.asarray(labels), probs[:, 1], elapsed_ms)
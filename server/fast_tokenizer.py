@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
+
+import numpy as np
+
+# Defaults of tf.keras.preprocessing.text.Tokenizer, which the shipped tokenizer.json was built with
+KERAS_FILTERS = '!"#$%&()*+,-./:;<=>?@[\\]^_`{|}~\t\n'
+
+# Word ids kept by the worker processes of a parallel encode, set once by _init_worker
+_worker_index = None
+
+
+def _init_worker(index, table, split, lower):
+    global _worker_index
+    _worker_index = (index, table, split, lower)
+
+
+def _encode_chunk(texts):
+    return _encode(texts, *_worker_index)
+
+
+def _encode(texts, index, table, split, lower):
+    # Every text becomes its kept word ids; returns them flattened plus the per-text lengths
+    lookup = index.get
+    sequences = []
+    for text in texts:
+        if lower:
+            text = text.lower()
+        sequences.append([i for i in map(lookup, text.translate(table).split(split)) if i is not None])
+    lengths = np.fromiter(map(len, sequences), dtype=np.int64, count=len(sequences))
+    flat = np.fromiter(chain.from_iterable(sequences), dtype=np.int32, count=int(lengths.sum()))
+    return flat, lengths
+
+
+def pad_flat(flat, lengths, maxlen):
+    # pad_sequences(..., maxlen) with Keras' 'pre' padding and truncation, for all rows in one go:
+    # each row keeps its last maxlen ids, right-aligned, zeros in front
+    kept = np.minimum(lengths, maxlen)
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1])) + lengths - kept
+    rows = np.repeat(np.arange(len(lengths)), kept)
+    within = np.arange(int(kept.sum())) - np.repeat(np.cumsum(kept) - kept, kept)
+    padded = np.zeros((len(lengths), maxlen), dtype=np.int32)
+    padded[rows, maxlen - kept[rows] + within] = flat[np.repeat(starts, kept) + within]
+    return padded
+
+
+class FastTokenizer:
+    # Drop-in for the subset of the Keras Tokenizer the server uses. Words are split exactly like
+    # text_to_word_sequence (lowercase, filters mapped to the split character, empty strings dropped)
+    # and ranked by count with ties in first-seen order, so word_index and the encodings match Keras.
+    # Ids at or above num_words are dropped, as Keras does without an oov_token.
+    def __init__(self, num_words=None, filters=KERAS_FILTERS, lower=True, split=' ', word_index=None):
+        self.num_words = num_words
+        self.filters = filters
+        self.lower = lower
+        self.split = split
+        self.table = str.maketrans({c: split for c in filters})
+        self.word_index = word_index or {}
+
+    def fit_on_texts(self, texts):
+        # Fits from scratch in one pass over the joined corpus; joining on the split character
+        # cannot merge two words
+        corpus = self.split.join(texts)
+        if self.lower:
+            corpus = corpus.lower()
+        counts = Counter(filter(None, corpus.translate(self.table).split(self.split)))
+        ranked = sorted(counts.items(), key=lambda item: item[1], reverse=True)
+        self.word_index = {word: i for i, (word, _) in enumerate(ranked, start=1)}
+
+    def to_json(self):
+        # Same bytes create_pretrained_model used to write with json.dump
+        return json.dumps({"word_index": self.word_index})
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            f.write(self.to_json())
+
+    @classmethod
+    def load(cls, path, num_words=None, **options):
+        with open(path, 'r') as f:
+            return cls(num_words=num_words, word_index=json.load(f)["word_index"], **options)
+
+    @property
+    def hash(self):
+        settings = json.dumps([self.num_words, self.filters, self.lower, self.split])
+        return hashlib.sha256(settings.encode('utf-8') + self.to_json().encode('utf-8')).hexdigest()[:16]
+
+    def _kept_index(self):
+        if self.num_words is None:
+            return self.word_index
+        return {word: i for word, i in self.word_index.items() if i < self.num_words}
+
+    def texts_to_padded(self, texts, maxlen, workers=1):
+        # texts_to_sequences + pad_sequences(maxlen=maxlen) as one int32 matrix
+        texts = list(texts)
+        index = self._kept_index()
+        if workers <= 1 or len(texts) < 1000:
+            flat, lengths = _encode(texts, index, self.table, self.split, self.lower)
+        else:
+            chunk = -(-len(texts) // (workers * 4))
+            chunks = [texts[i:i + chunk] for i in range(0, len(texts), chunk)]
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                     initargs=(index, self.table, self.split, self.lower)) as pool:
+                results = list(pool.map(_encode_chunk, chunks))
+            flat = np.concatenate([flat for flat, _ in results])
+            lengths = np.concatenate([lengths for _, lengths in results])
+        return pad_flat(flat, lengths, maxlen)
+
+    def encoding_path(self, cache_dir, name, maxlen):
+        return os.path.join(cache_dir, self.hash, f"{name}_{maxlen}.npy")
+
+    def encode_cached(self, texts, maxlen, cache_dir, name, workers=1):
+        # The padded matrix is stored as .npy under the tokenizer hash and returned memory-mapped
+        path = self.encoding_path(cache_dir, name, maxlen)
+        if not os.path.exists(path):
+            save_encoding(path, self.texts_to_padded(texts, maxlen, workers))
+        return np.load(path, mmap_mode='r')
+
+
+def save_encoding(path, padded):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp.npy'
+    np.save(tmp_path, np.asarray(padded, dtype=np.int32))
+    os.replace(tmp_path, path)
@@ -0,0 +1,157 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+import numpy as np
+
+from loadtest import synthetic_model_zip
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+
+
+def call(url, method="GET", body=None, headers=None, timeout=120):
+    # (status, headers, body) of one request; HTTP errors are returned rather than raised
+    request = urllib.request.Request(url, data=body, method=method, headers=headers or {})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status, response.headers, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers, e.read()
+
+
+def start_server(name, port, workdir, env):
+    # Every server gets its own working directory for uploads, models and the model store
+    server_dir = os.path.join(workdir, name)
+    os.makedirs(server_dir)
+    log = open(os.path.join(server_dir, "server.log"), "w")
+    process = subprocess.Popen([sys.executable, SERVER_SCRIPT], cwd=server_dir, stdout=log, stderr=subprocess.STDOUT,
+                               env=dict(os.environ, FL_PORT=str(port), **env))
+    return {"name": name, "url": f"http://127.0.0.1:{port}", "process": process, "log": log.name}
+
+
+def wait_until_up(server, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if server["process"].poll() is not None:
+            raise RuntimeError(f"{server['name']} exited, see {server['log']}")
+        try:
+            if call(f"{server['url']}/round_status", timeout=5)[0] == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(1)
+    raise RuntimeError(f"{server['name']} did not come up within {timeout}s, see {server['log']}")
+
+
+def upload(server, client_id, model_zip, num_samples):
+    status, _, body = call(f"{server['url']}/upload", "POST", model_zip, {
+        "Content-Type": "application/zip", "Sample-Count": str(num_samples), "Client-Id": client_id})
+    if status != 202:
+        raise RuntimeError(f"Upload of {client_id} to {server['name']} failed with {status}: {body[:200]!r}")
+    return json.loads(body)["status_url"]
+
+
+def wait_for_uploads(pending, timeout):
+    deadline = time.time() + timeout
+    for server, status_url in pending:
+        while True:
+            status = json.loads(call(f"{server['url']}{status_url}")[2]).get("status")
+            if status == "done":
+                break
+            if status not in ("queued", "processing") or time.time() > deadline:
+                raise RuntimeError(f"Upload {status_url} on {server['name']} ended as {status}")
+            time.sleep(0.2)
+
+
+def model_version(server):
+    status, headers, _ = call(f"{server['url']}/download", "HEAD")
+    return headers.get("Model-Version") if status == 200 else None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run a root and several edge servers as local processes, send every client to one edge, and "
+                    "check that the root publishes the same model as a single flat server given all clients. "
+                    "Run app.py once beforehand so every process reuses the cached artifacts.")
+    parser.add_argument("--edges", type=int, default=3)
+    parser.add_argument("--clients", type=int, default=12)
+    parser.add_argument("--base-port", type=int, default=5100, help="root port; edges and the flat server follow")
+    parser.add_argument("--startup-timeout", type=float, default=600)
+    parser.add_argument("--sync-timeout", type=float, default=120)
+    parser.add_argument("--keep", action="store_true", help="keep the servers' working directories")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="fl_hierarchy_")
+    artifact_dir = os.path.abspath(os.environ.get("FL_ARTIFACT_DIR",
+                                                  os.path.join(os.path.dirname(SERVER_SCRIPT), "artifacts")))
+    # Rounds are only ever triggered explicitly, except on the root, which publishes once every edge has pushed
+    manual = str(10 ** 9)
+    common = {"FL_ARTIFACT_DIR": artifact_dir, "FL_EVALUATE": "0"}
+    root = start_server("root", args.base_port, workdir, dict(common, FL_ROLE="root", FL_ROUND_QUORUM=str(args.edges)))
+    edges = [start_server(f"edge-{i}", args.base_port + 1 + i, workdir,
+                          dict(common, FL_ROLE="edge", FL_ROOT_URL=root["url"], FL_EDGE_ID=f"edge-{i}",
+                               FL_ROUND_QUORUM=manual))
+             for i in range(args.edges)]
+    flat = start_server("flat", args.base_port + 1 + args.edges, workdir, dict(common, FL_ROUND_QUORUM=manual))
+    servers = [root, *edges, flat]
+    print(f"Started root, {args.edges} edges and a flat server under {workdir}")
+
+    passed = False
+    try:
+        for server in servers:
+            wait_until_up(server, args.startup_timeout)
+
+        rng = np.random.default_rng(args.seed)
+        pending = []
+        for i in range(args.clients):
+            model_zip = synthetic_model_zip(rng)
+            num_samples = int(rng.integers(1, 500))
+            client_id = f"client-{i}"
+            pending.append((edges[i % args.edges], upload(edges[i % args.edges], client_id, model_zip, num_samples)))
+            pending.append((flat, upload(flat, client_id, model_zip, num_samples)))
+        wait_for_uploads(pending, args.sync_timeout)
+        print(f"Uploaded {args.clients} clients to the edges and to the flat server")
+
+        start = time.perf_counter()
+        for edge in edges:
+            status, _, body = call(f"{edge['url']}/aggregate?force=1&wait={args.sync_timeout}", "POST")
+            print(f"{edge['name']}: {status} {body.decode(errors='replace').strip()}")
+        call(f"{root['url']}/round_status?after=0&wait=60")
+        call(f"{flat['url']}/aggregate?force=1&wait={args.sync_timeout}", "POST")
+        root_version, flat_version = model_version(root), model_version(flat)
+        print(f"root published {root_version} in {time.perf_counter() - start:.2f}s, flat published {flat_version}")
+
+        # Edges pick the new version up from the root in the background
+        deadline = time.time() + args.sync_timeout
+        edge_versions = [model_version(edge) for edge in edges]
+        while any(version != root_version for version in edge_versions) and time.time() < deadline:
+            time.sleep(0.5)
+            edge_versions = [model_version(edge) for edge in edges]
+        for edge, version in zip(edges, edge_versions):
+            print(f"{edge['name']} serves {version}")
+
+        passed = (root_version is not None and root_version == flat_version
+                  and all(version == root_version for version in edge_versions))
+        print("✅ Hierarchical aggregation matches flat fedavg" if passed else "❌ Versions differ")
+    finally:
+        for server in servers:
+            server["process"].terminate()
+        for server in servers:
+            server["process"].wait()
+        if args.keep or not passed:
+            print(f"Server directories and logs kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == "__main__":
+    main()
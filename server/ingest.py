@@ -0,0 +1,105 @@
+import itertools
+import threading
+import time
+import uuid
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class UploadIngestor:
+    # Runs process_fn(upload_id, client_id, payload) for accepted uploads on a bounded worker pool,
+    # so request threads only have to get the bytes onto disk. Uploads from one client are applied
+    # one at a time and in arrival order; an upload overtaken by a newer one from the same client is
+    # skipped and handed to discard_fn(payload) instead.
+    def __init__(self, process_fn, discard_fn=None, max_workers=4, max_tracked=10000):
+        self.process_fn = process_fn
+        self.discard_fn = discard_fn
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ingest')
+        self.max_tracked = max_tracked
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.unfinished = defaultdict(int)
+        self.statuses = OrderedDict()
+        self.client_locks = defaultdict(threading.Lock)
+        self.latest_seq = {}
+        self.sequence = itertools.count(1)
+
+    def _set_status(self, upload_id, **fields):
+        with self.lock:
+            # Entries past max_tracked are evicted, possibly while their upload is still being processed
+            status = self.statuses.get(upload_id)
+            if status is not None:
+                status.update(fields, updated_at=time.time())
+
+    def submit(self, client_id, payload, **info):
+        upload_id = uuid.uuid4().hex
+        with self.lock:
+            seq = next(self.sequence)
+            self.latest_seq[client_id] = seq
+            self.unfinished[client_id] += 1
+            self.statuses[upload_id] = dict(info, upload_id=upload_id, client_id=client_id, status='queued',
+                                            received_at=time.time(), updated_at=time.time())
+            while len(self.statuses) > self.max_tracked:
+                self.statuses.popitem(last=False)
+        self.executor.submit(self._run, upload_id, seq, client_id, payload)
+        return upload_id
+
+    def run_inline(self, client_id, fn):
+        # Runs fn() on the calling thread, ordered with this client's uploads as if it were one more of
+        # them: it waits for the one being processed, and the ones still queued are superseded
+        with self.lock:
+            self.latest_seq[client_id] = next(self.sequence)
+        with self.client_locks[client_id]:
+            return fn()
+
+    def wait_for_client(self, client_id, timeout):
+        # Waits until every upload submitted for client_id so far is done, failed or superseded
+        end = time.time() + timeout
+        with self.idle:
+            while self.unfinished.get(client_id):
+                remaining = end - time.time()
+                if remaining <= 0:
+                    return False
+                self.idle.wait(remaining)
+            return True
+
+    def _run(self, upload_id, seq, client_id, payload):
+        try:
+            self._process(upload_id, seq, client_id, payload)
+        finally:
+            with self.idle:
+                self.unfinished[client_id] -= 1
+                if not self.unfinished[client_id]:
+                    del self.unfinished[client_id]
+                self.idle.notify_all()
+
+    def _process(self, upload_id, seq, client_id, payload):
+        with self.client_locks[client_id]:
+            with self.lock:
+                superseded = self.latest_seq.get(client_id, seq) > seq
+            if superseded:
+                self._set_status(upload_id, status='superseded')
+                if self.discard_fn is not None:
+                    self.discard_fn(payload)
+                return
+            self._set_status(upload_id, status='processing')
+            try:
+                message = self.process_fn(upload_id, client_id, payload)
+                self._set_status(upload_id, status='done', message=message)
+            except Exception as e:
+                print(f"❌ Failed to ingest upload {upload_id} from {client_id}: {e}")
+                self._set_status(upload_id, status='failed', error=str(e))
+                if self.discard_fn is not None:
+                    self.discard_fn(payload)
+
+    def status(self, upload_id):
+        with self.lock:
+            status = self.statuses.get(upload_id)
+            return dict(status) if status is not None else None
+
+    def counts(self):
+        with self.lock:
+            counts = defaultdict(int)
+            for status in self.statuses.values():
+                counts[status['status']] += 1
+            return dict(counts)
@@ -0,0 +1,143 @@
+import bisect
+import cProfile
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency bucket upper bounds in seconds, from sub-millisecond handlers to multi-minute rounds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+class Histogram:
+    # Cumulative-on-render bucket counts plus sum and count, as a Prometheus histogram
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f"{name}_bucket{format_labels(dict(labels, le=le))} {cumulative}")
+        lines.append(f"{name}_sum{format_labels(labels)} {self.sum}")
+        lines.append(f"{name}_count{format_labels(labels)} {self.count}")
+        return lines
+
+
+class Stats:
+    # In-process counters, histograms and gauges, rendered in the Prometheus text format. Every update
+    # is a dict lookup and a few additions under one lock, cheap enough to leave on for every request.
+    def __init__(self, prefix='fl'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.help = {}
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def gauge(self, name, read):
+        # read() is called at render time and returns a number or a {labels tuple: number} dict
+        self.gauges[name] = read
+
+    def _header(self, lines, name, kind):
+        full_name = f"{self.prefix}_{name}"
+        if name in self.help:
+            lines.append(f"# HELP {full_name} {self.help[name]}")
+        lines.append(f"# TYPE {full_name} {kind}")
+        return full_name
+
+    def render(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: (list(h.counts), h.sum, h.count) for key, h in self.histograms.items()}
+
+        lines = []
+        for name in sorted({name for name, _ in counters}):
+            full_name = self._header(lines, name, 'counter')
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{full_name}{format_labels(dict(labels))} {value}")
+        for name in sorted({name for name, _ in histograms}):
+            full_name = self._header(lines, name, 'histogram')
+            for (metric, labels), (counts, total, count) in sorted(histograms.items()):
+                if metric == name:
+                    snapshot = Histogram()
+                    snapshot.counts, snapshot.sum, snapshot.count = counts, total, count
+                    lines.extend(snapshot.render(full_name, dict(labels)))
+        for name, read in sorted(self.gauges.items()):
+            try:
+                value = read()
+            except Exception:
+                continue
+            full_name = self._header(lines, name, 'gauge')
+            values = value.items() if isinstance(value, dict) else [((), value)]
+            for labels, number in values:
+                lines.append(f"{full_name}{format_labels(dict(labels))} {float(number)}")
+        return '\n'.join(lines) + '\n'
+
+
+class RoundProfiler:
+    # cProfile of one aggregation in every `every`, dumped as <dir>/round_<n>.prof for pstats or snakeviz.
+    # every=0 disables it, so the profiler costs nothing unless switched on.
+    def __init__(self, every=0, out_dir='./profiles'):
+        self.every = every
+        self.out_dir = out_dir
+        self.calls = 0
+
+    @contextmanager
+    def profile(self, round_number):
+        self.calls += 1
+        if not self.every or (self.calls - 1) % self.every:
+            yield None
+            return
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield profiler
+        finally:
+            profiler.disable()
+            os.makedirs(self.out_dir, exist_ok=True)
+            path = os.path.join(self.out_dir, f"round_{round_number}.prof")
+            profiler.dump_stats(path)
+            print(f"✅ Profile of round {round_number} written to {path}")
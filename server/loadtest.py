@@ -0,0 +1,251 @@
+import argparse
+import hashlib
+import http.client
+import io
+import json
+import os
+import random
+import threading
+import time
+import zipfile
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+import numpy as np
+
+from espresso import NET_FILE, WEIGHTS_FILE, encode_model
+
+# Shapes of the updatable layers of the served model (MAX_LEN * EMBED_DIM -> 64 -> 2)
+LAYER_SHAPES = {
+    "sequential/dense1/BiasAdd": (12800 * 64, 64),
+    "sequential/output/BiasAdd": (64 * 2, 2),
+}
+
+
+def synthetic_model_zip(rng, scale=0.05):
+    # A zipped .mlmodelc with just the espresso files read_compiled_weights parses
+    layers = {
+        name: {
+            "weights": (rng.standard_normal(num_weights) * scale).astype(np.float32),
+            "bias": (rng.standard_normal(num_bias) * scale).astype(np.float32),
+        }
+        for name, (num_weights, num_bias) in LAYER_SHAPES.items()
+    }
+    net, weights = encode_model(layers)
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+        archive.writestr(f"model.mlmodelc/{NET_FILE}", net)
+        archive.writestr(f"model.mlmodelc/{WEIGHTS_FILE}", weights)
+    return buffer.getvalue()
+
+
+def synthetic_report(rng, client_id, round_number):
+    tp, tn, fp, fn = (int(x) for x in rng.integers(0, 500, 4))
+    confidence = np.sort(rng.uniform(0.5, 1.0, 3))
+    return {
+        "client_id": client_id, "round": round_number,
+        "accuracy": float(rng.uniform(0.6, 0.9)), "precision": float(rng.uniform(0.6, 0.9)),
+        "recall": float(rng.uniform(0.6, 0.9)), "f1_score": float(rng.uniform(0.6, 0.9)),
+        "log_loss": float(rng.uniform(0.2, 0.7)),
+        "confusion_matrix": {"tp": tp, "tn": tn, "fp": fp, "fn": fn},
+        "evaluation_time_ms": float(rng.uniform(50, 500)),
+        "prediction_confidence": {"average": confidence[1], "min": confidence[0], "max": confidence[2]},
+        "per_class_precision": {"class_0": float(rng.uniform(0.6, 0.9)), "class_1": float(rng.uniform(0.6, 0.9))},
+        "per_class_recall": {"class_0": float(rng.uniform(0.6, 0.9)), "class_1": float(rng.uniform(0.6, 0.9))},
+    }
+
+
+class Recorder:
+    # Latency, status and byte counts per endpoint, shared by every client thread
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.bytes_out = defaultdict(int)
+        self.bytes_in = defaultdict(int)
+
+    def add(self, endpoint, latency, status, sent, received):
+        with self.lock:
+            self.latencies[endpoint].append(latency)
+            self.statuses[endpoint][status] += 1
+            self.bytes_out[endpoint] += sent
+            self.bytes_in[endpoint] += received
+
+
+class Client:
+    def __init__(self, index, base_url, recorder, source_address=None, timeout=120):
+        parts = urlsplit(base_url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.client_id = f"loadtest-{index}"
+        self.rng = np.random.default_rng(index)
+        self.recorder = recorder
+        self.source_address = source_address
+        self.timeout = timeout
+
+    def request(self, endpoint, method, path, body=None, headers=None):
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout,
+                                                source_address=self.source_address)
+        start = time.perf_counter()
+        status, data = None, b""
+        try:
+            connection.request(method, path, body=body, headers={"Client-Id": self.client_id, **(headers or {})})
+            response = connection.getresponse()
+            status, data = response.status, response.read()
+        except OSError as e:
+            status = type(e).__name__
+        finally:
+            connection.close()
+            self.recorder.add(endpoint, time.perf_counter() - start, status, len(body or b""), len(data))
+        return status, data
+
+    def upload_resumable(self, model_zip, num_samples, chunk_size):
+        # Initiates a resumable upload and sends whatever ranges the server reports missing
+        status, data = self.request("uploads", "POST", "/uploads", headers={
+            "Upload-Length": str(len(model_zip)), "Upload-Sha256": hashlib.sha256(model_zip).hexdigest(),
+            "Sample-Count": str(num_samples)})
+        if status not in (200, 201) or "chunk_url" not in json.loads(data):
+            return status, data
+        state = json.loads(data)
+        for start, end in state["missing"]:
+            for offset in range(start, end, chunk_size):
+                chunk = model_zip[offset:min(offset + chunk_size, end)]
+                status, data = self.request("uploads chunk", "PUT", state["chunk_url"], chunk, {
+                    "Content-Type": "application/octet-stream", "Upload-Offset": str(offset)})
+        return status, data
+
+    def run_round(self, round_number, num_samples, aggregate_wait, poll_interval, chunk_size=None):
+        self.request("get_train_data", "GET", "/get_train_data")
+
+        model_zip = synthetic_model_zip(self.rng)
+        if chunk_size:
+            status, data = self.upload_resumable(model_zip, num_samples, chunk_size)
+        else:
+            status, data = self.request("upload", "POST", "/upload", model_zip, {
+                "Content-Type": "application/zip", "Sample-Count": str(num_samples)})
+        if status == 202:
+            # Ingestion runs in the background; wait until this upload is folded in
+            status_url = json.loads(data)["status_url"]
+            start = time.perf_counter()
+            while True:
+                _, data = self.request("upload_status", "GET", status_url)
+                if json.loads(data or b"{}").get("status") not in ("queued", "processing"):
+                    break
+                time.sleep(poll_interval)
+            self.recorder.add("ingest (end to end)", time.perf_counter() - start, "done", 0, 0)
+
+        self.request("aggregate", "POST", f"/aggregate?wait={aggregate_wait}")
+        self.request("download", "GET", "/download")
+        self.request("report_metrics", "POST", "/report_metrics",
+                     json.dumps(synthetic_report(self.rng, self.client_id, round_number)).encode(),
+                     {"Content-Type": "application/json"})
+
+
+def read_rss_bytes(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+def disk_usage(paths):
+    total = 0
+    for path in paths:
+        if os.path.isfile(path):
+            total += os.path.getsize(path)
+        for root, _, files in os.walk(path):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+    return total
+
+
+class ResourceSampler(threading.Thread):
+    # Samples the server's resident memory while the load runs; needs /proc, so Linux only
+    def __init__(self, pid, interval=0.5):
+        super().__init__(daemon=True)
+        self.pid, self.interval = pid, interval
+        self.peak_rss = self.start_rss = read_rss_bytes(pid)
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            rss = read_rss_bytes(self.pid)
+            if rss is not None:
+                self.peak_rss = max(self.peak_rss or 0, rss)
+
+
+def print_report(recorder, elapsed):
+    print(f"{'endpoint':>20} {'requests':>9} {'req/s':>8} {'p50_ms':>9} {'p99_ms':>9} {'MB_out':>8} {'MB_in':>8}  statuses")
+    for endpoint, latencies in recorder.latencies.items():
+        p50, p99 = np.percentile(np.array(latencies) * 1000, [50, 99])
+        statuses = ", ".join(f"{status}:{count}" for status, count in recorder.statuses[endpoint].items())
+        print(f"{endpoint:>20} {len(latencies):>9} {len(latencies) / elapsed:>8.1f} {p50:>9.1f} {p99:>9.1f} "
+              f"{recorder.bytes_out[endpoint] / 1e6:>8.1f} {recorder.bytes_in[endpoint] / 1e6:>8.1f}  {statuses}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive simulated clients through the server's round trip on localhost")
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--samples", type=int, default=50, help="Sample-Count sent with each upload")
+    parser.add_argument("--aggregate-wait", type=float, default=60)
+    parser.add_argument("--poll-interval", type=float, default=0.2)
+    parser.add_argument("--server-pid", type=int, help="server process to sample RSS from")
+    parser.add_argument("--server-dir", default=os.path.dirname(os.path.abspath(__file__)),
+                        help="server working directory, for disk usage")
+    parser.add_argument("--distinct-addresses", action=argparse.BooleanOptionalAction, default=False,
+                        help="give each client its own 127.x.y.z source address, for servers that tell clients "
+                             "apart by remote address rather than the Client-Id header")
+    parser.add_argument("--chunk-size", type=int, help="send models through the resumable /uploads protocol "
+                                                        "in chunks of this many bytes instead of one /upload")
+    args = parser.parse_args()
+
+    recorder = Recorder()
+    clients = []
+    for i in range(args.clients):
+        source = (f"127.1.{i // 250}.{i % 250 + 1}", 0) if args.distinct_addresses else None
+        clients.append(Client(i, args.url, recorder, source))
+
+    disk_paths = [os.path.join(args.server_dir, name)
+                  for name in ("uploads", "models", "model_store", "metrics.db", "clients.jsonl")]
+    disk_before = disk_usage(disk_paths)
+    sampler = ResourceSampler(args.server_pid) if args.server_pid else None
+    if sampler is not None:
+        sampler.start()
+
+    # Clients start each round together, like a fleet answering the same round
+    barrier = threading.Barrier(args.clients)
+
+    def run_client(client):
+        for round_number in range(1, args.rounds + 1):
+            barrier.wait()
+            time.sleep(random.uniform(0, 0.05))
+            client.run_round(round_number, args.samples, args.aggregate_wait, args.poll_interval, args.chunk_size)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=run_client, args=(client,)) for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    print(f"{args.clients} clients x {args.rounds} rounds in {elapsed:.1f}s")
+    print_report(recorder, elapsed)
+    if sampler is not None and sampler.peak_rss is None:
+        print(f"server RSS: unavailable for pid {args.server_pid}")
+    elif sampler is not None:
+        sampler.stopped.set()
+        print(f"server RSS: start {sampler.start_rss / 1e6:.1f} MB, peak {sampler.peak_rss / 1e6:.1f} MB")
+    print(f"server disk: {disk_before / 1e6:.1f} MB before, {disk_usage(disk_paths) / 1e6:.1f} MB after")
+
+
+if __name__ == "__main__":
+    main()
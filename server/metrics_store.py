@@ -0,0 +1,168 @@
+import atexit
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+# Flattened /report_metrics schema: (column, path into the JSON report, SQLite type). Nested dicts
+# sent by the app become one typed column per field, so nothing has to be parsed back later.
+CLIENT_REPORT_COLUMNS = [
+    ("client_id", ("client_id",), "TEXT"),
+    ("round", ("round",), "INTEGER"),
+    ("accuracy", ("accuracy",), "REAL"),
+    ("precision", ("precision",), "REAL"),
+    ("recall", ("recall",), "REAL"),
+    ("f1_score", ("f1_score",), "REAL"),
+    ("log_loss", ("log_loss",), "REAL"),
+    ("tp", ("confusion_matrix", "tp"), "INTEGER"),
+    ("tn", ("confusion_matrix", "tn"), "INTEGER"),
+    ("fp", ("confusion_matrix", "fp"), "INTEGER"),
+    ("fn", ("confusion_matrix", "fn"), "INTEGER"),
+    ("evaluation_time_ms", ("evaluation_time_ms",), "REAL"),
+    ("confidence_avg", ("prediction_confidence", "average"), "REAL"),
+    ("confidence_min", ("prediction_confidence", "min"), "REAL"),
+    ("confidence_max", ("prediction_confidence", "max"), "REAL"),
+    ("precision_class_0", ("per_class_precision", "class_0"), "REAL"),
+    ("precision_class_1", ("per_class_precision", "class_1"), "REAL"),
+    ("recall_class_0", ("per_class_recall", "class_0"), "REAL"),
+    ("recall_class_1", ("per_class_recall", "class_1"), "REAL"),
+]
+
+MODEL_METRIC_COLUMNS = [
+    ("model_version", ("model_version",), "TEXT"),
+    ("accuracy", ("accuracy",), "REAL"),
+    ("loss", ("loss",), "REAL"),
+]
+
+# The server's own evaluation of each aggregated version, in the client report schema
+SERVER_EVALUATION_COLUMNS = [("model_version", ("model_version",), "TEXT")] + CLIENT_REPORT_COLUMNS[1:]
+
+TABLES = {
+    "client_reports": (CLIENT_REPORT_COLUMNS, ["round", "client_id"]),
+    "model_metrics": (MODEL_METRIC_COLUMNS, ["model_version"]),
+    "server_evaluations": (SERVER_EVALUATION_COLUMNS, ["round", "model_version"]),
+}
+
+CASTS = {"TEXT": str, "INTEGER": int, "REAL": float}
+
+
+def flatten(report, columns):
+    # Raises KeyError/TypeError/ValueError when a field is missing or has the wrong type
+    row = []
+    for _, path, sql_type in columns:
+        value = report
+        for key in path:
+            value = value[key]
+        row.append(CASTS[sql_type](value))
+    return row
+
+
+class MetricsSink:
+    # Buffers metric rows in memory and writes them to SQLite in batches, from a single background
+    # thread, when batch_size rows are waiting or flush_interval seconds have passed. Request threads
+    # only append to a list; the database is opened once and written in one transaction per batch.
+    def __init__(self, path, batch_size=500, flush_interval=2.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.buffers = {table: [] for table in TABLES}
+        self.write_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self._create_schema()
+        self.thread = threading.Thread(target=self._run, name='metrics-sink', daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def _create_schema(self):
+        with self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            for table, (columns, indexes) in TABLES.items():
+                definitions = ", ".join(f'"{name}" {sql_type}' for name, _, sql_type in columns)
+                self.connection.execute(
+                    f'CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY, received_at REAL, {definitions})')
+                for column in indexes:
+                    self.connection.execute(
+                        f'CREATE INDEX IF NOT EXISTS {table}_{column} ON {table} ("{column}")')
+
+    def record(self, table, report):
+        row = [time.time()] + flatten(report, TABLES[table][0])
+        with self.lock:
+            buffer = self.buffers[table]
+            buffer.append(row)
+            full = len(buffer) >= self.batch_size
+        if full:
+            self.wakeup.set()
+
+    def _write_batches(self):
+        with self.write_lock:
+            with self.lock:
+                batches = {table: rows for table, rows in self.buffers.items() if rows}
+                self.buffers = {table: [] for table in TABLES}
+            if not batches:
+                return 0
+            with self.connection:
+                for table, rows in batches.items():
+                    names = ", ".join(f'"{name}"' for name, _, _ in TABLES[table][0])
+                    placeholders = ", ".join("?" * (len(TABLES[table][0]) + 1))
+                    self.connection.executemany(
+                        f"INSERT INTO {table} (received_at, {names}) VALUES ({placeholders})", rows)
+            return sum(len(rows) for rows in batches.values())
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self._write_batches()
+            except sqlite3.Error as e:
+                print(f"❌ Failed to write metrics batch: {e}")
+
+    def flush(self):
+        # Writes everything recorded so far from the calling thread, e.g. before reading or at exit
+        return self._write_batches()
+
+    def query(self, sql, params=()):
+        # Reads on a separate connection; WAL lets them run alongside the batch writer
+        connection = sqlite3.connect(self.path)
+        try:
+            return connection.execute(sql, params).fetchall()
+        finally:
+            connection.close()
+
+
+def classification_report(client_id, round_number, labels, positive_probs, evaluation_time_ms):
+    # A /report_metrics record for binary predictions. The overall metrics, confusion matrix and log
+    # loss follow the app's on-device evaluation. class_0 precision and recall are the real tn-based
+    # figures, while the app always reports 0 for them (it never counts class 0 true positives), so only
+    # class_1 per-class values compare with on-device reports.
+    labels = np.asarray(labels)
+    probs = np.asarray(positive_probs, dtype=np.float64)
+    predicted = (probs >= 0.5).astype(labels.dtype)
+    tp = int(np.sum((predicted == 1) & (labels == 1)))
+    tn = int(np.sum((predicted == 0) & (labels == 0)))
+    fp = int(np.sum((predicted == 1) & (labels == 0)))
+    fn = int(np.sum((predicted == 0) & (labels == 1)))
+
+    def ratio(a, b):
+        return a / b if b else 0.0
+
+    precision, recall = ratio(tp, tp + fp), ratio(tp, tp + fn)
+    clipped = np.clip(probs, 1e-15, 1 - 1e-15)
+    return {
+        "client_id": client_id,
+        "round": round_number,
+        "accuracy": ratio(tp + tn, len(labels)),
+        "precision": precision,
+        "recall": recall,
+        "f1_score": ratio(2 * precision * recall, precision + recall),
+        "log_loss": float(-np.mean(labels * np.log(clipped) + (1 - labels) * np.log(1 - clipped))),
+        "confusion_matrix": {"tp": tp, "tn": tn, "fp": fp, "fn": fn},
+        "evaluation_time_ms": evaluation_time_ms,
+        "prediction_confidence": {"average": float(probs.mean()), "min": float(probs.min()), "max": float(probs.max())},
+        "per_class_precision": {"class_0": ratio(tn, tn + fn), "class_1": precision},
+        "per_class_recall": {"class_0": ratio(tn, tn + fp), "class_1": recall},
+    }
@@ -0,0 +1,109 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from payloads import EncodedPayload
+
+MODEL_MIMETYPE = 'application/octet-stream'
+DEFAULT_CACHE_SIZE = 4
+
+
+def write_atomic(path, data):
+    # Readers see either the previous file or the complete new one, never a partial write
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def content_version(data):
+    # Same digest as EncodedPayload.etag, so a version doubles as the ETag of its model body
+    return hashlib.sha256(data).hexdigest()[:32]
+
+
+class ModelStore:
+    # Immutable aggregated models, each saved once under the hash of its bytes next to a JSON
+    # metadata record (round, contributing clients, parent version). LATEST names the published
+    # version. The serialized payloads of the most recently used versions are kept in memory, and
+    # compressed only once a download asks for that encoding, so storing a version never waits on it.
+    def __init__(self, root, cache_size=DEFAULT_CACHE_SIZE, encodings=('gzip',)):
+        self.root = root
+        self.objects = os.path.join(root, 'objects')
+        os.makedirs(self.objects, exist_ok=True)
+        self.cache_size = cache_size
+        self.encodings = encodings
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        self.latest = self._read_latest()
+
+    def path(self, version):
+        return os.path.join(self.objects, f"{version}.mlmodel")
+
+    def _metadata_path(self, version):
+        return os.path.join(self.objects, f"{version}.json")
+
+    def _read_latest(self):
+        try:
+            with open(os.path.join(self.root, 'LATEST')) as f:
+                version = f.read().strip()
+        except FileNotFoundError:
+            return None
+        return version if self.has(version) else None
+
+    def has(self, version):
+        return bool(version) and all(c in '0123456789abcdef' for c in version) and os.path.exists(self.path(version))
+
+    def put(self, data, **metadata):
+        # Stores the bytes if this content is new and returns its version; it is not published yet
+        version = content_version(data)
+        if not self.has(version):
+            write_atomic(self._metadata_path(version), json.dumps(
+                dict(metadata, version=version, size=len(data), created_at=time.time())).encode())
+            write_atomic(self.path(version), data)
+        self._remember(version, EncodedPayload(data, MODEL_MIMETYPE, encodings=self.encodings, lazy=True))
+        return version
+
+    def publish(self, version):
+        if not self.has(version):
+            raise KeyError(f"Unknown model version '{version}'")
+        write_atomic(os.path.join(self.root, 'LATEST'), version.encode())
+        self.latest = version
+
+    def metadata(self, version):
+        with open(self._metadata_path(version)) as f:
+            return json.load(f)
+
+    def versions(self):
+        records = [self.metadata(name[:-len('.json')]) for name in os.listdir(self.objects) if name.endswith('.json')]
+        return sorted(records, key=lambda record: record.get('created_at', 0))
+
+    def _remember(self, version, payload):
+        with self.lock:
+            self.cache[version] = payload
+            self.cache.move_to_end(version)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def payload(self, version):
+        # The EncodedPayload of a version, from memory when it is one of the recent ones
+        with self.lock:
+            payload = self.cache.get(version)
+            if payload is not None:
+                self.cache.move_to_end(version)
+                return payload
+        if not self.has(version):
+            return None
+        with open(self.path(version), 'rb') as f:
+            payload = EncodedPayload(f.read(), MODEL_MIMETYPE, encodings=self.encodings, lazy=True)
+        self._remember(version, payload)
+        return payload
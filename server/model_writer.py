@@ -0,0 +1,95 @@
+import coremltools as ct
+import numpy as np
+
+from model_store import write_atomic
+
+FLOAT_DTYPE = np.dtype('<f4')
+MAX_MARKER_ATTEMPTS = 8
+EMBEDDING_KINDS = ('embedding', 'embeddingND')
+
+
+def layer_fields(layer):
+    # (kind, WeightParams) of the float parameters the server writes into a layer
+    layer_type = layer.WhichOneof('layer')
+    if layer_type == 'innerProduct':
+        return [("weights", layer.innerProduct.weights), ("bias", layer.innerProduct.bias)]
+    if layer_type in EMBEDDING_KINDS:
+        params = getattr(layer, layer_type)
+        return [("weights", params.weights)] + ([("bias", params.bias)] if params.hasBias else [])
+    return []
+
+
+def find_embedding_layer(spec):
+    for layer in spec.neuralNetwork.layers:
+        if layer.WhichOneof('layer') in EMBEDDING_KINDS:
+            return layer
+    raise ValueError("Model has no embedding layer")
+
+
+def embedding_shape(layer):
+    # CoreML stores embeddings as (embedding size, vocab size): one column per vocabulary id
+    if layer.WhichOneof('layer') == 'embeddingND':
+        return layer.embeddingND.embeddingSize, layer.embeddingND.vocabSize
+    return layer.embedding.outputChannels, layer.embedding.inputDim
+
+
+class ModelTemplate:
+    # The base spec serialized once, with the byte range of every innerProduct or embedding
+    # parameter field of the given layers recorded. Proto3 packs repeated floats as raw
+    # little-endian float32, so writing a new model is a copy of the template with those ranges
+    # overwritten; the Python protobuf objects are never touched per round. Layers missing from
+    # the weights passed to render keep their base values.
+    def __init__(self, base_model_path, layer_names):
+        spec = ct.utils.load_spec(base_model_path)
+        fields = []
+        for layer in spec.neuralNetwork.layers:
+            if layer.name in layer_names:
+                fields.extend((layer.name, kind, field) for kind, field in layer_fields(layer))
+        missing = set(layer_names) - {name for name, _, _ in fields}
+        if missing:
+            raise ValueError(f"Base model has no innerProduct or embedding layers named {sorted(missing)}")
+        defaults = [np.array(field.floatValue, dtype=FLOAT_DTYPE).tobytes() for _, _, field in fields]
+
+        # Fill each field with a random marker pattern once, then locate the markers in the
+        # serialized bytes. A marker that is not unique in the template is redrawn.
+        for attempt in range(MAX_MARKER_ATTEMPTS):
+            markers = []
+            for index, (name, kind, field) in enumerate(fields):
+                count = len(field.floatValue)
+                if count == 0:
+                    raise ValueError(f"{name} {kind} is not stored as floatValue")
+                rng = np.random.default_rng([attempt, index])
+                bits = rng.integers(0, 1 << 23, size=count, dtype=np.uint32) | np.uint32(0x3F800000)
+                marker = bits.view(FLOAT_DTYPE)
+                field.floatValue[:] = marker.tolist()
+                markers.append(marker.tobytes())
+            template = spec.SerializeToString()
+            offsets = [template.find(marker) for marker in markers]
+            if all(offset >= 0 and template.find(marker, offset + 1) < 0 for offset, marker in zip(offsets, markers)):
+                break
+        else:
+            raise RuntimeError("Could not place unique weight markers in the model template")
+
+        # Markers are only needed to find the offsets; the template itself keeps the base values
+        buffer = bytearray(template)
+        for offset, values in zip(offsets, defaults):
+            buffer[offset:offset + len(values)] = values
+        self.template = bytes(buffer)
+        self.fields = {
+            (name, kind): (offset, len(field.floatValue))
+            for (name, kind, field), offset in zip(fields, offsets)
+        }
+
+    def render(self, weights):
+        buffer = bytearray(self.template)
+        for (name, kind), (offset, count) in self.fields.items():
+            if name not in weights:
+                continue
+            values = np.ascontiguousarray(weights[name][kind], dtype=FLOAT_DTYPE).ravel()
+            if values.size != count:
+                raise ValueError(f"{name} {kind} has {values.size} values, the model expects {count}")
+            buffer[offset:offset + count * FLOAT_DTYPE.itemsize] = values.tobytes()
+        return bytes(buffer)
+
+    def write(self, weights, output_path):
+        write_atomic(output_path, self.render(weights))
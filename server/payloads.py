@@ -0,0 +1,98 @@
+import gzip
+import hashlib
+import threading
+
+from flask import Response
+
+# brotli and zstandard are in requirements.txt; an environment without them still works and only
+# offers gzip and identity
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Preferred order when a client accepts several encodings with the same quality
+ENCODING_PREFERENCE = ['br', 'zstd', 'gzip', 'identity']
+
+
+def compress(body, encoding):
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=9, mtime=0)
+    if encoding == 'br' and brotli is not None:
+        return brotli.compress(body, quality=9)
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdCompressor(level=10).compress(body)
+    return None
+
+
+def can_compress(encoding):
+    return encoding == 'gzip' or (encoding == 'br' and brotli is not None) or (encoding == 'zstd' and zstandard is not None)
+
+
+class EncodedPayload:
+    # A response body that never changes once built, serialized and compressed up front so
+    # serving it is a dictionary lookup. lazy=True defers each compression to the first request that
+    # negotiates it, for large bodies built in a hot path that may never be served compressed. The
+    # ETag is the content hash of the identity body and is weak, since it is shared by every
+    # Content-Encoding of the same content.
+    def __init__(self, body, mimetype, encodings=('gzip', 'br', 'zstd'), lazy=False):
+        self.mimetype = mimetype
+        self.etag = hashlib.sha256(body).hexdigest()[:32]
+        self.encodings = ['identity'] + [encoding for encoding in encodings if can_compress(encoding)]
+        self.bodies = {'identity': body}
+        self.lock = threading.Lock()
+        if not lazy:
+            for encoding in self.encodings:
+                self.body(encoding)
+
+    def body(self, encoding):
+        compressed = self.bodies.get(encoding)
+        if compressed is None:
+            with self.lock:
+                compressed = self.bodies.get(encoding)
+                if compressed is None:
+                    compressed = self.bodies[encoding] = compress(self.bodies['identity'], encoding)
+        return compressed
+
+    def negotiate(self, accept_encodings):
+        # Highest quality wins, ties go to the earlier entry of ENCODING_PREFERENCE. identity stays
+        # acceptable at a token quality unless the client explicitly refuses it. None means nothing
+        # available is acceptable.
+        best, best_quality = None, 0
+        for encoding in ENCODING_PREFERENCE:
+            if encoding not in self.encodings:
+                continue
+            quality = accept_encodings.quality(encoding)
+            if encoding == 'identity' and quality == 0 and 'identity' not in accept_encodings:
+                quality = 0.001
+            if quality > best_quality:
+                best, best_quality = encoding, quality
+        return best
+
+
+def not_modified(etag, request):
+    return request.if_none_match.contains_weak(etag)
+
+
+def serve_payload(payload, request, encoding=None, mimetype=None):
+    # encoding pins a specific Content-Encoding, otherwise it is negotiated from Accept-Encoding
+    if not_modified(payload.etag, request):
+        response = Response(status=304)
+    else:
+        if encoding is None:
+            encoding = payload.negotiate(request.accept_encodings)
+            if encoding is None:
+                available = ', '.join(payload.encodings)
+                return Response(f"No acceptable Content-Encoding, this resource is available as {available}",
+                                status=406, mimetype='text/plain')
+        response = Response(payload.body(encoding), mimetype=mimetype or payload.mimetype)
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(payload.etag, weak=True)
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
@@ -0,0 +1,194 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import uuid
+
+from model_store import write_atomic
+
+SHA256_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def add_range(ranges, start, end):
+    # Inserts [start, end) into a sorted list of disjoint ranges, merging overlapping and touching ones
+    merged = []
+    for range_start, range_end in ranges:
+        if range_end < start or range_start > end:
+            merged.append([range_start, range_end])
+        else:
+            start, end = min(start, range_start), max(end, range_end)
+    merged.append([start, end])
+    return sorted(merged)
+
+
+def missing_ranges(ranges, size):
+    missing, position = [], 0
+    for start, end in ranges:
+        if start > position:
+            missing.append([position, start])
+        position = max(position, end)
+    if position < size:
+        missing.append([position, size])
+    return missing
+
+
+class UploadSession:
+    def __init__(self, upload_id, client_id, size, sha256, num_samples, received=None, status='receiving',
+                 updated_at=None):
+        self.upload_id = upload_id
+        self.client_id = client_id
+        self.size = size
+        self.sha256 = sha256
+        self.num_samples = num_samples
+        self.received = received or []
+        self.status = status
+        self.updated_at = updated_at or time.time()
+        self.lock = threading.Lock()
+
+    def to_json(self):
+        return {
+            "upload_id": self.upload_id, "client_id": self.client_id, "size": self.size, "sha256": self.sha256,
+            "num_samples": self.num_samples, "received": self.received, "status": self.status,
+            "updated_at": self.updated_at,
+        }
+
+    @property
+    def complete(self):
+        return self.received == [[0, self.size]] or self.size == 0
+
+
+class ResumableUploads:
+    # Uploads sent as any number of chunks at explicit offsets, resumable across dropped connections
+    # and server restarts. Each upload has a preallocated data file that chunks are pwrite()n into, and
+    # a small JSON file with the ranges received so far. Sessions are looked up by id in memory; the
+    # directory is only listed once, at startup, to reload them.
+    def __init__(self, directory, max_size, ttl_seconds=24 * 3600):
+        self.directory = directory
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.sessions = {}
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(directory, name)) as f:
+                    session = UploadSession(**json.load(f))
+            except (OSError, ValueError, TypeError):
+                continue
+            if session.status == 'verifying':
+                # Interrupted mid-check; the data is still in place and is checked again on the next chunk
+                session.status = 'receiving'
+            self.sessions[session.upload_id] = session
+
+    def data_path(self, upload_id):
+        return os.path.join(self.directory, f"{upload_id}.data")
+
+    def _meta_path(self, upload_id):
+        return os.path.join(self.directory, f"{upload_id}.json")
+
+    def _save(self, session):
+        session.updated_at = time.time()
+        write_atomic(self._meta_path(session.upload_id), json.dumps(session.to_json()).encode('utf-8'))
+
+    def _expire_locked(self):
+        cutoff = time.time() - self.ttl_seconds
+        for upload_id in [u for u, session in self.sessions.items() if session.updated_at < cutoff]:
+            del self.sessions[upload_id]
+            for path in (self.data_path(upload_id), self._meta_path(upload_id)):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def initiate(self, client_id, size, sha256, num_samples):
+        # Returns (session, created). An unfinished session of the same client for the same bytes and
+        # sample count is returned instead of a new one, so a retried initiate resumes where it left off.
+        if not 0 <= size <= self.max_size:
+            raise ValueError(f"Upload size must be between 0 and {self.max_size} bytes")
+        if not SHA256_PATTERN.match(sha256):
+            raise ValueError("sha256 must be 64 lowercase hex digits")
+        with self.lock:
+            self._expire_locked()
+            for session in self.sessions.values():
+                if (session.client_id, session.sha256, session.size, session.num_samples) == \
+                        (client_id, sha256, size, num_samples) and session.status == 'receiving':
+                    return session, False
+            session = UploadSession(uuid.uuid4().hex, client_id, size, sha256, num_samples)
+            with open(self.data_path(session.upload_id), 'wb') as f:
+                # Reserve the space up front where the filesystem supports it
+                if size and hasattr(os, 'posix_fallocate'):
+                    os.posix_fallocate(f.fileno(), 0, size)
+                else:
+                    f.truncate(size)
+            self._save(session)
+            self.sessions[session.upload_id] = session
+        return session, True
+
+    def get(self, upload_id):
+        with self.lock:
+            return self.sessions.get(upload_id)
+
+    def write(self, session, offset, stream, length, chunk_size=1024 * 1024):
+        # Copies length bytes from stream to offset. Whatever arrived before a dropped connection is
+        # still recorded, so the client only resends the rest.
+        if session.status != 'receiving':
+            raise ValueError(f"Upload is {session.status}")
+        if offset < 0 or length < 0 or offset + length > session.size:
+            raise ValueError(f"Chunk [{offset}, {offset + length}) is outside the {session.size}-byte upload")
+        written = 0
+        fd = os.open(self.data_path(session.upload_id), os.O_WRONLY)
+        try:
+            while written < length:
+                data = stream.read(min(chunk_size, length - written))
+                if not data:
+                    break
+                os.pwrite(fd, data, offset + written)
+                written += len(data)
+        finally:
+            os.close(fd)
+            if written:
+                with session.lock:
+                    session.received = add_range(session.received, offset, offset + written)
+                    self._save(session)
+        if written < length:
+            raise ValueError(f"Chunk ended after {written} of {length} bytes")
+        return written
+
+    def complete(self, session, destination):
+        # Once every byte has arrived, checks the data against the declared sha256 and moves it to
+        # destination. Returns False while ranges are missing or another request is already completing
+        # the upload. A mismatch clears the received ranges, as there is no telling which chunk was
+        # corrupted, and raises ValueError.
+        with session.lock:
+            if session.status != 'receiving' or not session.complete:
+                return False
+            session.status = 'verifying'
+        digest = hashlib.sha256()
+        with open(self.data_path(session.upload_id), 'rb') as f:
+            for block in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                digest.update(block)
+        with session.lock:
+            if digest.hexdigest() != session.sha256:
+                session.received = []
+                session.status = 'receiving'
+                self._save(session)
+                raise ValueError(f"Received data hashes to {digest.hexdigest()}, not the declared {session.sha256}")
+            os.replace(self.data_path(session.upload_id), destination)
+            session.status = 'complete'
+        with self.lock:
+            self.sessions.pop(session.upload_id, None)
+        os.remove(self._meta_path(session.upload_id))
+        return True
+
+    def discard(self, session):
+        with self.lock:
+            self.sessions.pop(session.upload_id, None)
+        for path in (self.data_path(session.upload_id), self._meta_path(session.upload_id)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def __len__(self):
+        return len(self.sessions)
@@ -0,0 +1,141 @@
+import threading
+import time
+
+
+class RoundCoordinator:
+    # Owns the round number and runs at most one aggregation at a time. A round is aggregated once
+    # `quorum` uploads have arrived since the previous one, or `deadline` seconds after the first of
+    # them, whichever comes first. Concurrent /aggregate calls join the in-flight job instead of
+    # starting their own. aggregate_fn(round_number, options) gets the options of the
+    # request_aggregation call that started the round, or None for rounds started any other way.
+    # Rounds are numbered on from start_round, the last one completed before a restart.
+    def __init__(self, aggregate_fn, quorum=1, deadline=None, start_round=0):
+        self.aggregate_fn = aggregate_fn
+        self.quorum = max(1, quorum)
+        self.deadline = deadline if deadline and deadline > 0 else None
+        self.condition = threading.Condition()
+        self.round = start_round
+        self.pending = 0
+        self.in_flight = None
+        self.round_started_at = None
+        self.last_result = None
+        self.last_error = None
+        self.last_completed_at = None
+        self._timer = None
+        self._in_flight_uploads = 0
+
+    def on_upload(self, count=1):
+        # count > 1 adds several uploads at once, so they can only ever start a single round
+        if count < 1:
+            return
+        with self.condition:
+            self.pending += count
+            if self.pending == count:
+                self.round_started_at = time.time()
+                if self.deadline is not None:
+                    self._timer = threading.Timer(self.deadline, self._deadline_passed)
+                    self._timer.daemon = True
+                    self._timer.start()
+            if self.pending >= self.quorum:
+                self._start_locked()
+
+    def _deadline_passed(self):
+        with self.condition:
+            if self.pending > 0:
+                print(f"⏰ Round {self.round + 1} deadline passed with {self.pending}/{self.quorum} uploads")
+                self._start_locked()
+
+    def _start_locked(self, options=None):
+        if self.in_flight is not None:
+            # Uploads that arrive mid-aggregation stay pending and are picked up when it finishes
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self.in_flight = self.round + 1
+        self._in_flight_uploads = self.pending
+        self.pending = 0
+        self.round_started_at = None
+        threading.Thread(target=self._run, args=(self.in_flight, options), daemon=True).start()
+
+    def _run(self, round_number, options):
+        result, error = None, None
+        try:
+            result = self.aggregate_fn(round_number, options)
+        except Exception as e:
+            error = str(e)
+            print(f"❌ Aggregation for round {round_number} failed: {e}")
+        with self.condition:
+            if error is None:
+                self.round = round_number
+                self.last_result = result
+            else:
+                # Put the uploads back so the next upload or /aggregate call retries the round; the
+                # options of the failed request are not carried over to it
+                self.pending += self._in_flight_uploads
+            self.last_error = error
+            self.last_completed_at = time.time()
+            self.in_flight = None
+            self.condition.notify_all()
+            if error is not None:
+                return
+            if self.pending >= self.quorum:
+                self._start_locked()
+            elif self.pending > 0 and self.deadline is not None:
+                self.round_started_at = time.time()
+                self._timer = threading.Timer(self.deadline, self._deadline_passed)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def request_aggregation(self, force=False, options=None):
+        # Returns the round number the caller should wait for: the in-flight round, a round started
+        # because quorum was met (or force was given with pending uploads), or the last completed round.
+        # options only apply to a round this call starts; None is returned when they are given and no
+        # round starts, rather than keeping them for some later round.
+        with self.condition:
+            if self.in_flight is None and self.pending > 0 and (force or self.pending >= self.quorum):
+                self._start_locked(options)
+                return self.in_flight
+            if options is not None:
+                return None
+            if self.in_flight is not None:
+                return self.in_flight
+            return self.round
+
+    def wait_for_round(self, round_number, timeout):
+        # Waits while round_number is the job in flight; a failed job returns early with False
+        end = time.time() + timeout
+        with self.condition:
+            while self.round < round_number and self.in_flight == round_number:
+                remaining = end - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return self.round >= round_number
+
+    def wait_for_change(self, after_round, timeout):
+        end = time.time() + timeout
+        with self.condition:
+            while self.round <= after_round:
+                remaining = end - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return self.status_locked()
+
+    def status_locked(self):
+        return {
+            "round": self.round,
+            "in_flight": self.in_flight,
+            "pending_uploads": self.pending,
+            "quorum": self.quorum,
+            "deadline_seconds": self.deadline,
+            "round_started_at": self.round_started_at,
+            "last_completed_at": self.last_completed_at,
+            "last_result": self.last_result,
+            "last_error": self.last_error,
+        }
+
+    def status(self):
+        with self.condition:
+            return self.status_locked()
@@ -0,0 +1,185 @@
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from aggregation import aggregate
+from metrics_store import MetricsSink, classification_report
+
+# Keras names of the fine-tuned layers and the CoreML layers they become. Weights travel in CoreML
+# layout (innerProduct weights are [out, in] row-major) so the server's aggregation code applies as is.
+KERAS_TO_COREML = {"dense1": "sequential/dense1/BiasAdd", "output": "sequential/output/BiasAdd"}
+
+# Per-worker state, set up once by init_worker in each pool process
+_model = None
+_inputs = None
+_labels = None
+
+
+def partition(labels, num_clients, rng, alpha=None):
+    # IID shuffle when alpha is None, otherwise per-class Dirichlet(alpha) proportions across clients
+    if alpha is None:
+        return np.array_split(rng.permutation(len(labels)), num_clients)
+    shards = [[] for _ in range(num_clients)]
+    for label in np.unique(labels):
+        indices = rng.permutation(np.flatnonzero(labels == label))
+        cuts = (np.cumsum(rng.dirichlet([alpha] * num_clients))[:-1] * len(indices)).astype(int)
+        for shard, part in zip(shards, np.split(indices, cuts)):
+            shard.append(part)
+    return [rng.permutation(np.concatenate(parts)) for parts in shards]
+
+
+def get_layer_weights(model):
+    return {
+        coreml: {"weights": model.get_layer(keras).kernel.numpy().T.ravel(),
+                 "bias": model.get_layer(keras).bias.numpy().ravel()}
+        for keras, coreml in KERAS_TO_COREML.items()
+    }
+
+
+def set_layer_weights(model, weights):
+    for keras, coreml in KERAS_TO_COREML.items():
+        layer = model.get_layer(keras)
+        kernel_shape = layer.kernel.shape
+        kernel = np.asarray(weights[coreml]["weights"], dtype=np.float32).reshape(kernel_shape[1], kernel_shape[0]).T
+        layer.set_weights([kernel, np.asarray(weights[coreml]["bias"], dtype=np.float32)])
+
+
+def load_model(keras_model_path):
+    import tensorflow as tf
+    model = tf.keras.models.load_model(keras_model_path)
+    # Only the updatable layers train, as on device
+    for layer in model.layers:
+        layer.trainable = layer.name in KERAS_TO_COREML
+    return model
+
+
+def init_worker(keras_model_path, inputs_path, labels_path):
+    global _model, _inputs, _labels
+    import tensorflow as tf
+    # One thread per worker; the pool provides the parallelism
+    tf.config.threading.set_intra_op_parallelism_threads(1)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    _model = load_model(keras_model_path)
+    _inputs = np.load(inputs_path, mmap_mode='r')
+    _labels = np.load(labels_path, mmap_mode='r')
+
+
+def run_client(client_index, round_number, indices, global_weights, local_epochs, batch_size, learning_rate, holdout):
+    # Like a device: evaluate the downloaded global model on local held-out data, then fine-tune on the rest
+    import tensorflow as tf
+    set_layer_weights(_model, global_weights)
+    num_holdout = max(1, int(len(indices) * holdout))
+    test_indices, train_indices = np.sort(indices[:num_holdout]), np.sort(indices[num_holdout:])
+
+    start = time.perf_counter()
+    probs = _model.predict(_inputs[test_indices], batch_size=256, verbose=0)[:, 1]
+    report = classification_report(f"sim-{client_index}", round_number, _labels[test_indices], probs,
+                                   (time.perf_counter() - start) * 1000)
+
+    _model.compile(loss='sparse_categorical_crossentropy',
+                   optimizer=tf.keras.optimizers.Adam(learning_rate=learning_rate))
+    _model.fit(_inputs[train_indices], _labels[train_indices], batch_size=batch_size, epochs=local_epochs, verbose=0)
+    return get_layer_weights(_model), len(train_indices), report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate federated rounds with CPU Keras clients")
+    parser.add_argument("--clients", type=int, default=20, help="virtual clients the training set is split across")
+    parser.add_argument("--clients-per-round", type=int, help="clients sampled each round (default: all)")
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--alpha", type=float, help="Dirichlet concentration for non-IID splits (default: IID)")
+    parser.add_argument("--local-epochs", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--learning-rate", type=float, default=0.001)
+    parser.add_argument("--holdout", type=float, default=0.2, help="share of each client's data kept for its report")
+    parser.add_argument("--rule", default="fedavg", help="aggregation rule, as for /aggregate?rule=")
+    parser.add_argument("--target-accuracy", type=float, default=0.85)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--metrics-db", default="simulation_metrics.db")
+    parser.add_argument("--summary", help="write per-round results as JSON to this path")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # Loads the data and pretrained model from the artifact cache, building them on a miss, without
+    # touching any server state
+    import dataset
+
+    rng = np.random.default_rng(args.seed)
+    shards = partition(dataset.train_labels, args.clients, rng, args.alpha)
+    # Skewed Dirichlet splits can leave a client too little data to both train and report on
+    eligible = [i for i, shard in enumerate(shards) if len(shard) >= 2]
+    per_round = min(args.clients_per_round or args.clients, len(eligible))
+    print(f"Split {len(dataset.train_labels)} samples over {args.clients} clients "
+          f"({'IID' if args.alpha is None else f'Dirichlet alpha={args.alpha}'}), {per_round} per round")
+
+    workdir = tempfile.mkdtemp(prefix="fl_sim_")
+    inputs_path = os.path.join(workdir, "inputs.npy")
+    labels_path = os.path.join(workdir, "labels.npy")
+    np.save(inputs_path, np.asarray(dataset.train_inputs, dtype=np.int32))
+    np.save(labels_path, np.asarray(dataset.train_labels))
+
+    global_model = load_model(dataset.KERAS_MODEL_PATH)
+    global_weights = get_layer_weights(global_model)
+    sink = MetricsSink(args.metrics_db)
+    results = []
+    target_round = None
+
+    # spawn keeps TensorFlow state out of the workers until they initialize it themselves
+    context = multiprocessing.get_context("spawn")
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers, mp_context=context, initializer=init_worker,
+                                 initargs=(dataset.KERAS_MODEL_PATH, inputs_path, labels_path)) as pool:
+            for round_number in range(1, args.rounds + 1):
+                start = time.perf_counter()
+                selected = rng.choice(eligible, size=per_round, replace=False)
+                futures = [pool.submit(run_client, int(i), round_number, shards[i], global_weights, args.local_epochs,
+                                       args.batch_size, args.learning_rate, args.holdout) for i in selected]
+                updates = [future.result() for future in futures]
+                train_seconds = time.perf_counter() - start
+
+                averaged = aggregate(args.rule, [w for w, _, _ in updates], [n for _, n, _ in updates])
+                global_weights = {layer: {kind: values.astype(np.float32) for kind, values in params.items()}
+                                  for layer, params in averaged.items()}
+                for _, _, report in updates:
+                    sink.record('client_reports', report)
+
+                set_layer_weights(global_model, global_weights)
+                probs = global_model.predict(dataset.test_inputs, batch_size=256, verbose=0)[:, 1]
+                test_report = classification_report("global", round_number, dataset.test_labels, probs, 0.0)
+                elapsed = time.perf_counter() - start
+
+                if target_round is None and test_report["accuracy"] >= args.target_accuracy:
+                    target_round = round_number
+                results.append({
+                    "round": round_number, "seconds": elapsed, "client_seconds": train_seconds,
+                    "test_accuracy": test_report["accuracy"], "test_f1": test_report["f1_score"],
+                    "client_accuracy": float(np.mean([r["accuracy"] for _, _, r in updates])),
+                })
+                print(f"round {round_number:>4}  {elapsed:7.2f}s (clients {train_seconds:6.2f}s)  "
+                      f"test acc {test_report['accuracy']:.4f}  f1 {test_report['f1_score']:.4f}  "
+                      f"mean client acc {results[-1]['client_accuracy']:.4f}")
+    finally:
+        sink.flush()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    mean_seconds = np.mean([r["seconds"] for r in results]) if results else 0.0
+    print(f"Mean wall-clock per round: {mean_seconds:.2f}s")
+    if target_round is None:
+        print(f"Test accuracy {args.target_accuracy} not reached in {args.rounds} rounds")
+    else:
+        print(f"Rounds to test accuracy {args.target_accuracy}: {target_round}")
+    if args.summary:
+        with open(args.summary, "w") as f:
+            json.dump({"args": vars(args), "rounds_to_target": target_round,
+                       "mean_seconds_per_round": mean_seconds, "rounds": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
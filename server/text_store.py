@@ -0,0 +1,76 @@
+import mmap
+import os
+import shutil
+
+import numpy as np
+
+TEXTS_NAME = 'texts.bin'
+OFFSETS_NAME = 'offsets.npy'
+LABELS_NAME = 'labels.npy'
+
+
+class TextStore:
+    # One dataset split on disk: every text's UTF-8 bytes back to back in texts.bin, an offsets array
+    # with n + 1 entries delimiting them, and the labels as a packed array. All three are memory-mapped
+    # on first access, so a process only pages in the texts it actually reads.
+    def __init__(self, path):
+        self.path = path
+        self._texts = None
+        self._offsets = None
+        self._labels = None
+
+    @classmethod
+    def build(cls, path, examples):
+        # examples yields (text as str or UTF-8 bytes, int label); written to a temp dir, then renamed
+        tmp_path = path + '.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        offsets, labels = [0], []
+        with open(os.path.join(tmp_path, TEXTS_NAME), 'wb') as f:
+            for text, label in examples:
+                data = text.encode('utf-8') if isinstance(text, str) else bytes(text)
+                f.write(data)
+                offsets.append(offsets[-1] + len(data))
+                labels.append(label)
+        np.save(os.path.join(tmp_path, OFFSETS_NAME), np.array(offsets, dtype=np.uint64))
+        np.save(os.path.join(tmp_path, LABELS_NAME), np.array(labels, dtype=np.uint8))
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+        return cls(path)
+
+    def _open(self):
+        self._offsets = np.load(os.path.join(self.path, OFFSETS_NAME), mmap_mode='r')
+        self._labels = np.load(os.path.join(self.path, LABELS_NAME), mmap_mode='r')
+        with open(os.path.join(self.path, TEXTS_NAME), 'rb') as f:
+            # mmap cannot map an empty file
+            self._texts = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self._offsets[-1] else b''
+
+    @property
+    def offsets(self):
+        if self._offsets is None:
+            self._open()
+        return self._offsets
+
+    @property
+    def labels(self):
+        if self._labels is None:
+            self._open()
+        return self._labels
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def raw(self, index):
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return self._texts[int(start):int(end)]
+
+    def text(self, index):
+        return self.raw(index).decode('utf-8')
+
+    def texts(self, indices=None):
+        # Decoded lazily, one text at a time
+        for index in range(len(self)) if indices is None else indices:
+            yield self.text(index)
+
+    def samples(self, indices):
+        return [{"text": self.text(i), "label": int(self.labels[i])} for i in indices]
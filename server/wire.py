@@ -0,0 +1,302 @@
+import struct
+
+import numpy as np
+
+from aggregation import ExactSum, PartialAggregate
+
+# Token shard: a fixed header followed by the (num_samples, max_len) token matrix in row-major
+# little-endian order and one uint8 label per sample
+SHARD_MAGIC = b'FSDS'
+SHARD_VERSION = 1
+SHARD_HEADER = struct.Struct('<4sHHII')  # magic, version, token itemsize, num_samples, max_len
+
+
+def token_dtype(vocab_size):
+    return np.dtype('<i2') if vocab_size <= np.iinfo(np.int16).max else np.dtype('<i4')
+
+
+def encode_shard(inputs, labels, dtype):
+    inputs = np.ascontiguousarray(inputs, dtype=dtype)
+    labels = np.ascontiguousarray(labels, dtype=np.uint8)
+    if inputs.ndim != 2 or len(inputs) != len(labels):
+        raise ValueError(f"Expected (n, max_len) inputs and n labels, got {inputs.shape} and {labels.shape}")
+    header = SHARD_HEADER.pack(SHARD_MAGIC, SHARD_VERSION, inputs.dtype.itemsize, inputs.shape[0], inputs.shape[1])
+    return header + inputs.tobytes() + labels.tobytes()
+
+
+def decode_shard(blob):
+    magic, version, itemsize, num_samples, max_len = SHARD_HEADER.unpack_from(blob, 0)
+    if magic != SHARD_MAGIC or version != SHARD_VERSION:
+        raise ValueError(f"Not a version {SHARD_VERSION} token shard")
+    dtype = np.dtype(f'<i{itemsize}')
+    inputs = np.frombuffer(blob, dtype=dtype, count=num_samples * max_len, offset=SHARD_HEADER.size)
+    labels = np.frombuffer(blob, dtype=np.uint8, count=num_samples, offset=SHARD_HEADER.size + inputs.nbytes)
+    return inputs.reshape(num_samples, max_len), labels
+
+
+# Layer patch: the full current tensors of the updatable layers of one model version, plus the rows
+# of row-sparse layers (the embedding) that differ from the base, applied on top of any model built
+# from the same base. Strings are uint16-length-prefixed UTF-8.
+PATCH_MAGIC = b'FSLP'
+PATCH_VERSION = 2
+PATCH_HEADER = struct.Struct('<4sHH')  # magic, version, number of layers
+TENSOR_HEADER = struct.Struct('<I')  # element count
+ROWS_HEADER = struct.Struct('<II')  # number of rows, row size
+STR_LEN = struct.Struct('<H')
+PATCH_DTYPE = np.dtype('<f4')
+
+
+def pack_str(value):
+    encoded = value.encode('utf-8')
+    return STR_LEN.pack(len(encoded)) + encoded
+
+
+def unpack_str(blob, offset):
+    (length,) = STR_LEN.unpack_from(blob, offset)
+    offset += STR_LEN.size
+    return bytes(blob[offset:offset + length]).decode('utf-8'), offset + length
+
+
+def encode_layer_patch(model_version, base_version, layers, row_layers=None):
+    # row_layers maps a layer name to (row ids, (rows, row size) values), as uint32 ids and float32 rows
+    row_layers = row_layers or {}
+    parts = [PATCH_HEADER.pack(PATCH_MAGIC, PATCH_VERSION, len(layers)), pack_str(model_version), pack_str(base_version)]
+    for name, params in layers.items():
+        parts.append(pack_str(name))
+        parts.append(STR_LEN.pack(len(params)))
+        for kind, values in params.items():
+            values = np.ascontiguousarray(values, dtype=PATCH_DTYPE).ravel()
+            parts.append(pack_str(kind))
+            parts.append(TENSOR_HEADER.pack(values.size))
+            parts.append(values.tobytes())
+    parts.append(STR_LEN.pack(len(row_layers)))
+    for name, (rows, values) in row_layers.items():
+        rows = np.ascontiguousarray(rows, dtype='<u4')
+        values = np.ascontiguousarray(values, dtype=PATCH_DTYPE)
+        if values.ndim != 2 or len(values) != len(rows):
+            raise ValueError(f"Expected one value row per row id, got {values.shape} for {len(rows)} rows")
+        parts.append(pack_str(name))
+        parts.append(ROWS_HEADER.pack(len(rows), values.shape[1]))
+        parts.append(rows.tobytes())
+        parts.append(values.tobytes())
+    return b''.join(parts)
+
+
+def decode_layer_patch(blob):
+    magic, version, num_layers = PATCH_HEADER.unpack_from(blob, 0)
+    if magic != PATCH_MAGIC or version != PATCH_VERSION:
+        raise ValueError(f"Not a version {PATCH_VERSION} layer patch")
+    model_version, offset = unpack_str(blob, PATCH_HEADER.size)
+    base_version, offset = unpack_str(blob, offset)
+    layers = {}
+    for _ in range(num_layers):
+        name, offset = unpack_str(blob, offset)
+        (num_tensors,) = STR_LEN.unpack_from(blob, offset)
+        offset += STR_LEN.size
+        params = {}
+        for _ in range(num_tensors):
+            kind, offset = unpack_str(blob, offset)
+            (count,) = TENSOR_HEADER.unpack_from(blob, offset)
+            offset += TENSOR_HEADER.size
+            params[kind] = np.frombuffer(blob, dtype=PATCH_DTYPE, count=count, offset=offset)
+            offset += count * PATCH_DTYPE.itemsize
+        layers[name] = params
+    (num_row_layers,) = STR_LEN.unpack_from(blob, offset)
+    offset += STR_LEN.size
+    row_layers = {}
+    for _ in range(num_row_layers):
+        name, offset = unpack_str(blob, offset)
+        num_rows, row_size = ROWS_HEADER.unpack_from(blob, offset)
+        offset += ROWS_HEADER.size
+        rows = np.frombuffer(blob, dtype='<u4', count=num_rows, offset=offset).astype(np.int64)
+        offset += num_rows * 4
+        values = np.frombuffer(blob, dtype=PATCH_DTYPE, count=num_rows * row_size, offset=offset)
+        offset += values.nbytes
+        row_layers[name] = (rows, values.reshape(num_rows, row_size))
+    if offset != len(blob):
+        raise ValueError(f"Layer patch has {len(blob) - offset} trailing bytes")
+    return model_version, base_version, layers, row_layers
+
+
+# Compressed client update: per-tensor deltas of the updatable layers against a stated base model
+# version, each tensor in one of the encodings below
+UPDATE_MAGIC = b'FSUP'
+UPDATE_VERSION = 1
+UPDATE_HEADER = struct.Struct('<4sHH')  # magic, version, number of layers
+UPDATE_SAMPLES = struct.Struct('<I')
+UPDATE_TENSOR = struct.Struct('<BI')  # encoding, dense element count
+INT8_SCALE = struct.Struct('<f')
+TOPK_COUNT = struct.Struct('<I')
+
+ENCODING_FP16 = 1
+ENCODING_INT8 = 2
+ENCODING_TOPK = 3
+UPDATE_ENCODINGS = {'fp16': ENCODING_FP16, 'int8': ENCODING_INT8, 'topk': ENCODING_TOPK}
+
+
+def encode_tensor_delta(delta, encoding, k=None):
+    delta = np.ascontiguousarray(delta, dtype=np.float32).ravel()
+    code = UPDATE_ENCODINGS[encoding]
+    header = UPDATE_TENSOR.pack(code, delta.size)
+    if code == ENCODING_FP16:
+        return header + delta.astype('<f2').tobytes()
+    if code == ENCODING_INT8:
+        # Symmetric per-tensor scale so the largest magnitude maps to +/-127
+        max_abs = float(np.abs(delta).max()) if delta.size else 0.0
+        scale = max_abs / 127.0 if max_abs > 0 else 1.0
+        quantized = np.clip(np.rint(delta / scale), -127, 127).astype(np.int8)
+        return header + INT8_SCALE.pack(scale) + quantized.tobytes()
+    # Top-k keeps the k largest-magnitude entries as (uint32 index, float32 value) pairs
+    k = delta.size if k is None else min(int(k), delta.size)
+    indices = np.argpartition(np.abs(delta), delta.size - k)[delta.size - k:] if k else np.zeros(0, np.int64)
+    indices = np.sort(indices).astype('<u4')
+    return header + TOPK_COUNT.pack(k) + indices.tobytes() + delta[indices].astype('<f4').tobytes()
+
+
+def decode_tensor_delta(blob, offset):
+    code, count = UPDATE_TENSOR.unpack_from(blob, offset)
+    offset += UPDATE_TENSOR.size
+    if code == ENCODING_FP16:
+        delta = np.frombuffer(blob, dtype='<f2', count=count, offset=offset).astype(np.float32)
+        return delta, offset + count * 2
+    if code == ENCODING_INT8:
+        (scale,) = INT8_SCALE.unpack_from(blob, offset)
+        offset += INT8_SCALE.size
+        quantized = np.frombuffer(blob, dtype=np.int8, count=count, offset=offset)
+        return quantized.astype(np.float32) * np.float32(scale), offset + count
+    if code == ENCODING_TOPK:
+        (k,) = TOPK_COUNT.unpack_from(blob, offset)
+        offset += TOPK_COUNT.size
+        indices = np.frombuffer(blob, dtype='<u4', count=k, offset=offset)
+        offset += k * 4
+        values = np.frombuffer(blob, dtype='<f4', count=k, offset=offset)
+        if k and int(indices.max()) >= count:
+            raise ValueError(f"Top-k index {int(indices.max())} out of range for {count} elements")
+        delta = np.zeros(count, dtype=np.float32)
+        delta[indices] = values
+        return delta, offset + k * 4
+    raise ValueError(f"Unknown tensor encoding {code}")
+
+
+def encode_update(base_version, num_samples, deltas, encoding, k=None):
+    parts = [UPDATE_HEADER.pack(UPDATE_MAGIC, UPDATE_VERSION, len(deltas)), pack_str(base_version),
+             UPDATE_SAMPLES.pack(num_samples)]
+    for name, params in deltas.items():
+        parts.append(pack_str(name))
+        parts.append(STR_LEN.pack(len(params)))
+        for kind, delta in params.items():
+            parts.append(pack_str(kind))
+            parts.append(encode_tensor_delta(delta, encoding, k))
+    return b''.join(parts)
+
+
+def decode_update(blob):
+    magic, version, num_layers = UPDATE_HEADER.unpack_from(blob, 0)
+    if magic != UPDATE_MAGIC or version != UPDATE_VERSION:
+        raise ValueError(f"Not a version {UPDATE_VERSION} compressed update")
+    base_version, offset = unpack_str(blob, UPDATE_HEADER.size)
+    (num_samples,) = UPDATE_SAMPLES.unpack_from(blob, offset)
+    offset += UPDATE_SAMPLES.size
+    deltas = {}
+    for _ in range(num_layers):
+        name, offset = unpack_str(blob, offset)
+        (num_tensors,) = STR_LEN.unpack_from(blob, offset)
+        offset += STR_LEN.size
+        params = {}
+        for _ in range(num_tensors):
+            kind, offset = unpack_str(blob, offset)
+            params[kind], offset = decode_tensor_delta(blob, offset)
+        deltas[name] = params
+    if offset != len(blob):
+        raise ValueError(f"Compressed update has {len(blob) - offset} trailing bytes")
+    return base_version, num_samples, deltas
+
+
+# Partial aggregate: the exact FedAvg sums an edge server pushes to the root. Per tensor, every digit
+# of its ExactSum as float64, plus the total sample count and the ids of the contributing clients.
+PARTIAL_MAGIC = b'FSPA'
+PARTIAL_VERSION = 1
+PARTIAL_HEADER = struct.Struct('<4sHHqI')  # magic, version, number of layers, total samples, number of clients
+PARTIAL_TENSOR = struct.Struct('<IIB')  # element count, terms since the last carry, number of digits
+PARTIAL_DIGIT = struct.Struct('<B')  # digit index
+PARTIAL_DTYPE = np.dtype('<f8')
+
+
+def encode_partial(partial):
+    parts = [PARTIAL_HEADER.pack(PARTIAL_MAGIC, PARTIAL_VERSION, len(partial.sums), partial.total_samples,
+                                 len(partial.clients))]
+    parts.extend(pack_str(client_id) for client_id in partial.clients)
+    for name, layer_sums in partial.sums.items():
+        parts.append(pack_str(name))
+        parts.append(STR_LEN.pack(len(layer_sums)))
+        for kind, exact in layer_sums.items():
+            size = next(iter(exact.digits.values())).size if exact.digits else 0
+            parts.append(pack_str(kind))
+            parts.append(PARTIAL_TENSOR.pack(size, exact.pending, len(exact.digits)))
+            for index, digit in sorted(exact.digits.items()):
+                parts.append(PARTIAL_DIGIT.pack(index))
+                parts.append(np.ascontiguousarray(digit, dtype=PARTIAL_DTYPE).ravel().tobytes())
+    return b''.join(parts)
+
+
+def decode_partial(blob):
+    magic, version, num_layers, total_samples, num_clients = PARTIAL_HEADER.unpack_from(blob, 0)
+    if magic != PARTIAL_MAGIC or version != PARTIAL_VERSION:
+        raise ValueError(f"Not a version {PARTIAL_VERSION} partial aggregate")
+    offset = PARTIAL_HEADER.size
+    partial = PartialAggregate()
+    partial.total_samples = total_samples
+    for _ in range(num_clients):
+        client_id, offset = unpack_str(blob, offset)
+        partial.clients.append(client_id)
+    for _ in range(num_layers):
+        name, offset = unpack_str(blob, offset)
+        (num_tensors,) = STR_LEN.unpack_from(blob, offset)
+        offset += STR_LEN.size
+        layer_sums = partial.sums[name] = {}
+        for _ in range(num_tensors):
+            kind, offset = unpack_str(blob, offset)
+            size, pending, num_digits = PARTIAL_TENSOR.unpack_from(blob, offset)
+            offset += PARTIAL_TENSOR.size
+            exact = layer_sums[kind] = ExactSum()
+            exact.pending = pending
+            for _ in range(num_digits):
+                (index,) = PARTIAL_DIGIT.unpack_from(blob, offset)
+                offset += PARTIAL_DIGIT.size
+                exact.digits[index] = np.frombuffer(blob, dtype=PARTIAL_DTYPE, count=size, offset=offset).astype(np.float64)
+                offset += size * PARTIAL_DTYPE.itemsize
+    if offset != len(blob):
+        raise ValueError(f"Partial aggregate has {len(blob) - offset} trailing bytes")
+    return partial
+
+
+# Sparse embedding update: deltas of just the embedding rows (vocabulary ids) a client touched,
+# against a stated model version. Row ids are uint32; the (rows, row size) delta matrix is one
+# tensor in any of the compressed update encodings.
+EMBEDDING_MAGIC = b'FSER'
+EMBEDDING_VERSION = 1
+EMBEDDING_HEADER = struct.Struct('<4sHIII')  # magic, version, num_samples, number of rows, row size
+
+
+def encode_embedding_update(base_version, num_samples, rows, deltas, encoding='fp16'):
+    rows = np.ascontiguousarray(rows, dtype='<u4')
+    deltas = np.asarray(deltas, dtype=np.float32)
+    if deltas.ndim != 2 or len(deltas) != len(rows):
+        raise ValueError(f"Expected one delta row per row id, got {deltas.shape} for {len(rows)} rows")
+    return b''.join([EMBEDDING_HEADER.pack(EMBEDDING_MAGIC, EMBEDDING_VERSION, num_samples, len(rows), deltas.shape[1]),
+                     pack_str(base_version), rows.tobytes(), encode_tensor_delta(deltas, encoding)])
+
+
+def decode_embedding_update(blob):
+    magic, version, num_samples, num_rows, row_size = EMBEDDING_HEADER.unpack_from(blob, 0)
+    if magic != EMBEDDING_MAGIC or version != EMBEDDING_VERSION:
+        raise ValueError(f"Not a version {EMBEDDING_VERSION} embedding update")
+    base_version, offset = unpack_str(blob, EMBEDDING_HEADER.size)
+    rows = np.frombuffer(blob, dtype='<u4', count=num_rows, offset=offset).astype(np.int64)
+    offset += num_rows * 4
+    deltas, offset = decode_tensor_delta(blob, offset)
+    if deltas.size != num_rows * row_size:
+        raise ValueError(f"Embedding update holds {deltas.size} values for {num_rows} rows of {row_size}")
+    if offset != len(blob):
+        raise ValueError(f"Embedding update has {len(blob) - offset} trailing bytes")
+    return base_version, num_samples, rows, deltas.reshape(num_rows, row_size)